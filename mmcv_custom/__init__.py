@@ -1,4 +1,4 @@
 # from .image_io import imread
-from .runner import Runner
+from .runner import Runner, load_checkpoint
 
 # __all__ = ['imread', '']
@@ -191,21 +191,68 @@ def get_keypoints():
     }
     return keypoints, keypoint_flip_map
 
-def flip_keypoints(keypoints, keypoint_flip_map, keypoint_coords, width):
-    """Left/right flip keypoint_coords. keypoints and keypoint_flip_map are
-    accessible from get_keypoints().
+def get_flip_index(keypoints=None, keypoint_flip_map=None):
+    """Get the permutation that swaps left/right joints.
+
+    `kpts[..., flip_index, :]` is the left/right swapped version of `kpts`,
+    for any number of joints. The COCO definition from get_keypoints() is
+    used by default.
+
+    Returns:
+        ndarray: int64 array of shape (num_keypoints, ).
     """
-    # flipped_kps = keypoint_coords.copy()
-    flipped_kps = keypoint_coords.clone()
+    if keypoints is None:
+        keypoints, keypoint_flip_map = get_keypoints()
+    flip_index = np.arange(len(keypoints), dtype=np.int64)
     for lkp, rkp in keypoint_flip_map.items():
         lid = keypoints.index(lkp)
         rid = keypoints.index(rkp)
-        flipped_kps[:, lid, :] = keypoint_coords[:, rid, :]
-        flipped_kps[:, rid, :] = keypoint_coords[:, lid, :]
+        flip_index[lid] = rid
+        flip_index[rid] = lid
+    return flip_index
+
+
+COCO_FLIP_INDEX = get_flip_index()
+
+
+def flip_keypoints_numpy(kpts, width, flip_index=None):
+    """Horizontally flip keypoints of shape (..., num_keypoints, C), with
+    x stored in channel 0, by a single gather.
+    """
+    if flip_index is None:
+        flip_index = COCO_FLIP_INDEX
+    flipped_kps = kpts[..., flip_index, :]
+    flipped_kps[..., 0] = width - flipped_kps[..., 0] - 1
+    return flipped_kps
+
 
-    # Flip x coordinates
-    flipped_kps[:, :, 0] = width - flipped_kps[:, :, 0] - 1
+def flip_keypoints_torch(kpts, width, flip_index=None):
+    """Torch version of flip_keypoints_numpy()."""
+    if flip_index is None:
+        flip_index = COCO_FLIP_INDEX
+    flip_index = torch.as_tensor(flip_index, device=kpts.device)
+    flipped_kps = kpts.index_select(-2, flip_index)
+    flipped_kps[..., 0] = width - flipped_kps[..., 0] - 1
+    return flipped_kps
+
+
+def flip_keypoints(keypoints, keypoint_flip_map, keypoint_coords, width):
+    """Left/right flip keypoint_coords. keypoints and keypoint_flip_map are
+    accessible from get_keypoints().
+    """
+    flip_index = get_flip_index(keypoints, keypoint_flip_map)
     # # Maintain COCO convention that if visibility == 0, then x, y = 0
     # inds = np.where(flipped_kps[:, 2, :] == 0)
     # flipped_kps[inds[0], 0, inds[1]] = 0
-    return flipped_kps
+    return flip_keypoints_torch(keypoint_coords, width, flip_index)
+
+
+def keypoints_xy2xyv(kpts, vis=1):
+    """Convert (N, num_keypoints * 2) xy keypoints into the COCO
+    (N, num_keypoints * 3) xyv layout in one shot.
+    """
+    kpts = np.asarray(kpts)
+    num_kpts = kpts.shape[1] // 2
+    xyv = np.full((kpts.shape[0], num_kpts, 3), vis, dtype=kpts.dtype)
+    xyv[..., :2] = kpts.reshape(kpts.shape[0], num_kpts, 2)
+    return xyv.reshape(kpts.shape[0], num_kpts * 3)
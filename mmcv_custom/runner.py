@@ -18,9 +18,15 @@ def load_checkpoint(model,
                     filename,
                     map_location=None,
                     strict=False,
-                    logger=None):
+                    logger=None,
+                    init_extra_stages=False):
     """Load checkpoint from a file or URI.
 
+    Unlike :func:`mmcv.runner.load_checkpoint`, the weights of the modules
+    whose layout changed are converted by their `remap_state_dict` first
+    (e.g. the fused layers of `PointSetAnchorPoseHead`), so every tool loads
+    the checkpoints through this function.
+
     Args:
         model (Module): Module to load checkpoint.
         filename (str): Either a filepath or URL or modelzoo://xxxxxxx.
@@ -28,6 +34,8 @@ def load_checkpoint(model,
         strict (bool): Whether to allow different params for the model and
             checkpoint.
         logger (:mod:`logging.Logger` or None): The logger for error message.
+        init_extra_stages (bool): Initialize the third stage of the pose
+            detector with the weights of the second one, when training.
 
     Returns:
         dict or OrderedDict: The loaded checkpoint.
@@ -67,7 +75,7 @@ def load_checkpoint(model,
         state_dict = {k[7:]: v for k, v in checkpoint['state_dict'].items()}
     # load state_dict
 
-    if True:
+    if init_extra_stages:
         # TODO(xiao): init stage3 with stage2
         state_dict_ = state_dict.copy()
         for k, v in state_dict.items():
@@ -76,6 +84,12 @@ def load_checkpoint(model,
                 state_dict_[kk] = v.clone()
         state_dict = state_dict_.copy()
 
+    # convert the weights of modules whose layout changed (e.g. fused layers)
+    module = model.module if hasattr(model, 'module') else model
+    for name, m in module.named_modules():
+        if hasattr(m, 'remap_state_dict'):
+            m.remap_state_dict(state_dict, name + '.' if name else '')
+
     if hasattr(model, 'module'):
         load_state_dict(model.module, state_dict, strict, logger)
     else:
@@ -193,4 +207,4 @@ class Runner(mmcv.runner.Runner):
     def load_checkpoint(self, filename, map_location='cpu', strict=False):
         self.logger.info('load checkpoint from %s', filename)
         return load_checkpoint(self.model, filename, map_location, strict,
-                               self.logger)
+                               self.logger, init_extra_stages=True)
@@ -6,8 +6,8 @@ import numpy as np
 import pycocotools.mask as maskUtils
 import torch
 from mmcv.parallel import collate, scatter
-from mmcv.runner import load_checkpoint
 
+from mmcv_custom import load_checkpoint
 from mmdet.core import get_classes
 from mmdet.datasets.pipelines import Compose
 from mmdet.models import build_detector
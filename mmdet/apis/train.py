@@ -6,10 +6,11 @@ import torch
 from mmcv.parallel import MMDataParallel, MMDistributedDataParallel
 from mmcv.runner import DistSamplerSeedHook, Runner, obj_from_dict, hooks
 
+from mmcv_custom import load_checkpoint
 from mmdet import datasets
 from mmdet.core import (CocoDistEvalmAPHook, CocoDistEvalRecallHook,
                         DistEvalmAPHook, DistOptimizerHook, Fp16OptimizerHook, CocoPoseDistEvalmAPHook)
-from mmdet.datasets import DATASETS, build_dataloader
+from mmdet.datasets import DATASETS, DataPrefetcher, build_dataloader
 from .env import get_root_logger
 
 
@@ -144,9 +145,17 @@ def _dist_train(model, dataset, cfg, validate=False):
     dataset = dataset if isinstance(dataset, (list, tuple)) else [dataset]
     data_loaders = [
         build_dataloader(
-            ds, cfg.data.imgs_per_gpu, cfg.data.workers_per_gpu, dist=True)
-        for ds in dataset
+            ds,
+            cfg.data.imgs_per_gpu,
+            cfg.data.workers_per_gpu,
+            dist=True,
+            pin_memory=cfg.data.get('pin_memory', False)) for ds in dataset
     ]
+    if cfg.data.get('prefetch', False):
+        data_loaders = [
+            DataPrefetcher(data_loader, [torch.cuda.current_device()])
+            for data_loader in data_loaders
+        ]
     # put model on gpus
     model = MMDistributedDataParallel(model.cuda())
 
@@ -184,7 +193,11 @@ def _dist_train(model, dataset, cfg, validate=False):
     if cfg.resume_from:
         runner.resume(cfg.resume_from)
     elif cfg.load_from:
-        runner.load_checkpoint(cfg.load_from)
+        # converts the layers whose layout changed, unlike the mmcv runner
+        runner.logger.info('load checkpoint from %s', cfg.load_from)
+        load_checkpoint(
+            runner.model, cfg.load_from, map_location='cpu',
+            logger=runner.logger)
     runner.run(data_loaders, cfg.workflow, cfg.total_epochs)
 
 
@@ -202,8 +215,14 @@ def _non_dist_train(model, dataset, cfg, validate=False):
             cfg.data.imgs_per_gpu,
             cfg.data.workers_per_gpu,
             cfg.gpus,
-            dist=False) for ds in dataset
+            dist=False,
+            pin_memory=cfg.data.get('pin_memory', False)) for ds in dataset
     ]
+    if cfg.data.get('prefetch', False):
+        data_loaders = [
+            DataPrefetcher(data_loader, range(cfg.gpus))
+            for data_loader in data_loaders
+        ]
     # put model on gpus
     model = MMDataParallel(model, device_ids=range(cfg.gpus)).cuda()
 
@@ -224,5 +243,9 @@ def _non_dist_train(model, dataset, cfg, validate=False):
     if cfg.resume_from:
         runner.resume(cfg.resume_from)
     elif cfg.load_from:
-        runner.load_checkpoint(cfg.load_from)
+        # converts the layers whose layout changed, unlike the mmcv runner
+        runner.logger.info('load checkpoint from %s', cfg.load_from)
+        load_checkpoint(
+            runner.model, cfg.load_from, map_location='cpu',
+            logger=runner.logger)
     runner.run(data_loaders, cfg.workflow, cfg.total_epochs)
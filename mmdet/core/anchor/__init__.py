@@ -1,5 +1,8 @@
+from .anchor_cache import AnchorCache
 from .anchor_generator import AnchorGenerator
-from .anchor_target import anchor_inside_flags, anchor_target
+from .anchor_target import (anchor_inside_flags, anchor_target,
+                            compact_target, compact_targets_to_levels,
+                            images_to_levels_sparse)
 from .guided_anchor_target import ga_loc_target, ga_shape_target
 from .point_generator import PointGenerator
 from .point_target import point_target
@@ -10,7 +13,9 @@ from .template_target import template_target
 from .template_target_nobbox import template_target_nobbox
 
 __all__ = [
-    'AnchorGenerator', 'anchor_target', 'anchor_inside_flags', 'ga_loc_target',
+    'AnchorGenerator', 'AnchorCache', 'anchor_target', 'anchor_inside_flags',
+    'images_to_levels_sparse', 'compact_target', 'compact_targets_to_levels',
+    'ga_loc_target',
     'ga_shape_target', 'PointGenerator', 'point_target',
     'point_set_anchor_target', 'get_corner_points_from_anchor_points',
     'TemplateGenerator', 'template_target', 'template_target_nobbox'
@@ -0,0 +1,32 @@
+from collections import OrderedDict
+
+
+class AnchorCache(object):
+    """LRU cache of the anchors of a head at inference.
+
+    The anchors only depend on the feature map sizes (and on the padded image
+    shapes for the valid flags), which take few values at test time, e.g. one
+    per scale of the test augmentation. The cached tensors are shared by the
+    calls and must not be modified in place.
+
+    Args:
+        max_size (int): Maximum number of entries.
+    """
+
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, key, compute):
+        """Cached value of `key`, computed by `compute()` on a miss."""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        value = compute()
+        self._entries[key] = value
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._entries.clear()
@@ -91,6 +91,166 @@ def images_to_levels(target, num_level_anchors):
     return level_targets
 
 
+def images_to_levels_sparse(pos_inds, targets, num_level_anchors):
+    """Convert positive-only targets by image to targets by feature level.
+
+    Only the positive anchors of an image carry regression targets, so they
+    are kept as the indices of those anchors (into the anchors of all levels
+    of the image) and the targets of the positives, in the same order.
+
+    Args:
+        pos_inds (list[Tensor]): Positive anchor indices of each image.
+        targets (list[list]): Each item holds one kind of target of all
+            images, as tensors (or lists) whose rows match `pos_inds`.
+        num_level_anchors (list[int]): Anchor number of each level.
+
+    Returns:
+        tuple: `level_pos_inds` and one list per kind of target.
+            `level_pos_inds[i]` indexes the predictions of level i flattened
+            over (image, anchor), i.e. `pred.permute(0, 2, 3, 1).reshape(
+            -1, c)`, and the targets of level i are aligned with it.
+    """
+    level_pos_inds = []
+    level_targets = [[] for _ in targets]
+    start = 0
+    for n in num_level_anchors:
+        end = start + n
+        in_levels = [(inds >= start) & (inds < end) for inds in pos_inds]
+        level_pos_inds.append(
+            torch.cat([
+                inds[in_level] - start + img_id * n
+                for img_id, (inds, in_level) in enumerate(
+                    zip(pos_inds, in_levels))
+            ]))
+        for target, level_target in zip(targets, level_targets):
+            if isinstance(target[0], torch.Tensor):
+                level_target.append(
+                    torch.cat([t[in_level] for t, in_level in zip(
+                        target, in_levels)]))
+            else:
+                level_target.append([
+                    t for img_target, in_level in zip(target, in_levels)
+                    for t, keep in zip(img_target, in_level.tolist()) if keep
+                ])
+        start = end
+    return (level_pos_inds, ) + tuple(level_targets)
+
+
+def compact_target(featmap_sizes, labels_list, label_weights_list,
+                   level_pos_inds, level_targets, num_pos, num_neg):
+    """Pack the per-level targets of a single image.
+
+    The result only holds the positives and a validity mask of the anchors,
+    which is cheap to send from a data worker to the main process, and is
+    turned back into batch targets by :func:`compact_targets_to_levels`.
+
+    Args:
+        featmap_sizes (list[tuple]): Feature map size of each level of the
+            image the targets were computed on.
+        labels_list, label_weights_list (list[Tensor]): Dense per-level
+            labels and label weights of the image.
+        level_pos_inds (list[Tensor]): Positive anchor indices of each level.
+        level_targets (list[list]): Per-level positive-only targets, one
+            list per kind of target (see :func:`images_to_levels_sparse`).
+        num_pos, num_neg (int): Sample numbers the loss is normalized with.
+
+    Returns:
+        dict: Compact targets.
+    """
+    return dict(
+        featmap_sizes=[tuple(int(s) for s in size) for size in featmap_sizes],
+        num_pos=int(num_pos),
+        num_neg=int(num_neg),
+        pos_inds=level_pos_inds,
+        pos_labels=[
+            labels[inds] for labels, inds in zip(labels_list, level_pos_inds)
+        ],
+        pos_label_weights=[
+            weights[inds]
+            for weights, inds in zip(label_weights_list, level_pos_inds)
+        ],
+        valid=[weights > 0 for weights in label_weights_list],
+        targets=level_targets)
+
+
+def compact_targets_to_levels(compact_targets, featmap_sizes,
+                              num_base_anchors, device):
+    """Turn compact targets of each image into batch targets by level.
+
+    The anchors at a feature map location do not depend on the size of the
+    feature map, so targets computed on the feature maps of a single image
+    are moved to the (possibly larger, padded) feature maps of the batch.
+    Anchors outside of the image feature maps are not valid and get zero
+    label weights, as they would get from the valid flags.
+
+    Args:
+        compact_targets (list[dict]): Targets of each image, see
+            :func:`compact_target`.
+        featmap_sizes (list[tuple]): Feature map size of each level of the
+            batch.
+        num_base_anchors (int): Anchor number of each location.
+        device (torch.device): Device of the returned targets.
+
+    Returns:
+        tuple: `labels_list`, `label_weights_list`, `level_pos_inds`, one
+            list per kind of positive-only target, `num_total_pos` and
+            `num_total_neg`, as from the online target functions, or None if
+            the targets of some image do not fit into the batch feature maps.
+    """
+    for targets in compact_targets:
+        for (h, w), (feat_h, feat_w) in zip(targets['featmap_sizes'],
+                                            featmap_sizes):
+            if h > feat_h or w > feat_w:
+                return None
+    labels_list = []
+    label_weights_list = []
+    level_pos_inds = []
+    num_kinds = len(compact_targets[0]['targets'])
+    level_targets = [[] for _ in range(num_kinds)]
+    for lvl, (feat_h, feat_w) in enumerate(featmap_sizes):
+        num_anchors = int(feat_h) * int(feat_w) * num_base_anchors
+        labels = []
+        label_weights = []
+        pos_inds = []
+        for img_id, targets in enumerate(compact_targets):
+            h, w = targets['featmap_sizes'][lvl]
+            inds = targets['pos_inds'][lvl].to(device)
+            # (y, x, anchor) on the image feature map -> the batch one
+            loc, anchor_id = inds // num_base_anchors, inds % num_base_anchors
+            inds = ((loc // w) * int(feat_w) +
+                    loc % w) * num_base_anchors + anchor_id
+            valid = targets['valid'][lvl].to(device).view(
+                h, w, num_base_anchors)
+            img_label_weights = valid.new_zeros(
+                (int(feat_h), int(feat_w), num_base_anchors),
+                dtype=torch.float)
+            img_label_weights[:h, :w] = valid.float()
+            img_label_weights = img_label_weights.view(-1)
+            img_label_weights[inds] = targets['pos_label_weights'][lvl].to(
+                device)
+            img_labels = inds.new_zeros(num_anchors)
+            img_labels[inds] = targets['pos_labels'][lvl].to(device)
+            labels.append(img_labels)
+            label_weights.append(img_label_weights)
+            pos_inds.append(inds + img_id * num_anchors)
+        labels_list.append(torch.stack(labels).squeeze(0))
+        label_weights_list.append(torch.stack(label_weights).squeeze(0))
+        level_pos_inds.append(torch.cat(pos_inds))
+        for i in range(num_kinds):
+            target = [
+                targets['targets'][i][lvl] for targets in compact_targets
+            ]
+            if isinstance(target[0], torch.Tensor):
+                target = torch.cat(target).to(device)
+            else:
+                target = [t for img_target in target for t in img_target]
+            level_targets[i].append(target)
+    num_total_pos = sum(targets['num_pos'] for targets in compact_targets)
+    num_total_neg = sum(targets['num_neg'] for targets in compact_targets)
+    return ((labels_list, label_weights_list, level_pos_inds) +
+            tuple(level_targets) + (num_total_pos, num_total_neg))
+
+
 def anchor_target_single(flat_anchors,
                          valid_flags,
                          gt_bboxes,
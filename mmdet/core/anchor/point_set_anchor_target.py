@@ -1,9 +1,9 @@
 import torch
-import numpy as np
 
 from ..bbox import (PointSetAnchorPseudoSampler, assign_and_sample, bbox2delta, points2delta,
                     pointdist2distdelta, build_assigner)
 from ..utils import multi_apply
+from .anchor_target import images_to_levels_sparse
 from mmcv import Config
 
 
@@ -60,10 +60,22 @@ def point_set_anchor_target(anchor_points_list,
         gt_labels_list = [None for _ in range(num_imgs)]
     if gt_masks_list is None:
         gt_masks_list = [None for _ in range(num_imgs)]
-    (all_labels, all_label_weights, all_bbox_targets, all_bbox_weights,
-     all_point_dist_targets, all_point_dist_weights, all_point_dists_binary_targets,
-     all_corner_targets, all_corner_weights, all_contour_targets, pos_inds_list,
-     neg_inds_list) = multi_apply(
+    # the assigner and sampler are shared by all images
+    bbox_assigner = None
+    bbox_sampler = None
+    assign_result_list = [None for _ in range(num_imgs)]
+    if not sampling:
+        bbox_assigner = build_assigner(cfg.assigner)
+        bbox_sampler = PointSetAnchorPseudoSampler()
+        if cfg.get('batch_assign', False):
+            assign_result_list = point_set_anchor_assign_batch(
+                bbox_assigner, anchor_list, valid_flag_list, gt_bboxes_list,
+                gt_bboxes_ignore_list, gt_labels_list, img_metas,
+                cfg) or assign_result_list
+    (all_labels, all_label_weights, all_pos_anchor_inds, all_bbox_targets,
+     all_bbox_weights, all_point_dist_targets, all_point_dist_weights,
+     all_point_dists_binary_targets, all_corner_targets, all_corner_weights,
+     all_contour_targets, pos_inds_list, neg_inds_list) = multi_apply(
          anchor_target_single,
          anchor_points_list,
          anchor_points_count_list,
@@ -74,11 +86,14 @@ def point_set_anchor_target(anchor_points_list,
          gt_labels_list,
          gt_masks_list,
          img_metas,
+         assign_result_list,
          featmap_sizes=featmap_sizes,
          target_means=target_means,
          target_stds=target_stds,
          corner_number=corner_number,
          cfg=cfg,
+         bbox_assigner=bbox_assigner,
+         bbox_sampler=bbox_sampler,
          label_channels=label_channels,
          sampling=sampling,
          unmap_outputs=unmap_outputs)
@@ -91,39 +106,63 @@ def point_set_anchor_target(anchor_points_list,
     # split targets to a list w.r.t. multiple levels
     labels_list = images_to_levels(all_labels, num_level_anchors)
     label_weights_list = images_to_levels(all_label_weights, num_level_anchors)
-    bbox_targets_list = images_to_levels(all_bbox_targets, num_level_anchors)
-    bbox_weights_list = images_to_levels(all_bbox_weights, num_level_anchors)
-    point_dist_targets_list = images_to_levels(all_point_dist_targets, num_level_anchors)
-    point_dist_weights_list = images_to_levels(all_point_dist_weights, num_level_anchors)
-    point_dists_binary_targets_list = images_to_levels(all_point_dists_binary_targets, num_level_anchors)
-    corner_targets_list = images_to_levels(all_corner_targets, num_level_anchors)
-    corner_weights_list = images_to_levels(all_corner_weights, num_level_anchors)
-    contour_targets_list = images_to_levels_by_list(all_contour_targets, num_level_anchors)
-    anchor_list = images_to_levels(anchor_list, num_level_anchors)
-    anchor_points_list = images_to_levels(anchor_points_list, num_level_anchors)
-
-    return (labels_list, label_weights_list, bbox_targets_list,
-            bbox_weights_list, point_dist_targets_list, point_dist_weights_list,
+    # regression targets only exist for the positives
+    (pos_anchor_inds_list, bbox_targets_list, bbox_weights_list,
+     point_dist_targets_list, point_dist_weights_list,
+     point_dists_binary_targets_list, corner_targets_list,
+     corner_weights_list, contour_targets_list) = images_to_levels_sparse(
+         all_pos_anchor_inds,
+         [all_bbox_targets, all_bbox_weights, all_point_dist_targets,
+          all_point_dist_weights, all_point_dists_binary_targets,
+          all_corner_targets, all_corner_weights, all_contour_targets],
+         num_level_anchors)
+
+    return (labels_list, label_weights_list, pos_anchor_inds_list,
+            bbox_targets_list, bbox_weights_list, point_dist_targets_list,
+            point_dist_weights_list,
             point_dists_binary_targets_list, corner_targets_list, corner_weights_list,
-            contour_targets_list, anchor_list, anchor_points_list,
-            num_total_pos, num_total_neg)
-
-def images_to_levels_by_list(target, num_level_anchors):
-    """Convert targets by image to targets by feature level.
-
-    [target_img0, target_img1] -> [target_level0, target_level1, ...]
+            contour_targets_list, num_total_pos, num_total_neg)
+
+def point_set_anchor_assign_batch(bbox_assigner, anchor_list,
+                                  valid_flag_list, gt_bboxes_list,
+                                  gt_bboxes_ignore_list, gt_labels_list,
+                                  img_metas, cfg):
+    """Assign the gts of all images at once (`cfg.batch_assign`).
+
+    The gts are padded to the largest number of gts of the batch, see
+    `PointSetAnchorCenterAssigner.assign_batch`. Returns None if the batch
+    is not supported (other assigners, ignored gts or images without gt), in
+    which case each image is assigned on its own.
     """
-    # concat all lists in target
-    level_targets = []
-    start = 0
-    for n in num_level_anchors:
-        end = start + n
-        current_target = []
-        for t in target:
-            current_target.extend(t[start:end])
-        level_targets.append(current_target)
-        start = end
-    return level_targets
+    if cfg.assigner.type != 'PointSetAnchorCenterAssigner' or \
+            bbox_assigner.spatial_pruning or gt_labels_list[0] is None:
+        return None
+    if bbox_assigner.ignore_iof_thr > 0 and any(
+            gt_bboxes_ignore is not None and gt_bboxes_ignore.numel() > 0
+            for gt_bboxes_ignore in gt_bboxes_ignore_list):
+        return None
+    num_gts = [gt_bboxes.size(0) for gt_bboxes in gt_bboxes_list]
+    if min(num_gts) == 0:
+        return None
+    num_imgs = len(gt_bboxes_list)
+    inside_flags = torch.stack([
+        anchor_inside_flags(anchors, valid_flags, img_meta['img_shape'][:2],
+                            cfg.allowed_border).bool()
+        for anchors, valid_flags, img_meta in zip(anchor_list, valid_flag_list,
+                                                  img_metas)
+    ])
+    if not inside_flags.any(dim=1).all():
+        return None
+    gt_bboxes = gt_bboxes_list[0].new_zeros((num_imgs, max(num_gts), 4))
+    gt_valid = gt_bboxes.new_zeros((num_imgs, max(num_gts)), dtype=torch.bool)
+    gt_labels = gt_labels_list[0].new_zeros((num_imgs, max(num_gts)))
+    for i in range(num_imgs):
+        gt_bboxes[i, :num_gts[i]] = gt_bboxes_list[i]
+        gt_valid[i, :num_gts[i]] = True
+        gt_labels[i, :num_gts[i]] = gt_labels_list[i]
+    return bbox_assigner.assign_batch(
+        torch.stack(anchor_list), inside_flags, gt_bboxes, gt_valid,
+        gt_labels)
 
 
 def images_to_levels(target, num_level_anchors):
@@ -152,11 +191,14 @@ def anchor_target_single(flat_points,
                          gt_labels,
                          gt_masks,
                          img_meta,
+                         assign_result,
                          featmap_sizes,
                          target_means,
                          target_stds,
                          corner_number,
                          cfg,   #cfg = train_cfg
+                         bbox_assigner=None,
+                         bbox_sampler=None,
                          label_channels=1,
                          sampling=True,
                          unmap_outputs=True):
@@ -165,7 +207,7 @@ def anchor_target_single(flat_points,
                                        cfg.allowed_border)
     assert corner_number == 4
     if not inside_flags.any():
-        return (None, ) * 6
+        return (None, ) * 13
     # assign gt and sample anchors
     anchors = flat_anchors[inside_flags, :]
     points = flat_points[inside_flags, :]
@@ -175,38 +217,44 @@ def anchor_target_single(flat_points,
         assign_result, sampling_result = assign_and_sample(
             anchors, gt_bboxes, gt_bboxes_ignore, None, cfg)
     else:
-        bbox_assigner = build_assigner(cfg.assigner)
+        if bbox_assigner is None:
+            bbox_assigner = build_assigner(cfg.assigner)
 
-        if cfg.assigner.type == 'PointSetAnchorCenterAssigner':
+        if assign_result is not None:
+            # assigned with the other images of the batch
+            pass
+        elif cfg.assigner.type == 'PointSetAnchorCenterAssigner':
             assign_result = bbox_assigner.assign(anchors, gt_bboxes,
                                                 gt_bboxes_ignore, gt_labels)
         else:
             raise NotImplementedError
-        bbox_sampler = PointSetAnchorPseudoSampler()
+        if bbox_sampler is None:
+            bbox_sampler = PointSetAnchorPseudoSampler()
         sampling_result = bbox_sampler.sample(assign_result, anchors, gt_bboxes,
                                               points, points_count, gt_masks)
 
     num_valid_anchors = anchors.shape[0]
-    bbox_targets = torch.zeros_like(anchors)
-    bbox_weights = torch.zeros_like(anchors)
     labels = anchors.new_zeros(num_valid_anchors, dtype=torch.long)
     label_weights = anchors.new_zeros(num_valid_anchors, dtype=torch.float)
+    # regression targets are kept for the positives only
+    bbox_targets = anchors.new_zeros((0, 4))
+    bbox_weights = anchors.new_zeros((0, 4))
     # assigned target points on contour
-    point_dists_targets = points.new_zeros(points.shape[0], points.shape[1]//2)
-    point_dists_binary_targets = points.new_zeros(points.shape[0], points.shape[1]//2)
-    point_dists_weights = points.new_zeros(points.shape[0], points.shape[1]//2)
+    point_dists_targets = points.new_zeros(0, points.shape[1]//2)
+    point_dists_binary_targets = points.new_zeros(0, points.shape[1]//2)
+    point_dists_weights = points.new_zeros(0, points.shape[1]//2)
     # corner targets
-    corner_targets = points.new_zeros(points.shape[0], corner_number * 2)
-    corner_weights = points.new_zeros(points.shape[0], corner_number * 2)
+    corner_targets = points.new_zeros(0, corner_number * 2)
+    corner_weights = points.new_zeros(0, corner_number * 2)
     # raw target contour
-    contour_targets = np.empty(num_valid_anchors, dtype=object)
+    contour_targets = []
 
     pos_inds = sampling_result.pos_inds
     neg_inds = sampling_result.neg_inds
     if len(pos_inds) > 0:
-        pos_bbox_targets = bbox2delta(sampling_result.pos_bboxes,
-                                      sampling_result.pos_gt_bboxes,
-                                      target_means, target_stds)
+        bbox_targets = bbox2delta(sampling_result.pos_bboxes,
+                                  sampling_result.pos_gt_bboxes,
+                                  target_means, target_stds)
         # assign anchor point to GT point
         assigned_corner_gts, assigned_point_dists, assigned_binary_mask =\
             corner_anchor_points_assign(sampling_result.pos_masks,
@@ -217,25 +265,19 @@ def anchor_target_single(flat_points,
         # encdoing targets
         # TODO: corner should be point to line, not point to point?
         pos_corner_points = get_corner_points_from_anchor_points(sampling_result.pos_masks)
-        pos_corner_targets = points2delta(pos_corner_points,
-                                          sampling_result.pos_bboxes,
-                                          assigned_corner_gts,
-                                          0, 1)
-        pos_point_dists_targets = pointdist2distdelta(assigned_point_dists,
-                                                      sampling_result.pos_bboxes,
-                                                      sampling_result.pos_points_count,
-                                                      0, 1)
-        bbox_targets[pos_inds, :] = pos_bbox_targets
-        bbox_weights[pos_inds, :] = 1.0
-        point_dists_targets[pos_inds, :] = pos_point_dists_targets
-        point_dists_binary_targets[pos_inds, :] = assigned_binary_mask
-        point_dists_weights[pos_inds, :] = 1.0
-        corner_targets[pos_inds, :] = pos_corner_targets
-        corner_weights[pos_inds, :] = 1.0
-        contour_targets[pos_inds.cpu().numpy()] = sampling_result.pos_gt_masks
-        #for i in range(len(pos_inds)):
-        #    idx = pos_inds[i]
-        #    contour_targets[idx] = sampling_result.pos_gt_masks[i]
+        corner_targets = points2delta(pos_corner_points,
+                                      sampling_result.pos_bboxes,
+                                      assigned_corner_gts,
+                                      0, 1)
+        point_dists_targets = pointdist2distdelta(assigned_point_dists,
+                                                  sampling_result.pos_bboxes,
+                                                  sampling_result.pos_points_count,
+                                                  0, 1)
+        bbox_weights = torch.ones_like(bbox_targets)
+        point_dists_binary_targets = assigned_binary_mask.type_as(point_dists_targets)
+        point_dists_weights = torch.ones_like(point_dists_targets)
+        corner_weights = torch.ones_like(corner_targets)
+        contour_targets = sampling_result.pos_gt_masks
         if gt_labels is None:
             labels[pos_inds] = 1
         else:
@@ -248,22 +290,16 @@ def anchor_target_single(flat_points,
         label_weights[neg_inds] = 1.0
 
     # map up to original set of anchors
+    pos_anchor_inds = pos_inds
     if unmap_outputs:
         num_total_anchors = flat_anchors.size(0)
         labels = unmap(labels, num_total_anchors, inside_flags)
         label_weights = unmap(label_weights, num_total_anchors, inside_flags)
-        bbox_targets = unmap(bbox_targets, num_total_anchors, inside_flags)
-        bbox_weights = unmap(bbox_weights, num_total_anchors, inside_flags)
-        point_dists_targets = unmap(point_dists_targets, num_total_anchors, inside_flags)
-        point_dists_weights = unmap(point_dists_weights, num_total_anchors, inside_flags)
-        point_dists_binary_targets = unmap(point_dists_binary_targets, num_total_anchors, inside_flags)
-        corner_targets = unmap(corner_targets, num_total_anchors, inside_flags)
-        corner_weights = unmap(corner_weights, num_total_anchors, inside_flags)
-        contour_targets = unmap_by_list(contour_targets.tolist(), num_total_anchors, inside_flags)
+        pos_anchor_inds = inside_flags.nonzero().squeeze(1)[pos_inds]
 
-    return (labels, label_weights, bbox_targets, bbox_weights, point_dists_targets,
-            point_dists_weights, point_dists_binary_targets, corner_targets, corner_weights,
-            contour_targets, pos_inds, neg_inds)
+    return (labels, label_weights, pos_anchor_inds, bbox_targets, bbox_weights,
+            point_dists_targets, point_dists_weights, point_dists_binary_targets,
+            corner_targets, corner_weights, contour_targets, pos_inds, neg_inds)
 
 
 def get_corner_points_from_anchor_points(point_proposals):
@@ -501,11 +537,3 @@ def unmap(data, count, inds, fill=0):
         ret = data.new_full(new_size, fill)
         ret[inds, :] = data
     return ret
-
-
-def unmap_by_list(data, count, inds, fill=0):
-    ret = np.full(count, fill, dtype=object)
-    inds_np = (inds == 1).cpu().numpy()
-    ret[inds_np] = data
-    ret = ret.tolist()
-    return ret
@@ -2,6 +2,7 @@ import torch
 
 from ..bbox import TemplatePseudoSampler, build_assigner, bbox2delta
 from ..utils import multi_apply
+from .anchor_target import images_to_levels_sparse
 
 
 def template2delta(proposals, scales, gt, means, stds, use_out_scale):
@@ -57,7 +58,17 @@ def template_target(anchor_list,
                     gt_labels_list=None,
                     label_channels=1,
                     sampling=True,
-                    unmap_outputs=True):
+                    unmap_outputs=True,
+                    assign_candidates_list=None,
+                    return_assign_candidates=False):
+    """Compute the targets of the templates of all images.
+
+    With `return_assign_candidates`, the (gt, anchor) candidate pairs of the
+    assignment of each image are returned too (see
+    `MaxOksIoUAssigner.get_candidates`), which can be given as
+    `assign_candidates_list` to only compute the OKS of those pairs when
+    assigning the refined templates of the next stage.
+    """
     num_imgs = len(img_metas)
     assert len(anchor_list) == len(anchor_list) == len(valid_flag_list) == num_imgs
 
@@ -77,9 +88,24 @@ def template_target(anchor_list,
     if gt_bboxes_ignore_list is None:
         gt_bboxes_ignore_list = [None for _ in range(num_imgs)]
 
-    (all_labels, all_label_weights, all_reg_targets, all_reg_weights,
-    all_reg_bbx_targets, all_reg_bbx_weights,
-    pos_inds_list, neg_inds_list) = multi_apply(
+    if assign_candidates_list is None:
+        assign_candidates_list = [None for _ in range(num_imgs)]
+
+    # the assigner and sampler are shared by all images
+    template_assigner = build_assigner(cfg.assigner)
+    template_sampler = TemplatePseudoSampler()
+    assign_result_list = [None for _ in range(num_imgs)]
+    if cfg.get('batch_assign', False) and not sampling and \
+            all(c is None for c in assign_candidates_list):
+        assign_result_list = template_assign_batch(
+            template_assigner, anchor_list, valid_flag_list,
+            gt_keypoints_list, gt_labels_list, img_metas, anchor_infos,
+            cfg, record_candidates=return_assign_candidates) or \
+            assign_result_list
+
+    (all_labels, all_label_weights, all_pos_anchor_inds, all_reg_targets,
+     all_reg_weights, all_reg_bbx_targets, all_reg_bbx_weights,
+     pos_inds_list, neg_inds_list, all_assign_candidates) = multi_apply(
          template_target_single,
          anchor_list,
          anchor_bbx_list,
@@ -90,13 +116,18 @@ def template_target(anchor_list,
          gt_bboxes_ignore_list,
          gt_labels_list,
          img_metas,
+         assign_result_list,
+         assign_candidates_list,
          target_means=target_means,
          target_stds=target_stds,
          anchor_infos=anchor_infos,
          use_out_scale=use_out_scale,
          cfg=cfg,
+         template_assigner=template_assigner,
+         template_sampler=template_sampler,
          sampling=sampling,
-         unmap_outputs=unmap_outputs)
+         unmap_outputs=unmap_outputs,
+         record_candidates=return_assign_candidates)
     # no valid anchors
     if any([labels is None for labels in all_labels]):
         return None
@@ -107,23 +138,58 @@ def template_target(anchor_list,
     # split targets to a list w.r.t. multiple levels
     labels_list = images_to_levels(all_labels, num_level_anchors)
     label_weights_list = images_to_levels(all_label_weights, num_level_anchors)
-    reg_targets_list = images_to_levels(all_reg_targets, num_level_anchors)
-    reg_weights_list = images_to_levels(all_reg_weights, num_level_anchors)
-    reg_bbx_targets_list = images_to_levels(all_reg_bbx_targets, num_level_anchors)
-    reg_bbx_weights_list = images_to_levels(all_reg_bbx_weights, num_level_anchors)
-
-    num_pos_list = []
-    num_neg_list = []
-    for l, w in zip(labels_list, label_weights_list):
-        num_pos = torch.sum(l > 0)
-        num_all = torch.sum(w > 0)
-        num_neg = num_all - num_pos
-        num_pos_list.append(num_pos.float())
-        num_neg_list.append(num_neg.float())
-
-    return (labels_list, label_weights_list, reg_targets_list,
-            reg_weights_list, reg_bbx_targets_list, reg_bbx_weights_list, 
-            num_total_pos, num_total_neg, num_pos_list, num_neg_list)
+    # regression targets only exist for the positives
+    (pos_anchor_inds_list, reg_targets_list, reg_weights_list,
+     reg_bbx_targets_list, reg_bbx_weights_list) = images_to_levels_sparse(
+         all_pos_anchor_inds,
+         [all_reg_targets, all_reg_weights, all_reg_bbx_targets,
+          all_reg_bbx_weights], num_level_anchors)
+
+    targets = (labels_list, label_weights_list, pos_anchor_inds_list,
+               reg_targets_list, reg_weights_list, reg_bbx_targets_list,
+               reg_bbx_weights_list, num_total_pos, num_total_neg)
+    if return_assign_candidates:
+        targets = targets + (all_assign_candidates, )
+    return targets
+
+
+def template_assign_batch(template_assigner, anchor_list, valid_flag_list,
+                          gt_keypoints_list, gt_labels_list, img_metas,
+                          anchor_infos, cfg, record_candidates=False):
+    """Assign the gts of all images at once (`cfg.batch_assign`).
+
+    The gts are padded to the largest number of gts of the batch, see
+    `MaxOksIoUAssigner.assign_batch`. Returns None if the batch is not
+    supported (other assigners, images with invalid anchors or without gt),
+    in which case each image is assigned on its own.
+    """
+    if cfg.assigner.type != 'MaxOksIoUAssigner' or \
+            not template_assigner.gt_max_assign_all or \
+            template_assigner.spatial_pruning or gt_labels_list[0] is None:
+        return None
+    inside_flags_list = [
+        template_inside_flags(anchors, valid_flags, img_meta['img_shape'][:2],
+                              cfg.allowed_border)
+        for anchors, valid_flags, img_meta in zip(anchor_list, valid_flag_list,
+                                                  img_metas)
+    ]
+    num_gts = [gt_keypoints.size(0) for gt_keypoints in gt_keypoints_list]
+    if not all(inside_flags.all() for inside_flags in inside_flags_list) or \
+            min(num_gts) == 0 or anchor_list[0].size(0) < 9:
+        return None
+    num_imgs = len(gt_keypoints_list)
+    gt_keypoints = gt_keypoints_list[0].new_zeros(
+        (num_imgs, max(num_gts)) + gt_keypoints_list[0].shape[1:])
+    gt_valid = gt_keypoints.new_zeros((num_imgs, max(num_gts)),
+                                      dtype=torch.bool)
+    gt_labels = gt_labels_list[0].new_zeros((num_imgs, max(num_gts)))
+    for i in range(num_imgs):
+        gt_keypoints[i, :num_gts[i]] = gt_keypoints_list[i]
+        gt_valid[i, :num_gts[i]] = True
+        gt_labels[i, :num_gts[i]] = gt_labels_list[i]
+    return template_assigner.assign_batch(
+        torch.stack(anchor_list), anchor_infos, gt_keypoints, gt_valid,
+        gt_labels, record_candidates=record_candidates)
 
 
 def images_to_levels(target, num_level_anchors):
@@ -146,19 +212,24 @@ def template_target_single(flat_anchors,
                            gt_bboxes_ignore,
                            gt_labels,
                            img_meta,
+                           assign_result,
+                           assign_candidates,
                            target_means,
                            target_stds,
                            anchor_infos,
                            use_out_scale,
                            cfg,
+                           template_assigner=None,
+                           template_sampler=None,
                            sampling=True,
-                           unmap_outputs=True):
+                           unmap_outputs=True,
+                           record_candidates=False):
     inside_flags = template_inside_flags(flat_anchors, valid_flags,
                                          img_meta['img_shape'][:2],
                                          cfg.allowed_border)
     assert len(gt_bboxes) == len(gt_keypoints)
     if not inside_flags.any():
-        return (None, ) * 6
+        return (None, ) * 10
     # assign gt and sample anchors
     anchors = flat_anchors[inside_flags, :]
     anchors_bbx = flat_anchors_bbx[inside_flags, :]
@@ -167,12 +238,22 @@ def template_target_single(flat_anchors,
     if sampling:
         assert 0
     else:
-        template_assigner = build_assigner(cfg.assigner)
-        if cfg.assigner.type == 'PointSetAnchorCenterAssigner':
+        if template_assigner is None:
+            template_assigner = build_assigner(cfg.assigner)
+        if assign_result is not None:
+            # assigned with the other images of the batch
+            pass
+        elif cfg.assigner.type == 'PointSetAnchorCenterAssigner':
             assign_result = template_assigner.assign(anchors_bbx, gt_bboxes,
                                                 gt_bboxes_ignore, gt_labels)
         elif cfg.assigner.type == 'MaxOksIoUAssigner':
-            assign_result  = template_assigner.assign(anchors, anchors_scales, anchor_infos, gt_keypoints, gt_labels)
+            if assign_candidates is not None:
+                # candidates of the parent anchors, with flat anchor indices
+                assign_candidates = flat_to_inside_pairs(assign_candidates,
+                                                         inside_flags)
+            assign_result  = template_assigner.assign(anchors, anchors_scales, anchor_infos, gt_keypoints, gt_labels,
+                                                      candidates=assign_candidates,
+                                                      record_candidates=record_candidates)
         elif cfg.assigner.type == 'MaxIoUAssigner':
             assign_result = template_assigner.assign(anchors_bbx, gt_bboxes,
                                              gt_bboxes_ignore, gt_labels)
@@ -181,15 +262,17 @@ def template_target_single(flat_anchors,
                                              gt_bboxes, gt_bboxes_ignore, gt_labels)
         else:
             raise NotImplementedError
-        template_sampler = TemplatePseudoSampler()
+        if template_sampler is None:
+            template_sampler = TemplatePseudoSampler()
         sampling_result = template_sampler.sample(assign_result, anchors, anchors_bbx, anchors_scales,
                                                   gt_keypoints.view(gt_keypoints.shape[0], -1), gt_bboxes)
 
     num_valid_anchors = anchors.shape[0]
-    template_targets = torch.zeros_like(anchors)
-    template_weights = torch.zeros_like(anchors)
-    template_bbx_targets = torch.zeros_like(anchors_bbx)
-    template_bbx_weights = torch.zeros_like(anchors_bbx)
+    # regression targets are kept for the positives only
+    template_targets = anchors.new_zeros((0, anchors.shape[1]))
+    template_weights = anchors.new_zeros((0, anchors.shape[1]))
+    template_bbx_targets = anchors_bbx.new_zeros((0, anchors_bbx.shape[1]))
+    template_bbx_weights = anchors_bbx.new_zeros((0, anchors_bbx.shape[1]))
     labels = anchors.new_zeros(num_valid_anchors, dtype=torch.long)
     label_weights = anchors.new_zeros(num_valid_anchors, dtype=torch.float)
 
@@ -197,21 +280,19 @@ def template_target_single(flat_anchors,
     neg_inds = sampling_result.neg_inds
     if len(pos_inds) > 0:
         # pose target and weight
-        pos_template_targets = template2delta(sampling_result.pos_templates,
-                                              sampling_result.pos_templates_scales,
-                                              sampling_result.pos_gt_keypoints,
-                                              target_means, target_stds, use_out_scale)
-        template_targets[pos_inds, :] = pos_template_targets
+        template_targets = template2delta(sampling_result.pos_templates,
+                                          sampling_result.pos_templates_scales,
+                                          sampling_result.pos_gt_keypoints,
+                                          target_means, target_stds, use_out_scale)
         t_v = sampling_result.pos_gt_keypoints[:, 2::3].clone()
         t_v[t_v > 0.5] = 1.0
         t_v[t_v < 0.5] = 0.0
         t_v = torch.stack([t_v, t_v], dim=-1).reshape(t_v.shape[0], -1)
-        template_weights[pos_inds, :] = t_v
+        template_weights = t_v.type_as(template_targets)
         # bbx target and weight
-        pos_bbox_targets = bbox2delta(sampling_result.pos_templates_bbx,
-                                      sampling_result.pos_gt_bboxes)
-        template_bbx_targets[pos_inds, :] = pos_bbox_targets
-        template_bbx_weights[pos_inds, :] = 1.0
+        template_bbx_targets = bbox2delta(sampling_result.pos_templates_bbx,
+                                          sampling_result.pos_gt_bboxes)
+        template_bbx_weights = torch.ones_like(template_bbx_targets)
         if gt_labels is None:
             assert 0
         else:
@@ -224,17 +305,32 @@ def template_target_single(flat_anchors,
         label_weights[neg_inds] = 1.0
 
     # map up to original set of anchors
+    pos_anchor_inds = pos_inds
     if unmap_outputs:
         num_total_anchors = flat_anchors.size(0)
         labels = unmap(labels, num_total_anchors, inside_flags)
         label_weights = unmap(label_weights, num_total_anchors, inside_flags)
-        template_targets = unmap(template_targets, num_total_anchors, inside_flags)
-        template_weights = unmap(template_weights, num_total_anchors, inside_flags)
-        template_bbx_targets = unmap(template_bbx_targets, num_total_anchors, inside_flags)
-        template_bbx_weights = unmap(template_bbx_weights, num_total_anchors, inside_flags)
-
-    return (labels, label_weights, template_targets, template_weights, template_bbx_targets,
-            template_bbx_weights, pos_inds, neg_inds)
+        pos_anchor_inds = inside_flags.nonzero().squeeze(1)[pos_inds]
+
+    candidates = None
+    if record_candidates and hasattr(assign_result, 'candidates'):
+        cand_gt_inds, cand_inds = assign_result.candidates
+        candidates = (cand_gt_inds, inside_flags.nonzero().squeeze(1)[cand_inds])
+
+    return (labels, label_weights, pos_anchor_inds, template_targets, template_weights,
+            template_bbx_targets, template_bbx_weights, pos_inds, neg_inds,
+            candidates)
+
+
+def flat_to_inside_pairs(pairs, inside_flags):
+    """Map the anchor indices of (gt, anchor) pairs from all the anchors to
+    the anchors inside the image, dropping the pairs of outside anchors."""
+    gt_inds, inds = pairs
+    if inside_flags.all():
+        return gt_inds, inds
+    inside_inds = inside_flags.long().cumsum(0) - 1
+    keep = inside_flags[inds].bool()
+    return gt_inds[keep], inside_inds[inds[keep]]
 
 
 def template_inside_flags(flat_anchors, valid_flags, img_shape,
@@ -1,6 +1,6 @@
 from .assigners import AssignResult, BaseAssigner, MaxIoUAssigner, PointSetAnchorCenterAssigner
 from .bbox_target import bbox_target
-from .geometry import bbox_overlaps
+from .geometry import bbox_candidate_pairs, bbox_overlaps
 from .samplers import (BaseSampler, CombinedSampler,
                        InstanceBalancedPosSampler, IoUBalancedNegSampler,
                        PseudoSampler, RandomSampler, SamplingResult,
@@ -11,19 +11,21 @@ from .transforms import (bbox2delta, bbox2result, bbox2roi, bbox_flip,
                          bbox_mapping, bbox_mapping_back, delta2bbox,
                          distance2bbox, roi2bbox, points2delta,
                          delta2points, pointdist2distdelta, distdelta2points,
-                         kpts2result, pose2bbox_minmax)
+                         contour_point_layouts, kpts2result, pose2bbox_minmax)
 
 from .assign_sampling import (  # isort:skip, avoid recursive imports
     assign_and_sample, build_assigner, build_sampler)
 
 __all__ = [
-    'bbox_overlaps', 'BaseAssigner', 'MaxIoUAssigner', 'AssignResult',
+    'bbox_overlaps', 'bbox_candidate_pairs', 'BaseAssigner', 'MaxIoUAssigner',
+    'AssignResult',
     'BaseSampler', 'PseudoSampler', 'RandomSampler',
     'InstanceBalancedPosSampler', 'IoUBalancedNegSampler', 'CombinedSampler',
     'SamplingResult', 'build_assigner', 'build_sampler', 'assign_and_sample',
     'bbox2delta', 'delta2bbox', 'bbox_flip', 'bbox_mapping',
     'bbox_mapping_back', 'bbox2roi', 'roi2bbox', 'bbox2result',
     'distance2bbox', 'bbox_target', 'points2delta', 'delta2points',
-    'pointdist2distdelta', 'distdelta2points', 'TemplatePseudoSampler',
+    'pointdist2distdelta', 'distdelta2points', 'contour_point_layouts',
+    'TemplatePseudoSampler',
     'kpts2result', 'pose2bbox_minmax'
 ]
@@ -3,10 +3,14 @@ import numpy as np
 
 # from ..geometry import bbox_overlaps
 from scnn.kmeans.kmeans import cal_area_2, cal_area_2_torch
-from mmdet.ops.nms.oks_nms_py import oks_iou_tensor
+from mmdet.ops.nms.oks_nms_py import oks_iou_tensor, oks_iou_tensor_batch
+from ..geometry import bbox_candidate_pairs
 from .assign_result import AssignResult
 from .base_assigner import BaseAssigner
 
+# largest keypoint sigma of oks_iou_tensor
+OKS_MAX_SIGMA = 1.07 / 10.0
+
 
 def kpt_overlaps(gt_keypoints, templates, mode='iou'):
     """Calculate overlap between two set of bboxes.
@@ -69,6 +73,49 @@ def kpt_overlaps(gt_keypoints, templates, mode='iou'):
     return ious
 
 
+def kpt_overlaps_batch(gt_keypoints, templates, max_elements=2**23):
+    """Same as `kpt_overlaps` for a batch of images.
+
+    Args:
+        gt_keypoints (Tensor): shape (b, m, k, 3), gts of each image padded
+            to the same number.
+        templates (Tensor): shape (b, n, 2k)
+        max_elements (int): Bound of the size of the intermediate tensors,
+            the gts are processed in chunks accordingly.
+
+    Returns:
+        ious(Tensor): shape (b, m, n)
+    """
+    num_imgs, num_gts = gt_keypoints.shape[:2]
+    num_templates = templates.size(1)
+    points = templates.view(num_imgs, num_templates, -1, 2)
+    templates = torch.cat([points, points.new_ones(points.shape[:-1] + (1, ))],
+                          dim=-1)
+    area2 = cal_area_2_torch(templates.view(-1, points.size(2), 3)).view(
+        num_imgs, num_templates)
+    templates = templates.view(num_imgs, num_templates, -1)
+
+    # same as cal_area_2 on the visible keypoints of each gt
+    vis = gt_keypoints[..., 2] > 0
+    x, y = gt_keypoints[..., 0], gt_keypoints[..., 1]
+    inf = x.new_tensor(float('inf'))
+    w = torch.where(vis, x, -inf).max(dim=-1)[0] - torch.where(
+        vis, x, inf).min(dim=-1)[0]
+    h = torch.where(vis, y, -inf).max(dim=-1)[0] - torch.where(
+        vis, y, inf).min(dim=-1)[0]
+    area1 = torch.where(vis.sum(dim=-1) >= 2, w * w + h * h, x.new_zeros(1))
+    gt_keypoints = gt_keypoints.view(num_imgs, num_gts, -1)
+
+    chunk = max(1, max_elements // max(
+        1, num_imgs * num_templates * points.size(2)))
+    ious = []
+    for i in range(0, num_gts, chunk):
+        ious.append(
+            oks_iou_tensor_batch(gt_keypoints[:, i:i + chunk], templates,
+                                 area1[:, i:i + chunk], area2))
+    return torch.cat(ious, dim=1)
+
+
 class MaxOksIoUAssigner(BaseAssigner):
     """Assign a corresponding gt bbox or background to each bbox.
 
@@ -92,6 +139,12 @@ class MaxOksIoUAssigner(BaseAssigner):
             ignoring any bboxes.
         ignore_wrt_candidates (bool): Whether to compute the iof between
             `bboxes` and `gt_bboxes_ignore`, or the contrary.
+        spatial_pruning (bool): Only compute the OKS of the templates which
+            are close enough to a gt to reach the thresholds, see
+            `pruned_overlaps`. The assignment is the same.
+        candidate_thr (float): OKS above which a (gt, template) pair is
+            recorded as a candidate for the refinement stages, see
+            `get_candidates`.
     """
 
     def __init__(self,
@@ -103,6 +156,8 @@ class MaxOksIoUAssigner(BaseAssigner):
                  ignore_wrt_candidates=True,
                  assign_fg_per_anchor=False,
                  assign_fg_per_level=False,
+                 spatial_pruning=False,
+                 candidate_thr=0.1,
                  ):
         self.pos_iou_thr = pos_iou_thr
         self.neg_iou_thr = neg_iou_thr
@@ -112,8 +167,11 @@ class MaxOksIoUAssigner(BaseAssigner):
         self.ignore_wrt_candidates = ignore_wrt_candidates
         self.assign_fg_per_anchor = assign_fg_per_anchor
         self.assign_fg_per_level = assign_fg_per_level
+        self.spatial_pruning = spatial_pruning
+        self.candidate_thr = candidate_thr
 
-    def assign(self, templates, templates_scales, anchor_infos, gt_keypoints, gt_labels=None):
+    def assign(self, templates, templates_scales, anchor_infos, gt_keypoints, gt_labels=None,
+               candidates=None, record_candidates=False):
         """Assign gt to bboxes.
 
         This method assign a gt bbox to every bbox (proposal/anchor), each bbox
@@ -135,6 +193,12 @@ class MaxOksIoUAssigner(BaseAssigner):
             gt_bboxes_ignore (Tensor, optional): Ground truth bboxes that are
                 labelled as `ignored`, e.g., crowd boxes in COCO.
             gt_labels (Tensor, optional): Label of gt_bboxes, shape (k, ).
+            candidates (tuple[Tensor], optional): gt indices and template
+                indices of the only pairs to compute the OKS of, the others
+                are taken as 0 (e.g. the candidates of the parent anchors of
+                refined templates, see `get_candidates`).
+            record_candidates (bool): Whether to keep the candidates of the
+                assignment as `candidates` of the assign result.
 
         Returns:
             :obj:`AssignResult`: The assign result.
@@ -145,7 +209,13 @@ class MaxOksIoUAssigner(BaseAssigner):
         if templates.shape[0] == 0 or gt_keypoints.shape[0] == 0:
             raise ValueError('No gt or bboxes')
         # bboxes = bboxes[:, :4]
-        overlaps = kpt_overlaps(gt_keypoints, templates)
+        if candidates is not None:
+            overlaps = self.candidate_overlaps(gt_keypoints, templates,
+                                               anchor_infos, candidates)
+        elif self.spatial_pruning:
+            overlaps = self.pruned_overlaps(gt_keypoints, templates, anchor_infos)
+        else:
+            overlaps = kpt_overlaps(gt_keypoints, templates)
 
         # if (self.ignore_iof_thr > 0) and (gt_bboxes_ignore is not None) and (
         #         gt_bboxes_ignore.numel() > 0):
@@ -162,9 +232,261 @@ class MaxOksIoUAssigner(BaseAssigner):
         #     overlaps[:, ignore_max_overlaps > self.ignore_iof_thr] = -1
 
         assign_result, num_fg_assigned, num_gts = self.assign_wrt_overlaps(overlaps, anchor_infos, gt_labels)
+        if record_candidates:
+            assign_result.candidates = self.get_candidates(
+                overlaps, assign_result.gt_inds, anchor_infos)
         #return assign_result, num_fg_assigned, num_gts
         return assign_result
 
+    def get_candidates(self, overlaps, assigned_gt_inds, anchor_infos):
+        """(gt, template) pairs with an OKS of at least `candidate_thr`, the
+        pairs the assignment picks for each gt (see `row_certified`) and the
+        pairs of the positives with their assigned gt.
+
+        Refined templates keep close to their parent templates, so the gts
+        they may be assigned to are among the candidates of their parents.
+
+        Returns:
+            tuple[Tensor]: gt indices and template indices of the pairs.
+        """
+        num_gts, num_templates = overlaps.shape
+        candidates = overlaps >= self.candidate_thr
+        if num_gts > 0 and num_templates > 0:
+            top_inds = overlaps.topk(min(9, num_templates), dim=1)[1]
+            candidates.scatter_(1, top_inds, True)
+            if self.assign_fg_per_anchor:
+                point_anchor_num = anchor_infos['point_anchor_num']
+                for start, end, n_a in self.fg_anchor_groups(num_templates, anchor_infos):
+                    group_inds = overlaps[:, start:end][:, n_a::point_anchor_num].argmax(dim=1)
+                    candidates[torch.arange(num_gts, device=overlaps.device),
+                               group_inds * point_anchor_num + n_a + start] = True
+        pos_inds = (assigned_gt_inds > 0).nonzero().view(-1)
+        candidates[assigned_gt_inds[pos_inds] - 1, pos_inds] = True
+        gt_inds, inds = candidates.nonzero().t()
+        return gt_inds, inds
+
+    def candidate_overlaps(self, gt_keypoints, templates, anchor_infos,
+                           candidates):
+        """Same overlaps as `kpt_overlaps` for the `candidates` pairs, the
+        others are left to 0.
+
+        Unlike `pruned_overlaps` this is an approximation: a template out of
+        the candidates may have a larger OKS. The rows of the gts whose
+        values picked by the assignment are not all positive (e.g. too few
+        candidates) are computed with all the templates.
+        """
+        gt_inds, inds = candidates
+        num_templates = templates.size(0)
+        if num_templates < 9:
+            return kpt_overlaps(gt_keypoints, templates)
+        groups = self.fg_anchor_groups(num_templates, anchor_infos) \
+            if self.assign_fg_per_anchor else []
+        overlaps = templates.new_zeros((gt_keypoints.size(0), num_templates))
+        dense = []
+        for i, k in enumerate(gt_keypoints):
+            cand = inds[gt_inds == i]
+            if len(cand) > 0:
+                points = templates[cand].view(len(cand), -1, 2)
+                templates_vis = torch.cat(
+                    [points, points.new_ones(points.shape[:-1] + (1, ))], dim=-1)
+                overlaps[i, cand] = oks_iou_tensor(
+                    k.view(-1), templates_vis.view(len(cand), -1), cal_area_2(k),
+                    cal_area_2_torch(templates_vis))
+            if not self.row_certified(overlaps[i], np.finfo(np.float32).tiny,
+                                      groups, anchor_infos):
+                dense.append(i)
+        if len(dense) > 0:
+            overlaps[dense] = kpt_overlaps(gt_keypoints[dense], templates)
+        return overlaps
+
+    def assign_batch(self, templates, anchor_infos, gt_keypoints, gt_valid,
+                     gt_labels, record_candidates=False):
+        """Assign gts to the templates of a batch of images at once.
+
+        Same as `assign` on each image, with `gt_max_assign_all`, for images
+        whose templates are all valid.
+
+        Args:
+            templates (Tensor): shape (b, n, 2k)
+            anchor_infos (dict): Same as for `assign`.
+            gt_keypoints (Tensor): shape (b, m, k, 3), gts of each image
+                padded to the same number.
+            gt_valid (Tensor): shape (b, m), which gts are not padding.
+            gt_labels (Tensor): shape (b, m)
+            record_candidates (bool): Same as for `assign`.
+
+        Returns:
+            list[:obj:`AssignResult`]: The assign result of each image.
+        """
+        assert self.gt_max_assign_all
+        num_imgs, num_gts = gt_valid.shape
+        overlaps = kpt_overlaps_batch(gt_keypoints, templates)
+        # padded gts never win, OKS are >= 0
+        overlaps[~gt_valid] = -1
+        num_templates = overlaps.size(2)
+
+        # 1. assign -1 by default
+        assigned_gt_inds = overlaps.new_full((num_imgs, num_templates),
+                                             -1,
+                                             dtype=torch.long)
+        max_overlaps, argmax_overlaps = overlaps.max(dim=1)
+
+        # 2. assign negative: below
+        if isinstance(self.neg_iou_thr, float):
+            assigned_gt_inds[(max_overlaps >= 0)
+                             & (max_overlaps < self.neg_iou_thr)] = 0
+        else:
+            assert 0
+
+        # 3. assign positive: above positive IoU threshold
+        pos_inds = max_overlaps >= self.pos_iou_thr
+        assigned_gt_inds[pos_inds] = argmax_overlaps[pos_inds] + 1
+
+        # 4. assign fg: the top-9 anchors (and the best anchor of each group)
+        # of each gt, the last gt wins as in `assign_wrt_overlaps`
+        top_num = 9
+        fg = torch.zeros_like(overlaps, dtype=torch.bool)
+        gt_max_overlaps_N = overlaps.topk(top_num, dim=2)[0]
+        for n_t in range(top_num):
+            gt_max_overlaps = gt_max_overlaps_N[:, :, n_t:n_t + 1]
+            fg |= (overlaps == gt_max_overlaps) & (
+                gt_max_overlaps >= self.min_pos_iou)
+        if self.assign_fg_per_anchor:
+            point_anchor_num = anchor_infos['point_anchor_num']
+            for start, end, n_a in self.fg_anchor_groups(num_templates, anchor_infos):
+                a_overlaps = overlaps[:, :, start:end][:, :, n_a::point_anchor_num]
+                gt_argmax_overlaps_anchor = a_overlaps.argmax(dim=2, keepdim=True) * point_anchor_num + n_a + start
+                fg.scatter_(2, gt_argmax_overlaps_anchor, 1)
+        fg &= gt_valid.unsqueeze(-1)
+        gt_ids = torch.arange(1, num_gts + 1, device=overlaps.device).view(1, -1, 1)
+        fg_gt_inds = (fg.long() * gt_ids).max(dim=1)[0]
+        assigned_gt_inds = torch.where(fg_gt_inds > 0, fg_gt_inds, assigned_gt_inds)
+
+        assigned_labels = assigned_gt_inds.new_zeros((num_imgs, num_templates))
+        pos = assigned_gt_inds > 0
+        assigned_labels[pos] = gt_labels.gather(
+            1, (assigned_gt_inds - 1).clamp(min=0))[pos]
+        assign_results = []
+        for i in range(num_imgs):
+            num_img_gts = int(gt_valid[i].sum())
+            assign_result = AssignResult(num_img_gts, assigned_gt_inds[i],
+                                         max_overlaps[i], labels=assigned_labels[i])
+            if record_candidates:
+                assign_result.candidates = self.get_candidates(
+                    overlaps[i, :num_img_gts], assigned_gt_inds[i], anchor_infos)
+            assign_results.append(assign_result)
+        return assign_results
+
+    def fg_anchor_groups(self, num_templates, anchor_infos):
+        """Groups of anchors in which each gt gets its best anchor when
+        `assign_fg_per_anchor`, as (start, end, anchor index) of the columns
+        ``overlaps[:, start:end][:, anchor_index::point_anchor_num]``."""
+        point_anchor_num = anchor_infos['point_anchor_num']
+        if not self.assign_fg_per_level:
+            return [(0, num_templates, n_a) for n_a in range(point_anchor_num)]
+        groups = []
+        lvl_start = 0
+        for featmap_size in anchor_infos['featmap_sizes']:
+            level_size = featmap_size[0] * featmap_size[1] * point_anchor_num
+            for n_a in range(point_anchor_num):
+                groups.append((lvl_start, lvl_start + level_size, n_a))
+            lvl_start = lvl_start + level_size
+        return groups
+
+    @staticmethod
+    def row_certified(row, thr, groups, anchor_infos):
+        """Whether the values the assignment picks in the overlaps `row` of a
+        gt (its top-9 and the best of each of the `groups`) are at least
+        `thr`."""
+        if bool(row.topk(9)[0][-1] < thr):
+            return False
+        point_anchor_num = anchor_infos['point_anchor_num']
+        for start, end, n_a in groups:
+            if bool(row[start:end][n_a::point_anchor_num].max() < thr):
+                return False
+        return True
+
+    def pruned_overlaps(self, gt_keypoints, templates, anchor_infos,
+                        max_rounds=4):
+        """Same overlaps as `kpt_overlaps` for the assignment, computed for
+        the templates close to each gt only.
+
+        The OKS of a template is at most ``exp(-D^2 / (var * (a_g + a_t)))``,
+        with ``D`` the distance between the bboxes of the template and of the
+        visible keypoints of the gt, ``var`` the largest keypoint variance and
+        ``a_g``, ``a_t`` the areas of `oks_iou_tensor`. A gt is compared with
+        the templates which may reach a threshold ``thr`` only, the overlaps
+        of the others are left to 0. Starting from `neg_iou_thr`, such a row
+        gives the same assignment as long as the values the assignment picks
+        for the gt (its top-9 and, with `assign_fg_per_anchor`, the best of
+        each anchor group) are at least ``thr``. Otherwise ``thr`` is lowered
+        and the gt is compared again, and after `max_rounds` with all the
+        templates.
+        """
+        num_gts, num_templates = gt_keypoints.size(0), templates.size(0)
+        points = templates.view(num_templates, -1, 2)
+        templates_vis = torch.cat(
+            [points, points.new_ones((num_templates, points.size(1), 1))],
+            dim=-1)
+        area2 = cal_area_2_torch(templates_vis)
+        templates_vis = templates_vis.view(num_templates, -1)
+        template_bboxes = torch.cat(
+            [points.min(dim=1)[0], points.max(dim=1)[0]], dim=1)
+        var = (OKS_MAX_SIGMA * 2)**2
+        groups = self.fg_anchor_groups(num_templates, anchor_infos) \
+            if self.assign_fg_per_anchor else []
+
+        if not 0 < self.neg_iou_thr < 1 or num_templates < 9:
+            return kpt_overlaps(gt_keypoints, templates)
+        overlaps = templates.new_zeros((num_gts, num_templates))
+        gt_bboxes = gt_keypoints.new_zeros((num_gts, 4))
+        gt_areas = gt_keypoints.new_zeros((num_gts, ))
+        has_vis = []
+        for i, k in enumerate(gt_keypoints):
+            vis = k[k[:, 2] > 0]
+            has_vis.append(len(vis) > 0)
+            if len(vis) > 0:
+                gt_bboxes[i, :2] = vis[:, :2].min(dim=0)[0]
+                gt_bboxes[i, 2:] = vis[:, :2].max(dim=0)[0]
+                gt_areas[i] = cal_area_2(k)
+        has_vis = torch.tensor(has_vis, dtype=torch.bool,
+                               device=templates.device)
+        todo = has_vis.nonzero().view(-1)
+        dense = (~has_vis).nonzero().view(-1)
+
+        thr = self.neg_iou_thr
+        for _ in range(max_rounds):
+            if len(todo) == 0:
+                break
+            # the OKS can only reach thr within the margins (plus some slack)
+            c = -np.log(thr) * var * 1.01
+            gt_margins = (c * gt_areas[todo]).sqrt() + 1
+            template_margins = (c * area2).sqrt() + 1
+            gt_inds, inds = bbox_candidate_pairs(
+                torch.cat([gt_bboxes[todo, :2] - gt_margins[:, None],
+                           gt_bboxes[todo, 2:] + gt_margins[:, None]], dim=1),
+                torch.cat([template_bboxes[:, :2] - template_margins[:, None],
+                           template_bboxes[:, 2:] + template_margins[:, None]],
+                          dim=1))
+            certified = []
+            for j, i in enumerate(todo.tolist()):
+                cand = inds[gt_inds == j]
+                k = gt_keypoints[i]
+                overlaps[i] = 0
+                if len(cand) > 0:
+                    overlaps[i, cand] = oks_iou_tensor(
+                        k.view(-1), templates_vis[cand], cal_area_2(k),
+                        area2[cand])
+                certified.append(
+                    self.row_certified(overlaps[i], thr, groups, anchor_infos))
+            todo = todo[~torch.tensor(certified, dtype=torch.bool,
+                                      device=todo.device)]
+            thr = thr**2
+        dense = torch.cat([dense, todo])
+        if len(dense) > 0:
+            overlaps[dense] = kpt_overlaps(gt_keypoints[dense], templates)
+        return overlaps
+
     def assign_wrt_overlaps(self, overlaps, anchor_infos, gt_labels=None):
         """Assign w.r.t. the overlaps of bboxes with gts.
 
@@ -206,31 +528,17 @@ class MaxOksIoUAssigner(BaseAssigner):
                 overlaps_[i, gt_argmax_overlaps_[i]] = 0
 
         if self.assign_fg_per_anchor:
-            featmap_sizes = anchor_infos['featmap_sizes']
             point_anchor_num = anchor_infos['point_anchor_num']
             gt_max_overlaps_anchor_list = []
             gt_argmax_overlaps_anchor_list = []
-            if self.assign_fg_per_level:
-                lvl_start = 0
-                num_level = len(featmap_sizes)
-                for n_l in range(num_level):
-                    level_size = featmap_sizes[n_l][0] * featmap_sizes[n_l][1] * point_anchor_num
-                    lvl_overlaps = overlaps[:, lvl_start:lvl_start + level_size]
-                    for n_a in range(point_anchor_num):
-                        a_overlaps = lvl_overlaps[:, n_a::point_anchor_num]
-                        gt_max_overlaps_anchor, gt_argmax_overlaps_anchor_ = a_overlaps.max(dim=1)
-                        gt_argmax_overlaps_anchor = gt_argmax_overlaps_anchor_ * point_anchor_num + n_a + lvl_start
-                        gt_max_overlaps_anchor_list.append(gt_max_overlaps_anchor)
-                        gt_argmax_overlaps_anchor_list.append(gt_argmax_overlaps_anchor)
-                    lvl_start = lvl_start + level_size
-            else:
-                # for each GT, find the highest IoU anchor for each class of the anchors.
-                for n_a in range(point_anchor_num):
-                    a_overlaps = overlaps[:, n_a::point_anchor_num]
-                    gt_max_overlaps_anchor, gt_argmax_overlaps_anchor_ = a_overlaps.max(dim=1)
-                    gt_argmax_overlaps_anchor = gt_argmax_overlaps_anchor_ * point_anchor_num + n_a
-                    gt_max_overlaps_anchor_list.append(gt_max_overlaps_anchor)
-                    gt_argmax_overlaps_anchor_list.append(gt_argmax_overlaps_anchor)
+            # for each GT, find the highest IoU anchor for each class of the
+            # anchors (of each level if assign_fg_per_level)
+            for start, end, n_a in self.fg_anchor_groups(num_templates, anchor_infos):
+                a_overlaps = overlaps[:, start:end][:, n_a::point_anchor_num]
+                gt_max_overlaps_anchor, gt_argmax_overlaps_anchor_ = a_overlaps.max(dim=1)
+                gt_argmax_overlaps_anchor = gt_argmax_overlaps_anchor_ * point_anchor_num + n_a + start
+                gt_max_overlaps_anchor_list.append(gt_max_overlaps_anchor)
+                gt_argmax_overlaps_anchor_list.append(gt_argmax_overlaps_anchor)
 
         # 2. assign negative: below
         if isinstance(self.neg_iou_thr, float):
@@ -1,6 +1,7 @@
 import torch
 
-from ..geometry import bbox_overlaps
+from ..geometry import (batch_bbox_overlaps, bbox_candidate_pairs,
+                        bbox_overlaps)
 from .assign_result import AssignResult
 from .base_assigner import BaseAssigner
 
@@ -14,7 +15,8 @@ class PointSetAnchorCenterAssigner(BaseAssigner):
                  pos_area_threshold=0.4,
                  gt_max_assign_all=True,
                  ignore_iof_thr=-1,
-                 ignore_wrt_candidates=True):
+                 ignore_wrt_candidates=True,
+                 spatial_pruning=False):
         self.pos_iou_thr = pos_iou_thr
         self.neg_iou_thr = neg_iou_thr
         self.min_pos_iou = min_pos_iou
@@ -22,6 +24,8 @@ class PointSetAnchorCenterAssigner(BaseAssigner):
         self.gt_max_assign_all = gt_max_assign_all
         self.ignore_iof_thr = ignore_iof_thr
         self.ignore_wrt_candidates = ignore_wrt_candidates
+        # only compute the ious of the bboxes touching a gt, the others are 0
+        self.spatial_pruning = spatial_pruning
 
     def assign(self, bboxes, gt_bboxes, gt_bboxes_ignore=None, gt_labels=None):
         """Assign gt to bboxes.
@@ -52,7 +56,10 @@ class PointSetAnchorCenterAssigner(BaseAssigner):
         if bboxes.shape[0] == 0 or gt_bboxes.shape[0] == 0:
             raise ValueError('No gt or bboxes')
         bboxes = bboxes[:, :4]
-        overlaps = bbox_overlaps(gt_bboxes, bboxes)
+        if self.spatial_pruning:
+            overlaps = self.pruned_overlaps(gt_bboxes, bboxes)
+        else:
+            overlaps = bbox_overlaps(gt_bboxes, bboxes)
 
         if (self.ignore_iof_thr > 0) and (gt_bboxes_ignore is not None) and (
                 gt_bboxes_ignore.numel() > 0):
@@ -70,6 +77,111 @@ class PointSetAnchorCenterAssigner(BaseAssigner):
             overlaps, bboxes, gt_bboxes, gt_labels)
         return assign_result
 
+    def assign_batch(self, bboxes, bbox_valid, gt_bboxes, gt_valid, gt_labels):
+        """Assign gts to the bboxes of a batch of images at once.
+
+        Same as `assign` on the valid bboxes of each image, without ignored
+        gts.
+
+        Args:
+            bboxes (Tensor): shape (b, n, 4)
+            bbox_valid (Tensor): shape (b, n), the bboxes to assign, the
+                others are left out of the results.
+            gt_bboxes (Tensor): shape (b, m, 4), gts of each image padded to
+                the same number.
+            gt_valid (Tensor): shape (b, m), which gts are not padding.
+            gt_labels (Tensor): shape (b, m)
+
+        Returns:
+            list[:obj:`AssignResult`]: The assign result of each image.
+        """
+        bboxes = bboxes[..., :4]
+        num_imgs, num_gts = gt_valid.shape
+        num_bboxes = bboxes.size(1)
+        overlaps = batch_bbox_overlaps(gt_bboxes, bboxes)
+        # padded gts and left out bboxes never win, ious are >= 0
+        overlaps[~gt_valid] = -1
+        overlaps.masked_fill_(~bbox_valid.unsqueeze(1), -1)
+
+        bboxes_ctr = (bboxes[..., :2] + bboxes[..., 2:] + 1) / 2
+        gt_bboxes_ctr = (gt_bboxes[..., :2] + gt_bboxes[..., 2:] + 1) / 2
+        gt_bboxes_wh = gt_bboxes[..., 2:] - gt_bboxes[..., :2] + 1
+
+        # 1. assign -1 by default
+        assigned_gt_inds = overlaps.new_full((num_imgs, num_bboxes),
+                                             -1,
+                                             dtype=torch.long)
+        max_overlaps, argmax_overlaps = overlaps.max(dim=1)
+        gt_max_overlaps, gt_argmax_overlaps = overlaps.max(dim=2)
+
+        # 2. assign negative: below
+        if isinstance(self.neg_iou_thr, float):
+            assigned_gt_inds[(max_overlaps >= 0)
+                             & (max_overlaps < self.neg_iou_thr)] = 0
+        elif isinstance(self.neg_iou_thr, tuple):
+            assert len(self.neg_iou_thr) == 2
+            assigned_gt_inds[(max_overlaps >= self.neg_iou_thr[0])
+                             & (max_overlaps < self.neg_iou_thr[1])] = 0
+
+        # 3. assign positive: above positive IoU threshold
+        pos_inds = max_overlaps >= self.pos_iou_thr
+        assigned_gt_inds[pos_inds] = argmax_overlaps[pos_inds] + 1
+
+        # 4. assign fg: for each gt, proposals with highest IoU, the last gt
+        # wins as in `assign_wrt_overlaps`
+        if self.gt_max_assign_all:
+            fg = overlaps == gt_max_overlaps.unsqueeze(-1)
+        else:
+            fg = torch.zeros_like(overlaps, dtype=torch.bool)
+            fg.scatter_(2, gt_argmax_overlaps.unsqueeze(-1), 1)
+        fg &= ((gt_max_overlaps >= self.min_pos_iou) & gt_valid).unsqueeze(-1)
+        gt_ids = torch.arange(
+            1, num_gts + 1, device=overlaps.device).view(1, -1, 1)
+        fg_gt_inds = (fg.long() * gt_ids).max(dim=1)[0]
+        assigned_gt_inds = torch.where(fg_gt_inds > 0, fg_gt_inds,
+                                       assigned_gt_inds)
+
+        # add center distance factor
+        pos = assigned_gt_inds > 0
+        gather_inds = (assigned_gt_inds - 1).clamp(min=0).unsqueeze(-1).expand(
+            -1, -1, 2)
+        assigned_gt_centers = torch.where(
+            pos.unsqueeze(-1), gt_bboxes_ctr.gather(1, gather_inds),
+            gt_bboxes_ctr.new_zeros(1))
+        assigned_gt_wh = torch.where(
+            pos.unsqueeze(-1), gt_bboxes_wh.gather(1, gather_inds),
+            gt_bboxes_wh.new_ones(1))
+
+        center_dist = torch.abs(bboxes_ctr - assigned_gt_centers)
+        rel_center_dist = center_dist * 2 / assigned_gt_wh
+
+        condition = ((assigned_gt_inds > 0) &
+                     (rel_center_dist[..., 0] <= self.pos_area_threshold) &
+                     (rel_center_dist[..., 1] <= self.pos_area_threshold))
+        assigned_labels = torch.where(
+            condition, gt_labels.gather(1, gather_inds[..., 0]),
+            assigned_gt_inds.new_zeros(1))
+
+        return [
+            AssignResult(
+                int(gt_valid[i].sum()),
+                assigned_gt_inds[i][bbox_valid[i]],
+                max_overlaps[i][bbox_valid[i]],
+                labels=assigned_labels[i][bbox_valid[i]])
+            for i in range(num_imgs)
+        ]
+
+    @staticmethod
+    def pruned_overlaps(gt_bboxes, bboxes):
+        """Same as `bbox_overlaps`, computed for the candidate pairs found by
+        `bbox_candidate_pairs` only."""
+        gt_inds, inds = bbox_candidate_pairs(gt_bboxes, bboxes)
+        overlaps = bboxes.new_zeros((gt_bboxes.size(0), bboxes.size(0)))
+        if gt_inds.numel() > 0:
+            overlaps[gt_inds, inds] = bbox_overlaps(
+                gt_bboxes[gt_inds], bboxes[inds], is_aligned=True)
+        return overlaps
+
     def assign_wrt_overlaps(self, 
                             overlaps,
                             bboxes,
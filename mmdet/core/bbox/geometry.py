@@ -61,3 +61,98 @@ def bbox_overlaps(bboxes1, bboxes2, mode='iou', is_aligned=False):
             ious = overlap / (area1[:, None])
 
     return ious
+
+
+def batch_bbox_overlaps(bboxes1, bboxes2):
+    """Same as `bbox_overlaps` (mode "iou") for a batch of bbox sets.
+
+    Args:
+        bboxes1 (Tensor): shape (b, m, 4)
+        bboxes2 (Tensor): shape (b, n, 4)
+
+    Returns:
+        ious(Tensor): shape (b, m, n)
+    """
+    lt = torch.max(bboxes1[:, :, None, :2], bboxes2[:, None, :, :2])
+    rb = torch.min(bboxes1[:, :, None, 2:], bboxes2[:, None, :, 2:])
+
+    wh = (rb - lt + 1).clamp(min=0)  # [b, m, n, 2]
+    overlap = wh[..., 0] * wh[..., 1]
+    area1 = (bboxes1[..., 2] - bboxes1[..., 0] + 1) * (
+        bboxes1[..., 3] - bboxes1[..., 1] + 1)
+    area2 = (bboxes2[..., 2] - bboxes2[..., 0] + 1) * (
+        bboxes2[..., 3] - bboxes2[..., 1] + 1)
+    return overlap / (area1[:, :, None] + area2[:, None, :] - overlap)
+
+
+def bbox_candidate_pairs(bboxes1, bboxes2):
+    """Find the pairs of bboxes which may overlap.
+
+    `bboxes2` are put into uniform grids over their centers, one grid per
+    power-of-two size of the bboxes, and each bbox of `bboxes1` only visits
+    the grid cells around it, so that the cost scales with the number of
+    nearby bboxes instead of ``m * n``.
+
+    Args:
+        bboxes1 (Tensor): shape (m, 4)
+        bboxes2 (Tensor): shape (n, 4)
+
+    Returns:
+        tuple: `inds1` and `inds2` (LongTensor), shape (k, ). They index the
+            pairs of bboxes which touch (with the +1 convention of
+            :func:`bbox_overlaps`), the overlap of all the other pairs is 0.
+    """
+    inds1 = []
+    inds2 = []
+    if bboxes1.size(0) == 0 or bboxes2.size(0) == 0:
+        empty = bboxes1.new_zeros((0, ), dtype=torch.long)
+        return empty, empty
+    sizes = torch.max(bboxes2[:, 2:] - bboxes2[:, :2], dim=1)[0] + 1
+    size_ids = torch.log2(sizes.clamp(min=1)).floor().long()
+    for size_id in size_ids.unique().tolist():
+        grid_inds = (size_ids == size_id).nonzero().squeeze(1)
+        grid_bboxes = bboxes2[grid_inds]
+        # bboxes of the grid are at most as large as a cell
+        cell = float(2**(size_id + 1))
+        ctrs = (grid_bboxes[:, :2] + grid_bboxes[:, 2:]) / 2
+        origin = ctrs.min(dim=0)[0]
+        cells = ((ctrs - origin) / cell).floor().long()
+        num_x, num_y = (cells.max(dim=0)[0] + 1).tolist()
+        cell_ids = cells[:, 1] * num_x + cells[:, 0]
+        order = cell_ids.argsort()
+        counts = torch.bincount(cell_ids, minlength=num_x * num_y)
+        starts = counts.cumsum(0) - counts
+        # cells of the centers of the bboxes touching a bbox of bboxes1, with
+        # one more cell around against rounding
+        lows = ((bboxes1[:, :2] - 1 - cell / 2 - origin) / cell).floor()
+        highs = ((bboxes1[:, 2:] + 1 + cell / 2 - origin) / cell).floor()
+        lows = (lows.long() - 1).clamp(min=0)
+        highs = torch.min(highs.long() + 1,
+                          cells.new_tensor([num_x - 1, num_y - 1]))
+        for i in range(bboxes1.size(0)):
+            (x0, y0), (x1, y1) = lows[i].tolist(), highs[i].tolist()
+            if x0 > x1 or y0 > y1:
+                continue
+            # each row of cells is a contiguous range of the sorted bboxes
+            rows = torch.arange(y0, y1 + 1, device=bboxes2.device) * num_x
+            row_starts = starts[rows + x0]
+            row_lens = starts[rows + x1] + counts[rows + x1] - row_starts
+            num = int(row_lens.sum())
+            if num == 0:
+                continue
+            offsets = (row_lens.cumsum(0) - row_lens).repeat_interleave(
+                row_lens)
+            cand = order[torch.arange(num, device=bboxes2.device) - offsets +
+                         row_starts.repeat_interleave(row_lens)]
+            cand_bboxes = grid_bboxes[cand]
+            touch = ((cand_bboxes[:, 0] <= bboxes1[i, 2] + 1) &
+                     (cand_bboxes[:, 2] >= bboxes1[i, 0] - 1) &
+                     (cand_bboxes[:, 1] <= bboxes1[i, 3] + 1) &
+                     (cand_bboxes[:, 3] >= bboxes1[i, 1] - 1))
+            cand = grid_inds[cand[touch]]
+            inds1.append(cand.new_full(cand.shape, i))
+            inds2.append(cand)
+    if len(inds1) == 0:
+        empty = bboxes1.new_zeros((0, ), dtype=torch.long)
+        return empty, empty
+    return torch.cat(inds1), torch.cat(inds2)
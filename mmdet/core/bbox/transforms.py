@@ -285,6 +285,50 @@ def delta2points(point_proposals, bbx_proposals, mask_pred,
     return decoding_res
 
 
+def contour_point_layouts(bbx_proposals, point_counter, point_num):
+    """Side and normalizer of every template point of contour anchors.
+
+    Template points are laid out as top, right, bottom, left, with
+    `point_counter[:, i]` points on side i. Anchors are grouped into layouts
+    by their width, and each layout takes the height and the point counter
+    of its first anchor, so the per-point tensors are only built once per
+    layout and then gathered for all anchors.
+
+    Args:
+        bbx_proposals (Tensor): Anchors, shape (n, 4).
+        point_counter (Tensor): Points per side, shape (n, 4).
+        point_num (int): Template points per anchor.
+
+    Returns:
+        tuple[Tensor]: Side ids and normalizers, both of shape
+            (n, point_num). Top and bottom points (side 0 and 2) are
+            normalized by the anchor height and move along y, right and left
+            points (side 1 and 3) by the anchor width and move along x.
+            Points beyond the total count of an anchor get side 4.
+    """
+    bw = bbx_proposals[:, 2] - bbx_proposals[:, 0] + 1.0
+    bh = bbx_proposals[:, 3] - bbx_proposals[:, 1] + 1.0
+    num_anchors = bw.shape[0]
+    _, layout_ids = bw.unique(return_inverse=True)
+    # index of the first anchor of each layout, in layout order
+    order = (layout_ids * num_anchors + torch.arange(
+        num_anchors, device=bw.device)).argsort()
+    sorted_ids = layout_ids[order]
+    is_first = torch.ones_like(sorted_ids, dtype=torch.bool)
+    is_first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+    first_inds = order[is_first]
+
+    point_counter_index = point_counter[first_inds].cumsum(dim=1)
+    point_ids = torch.arange(
+        point_num, dtype=point_counter_index.dtype,
+        device=point_counter_index.device)
+    sides = (point_ids[None, :, None] >=
+             point_counter_index[:, None, :]).sum(dim=-1)
+    normalizers = torch.where(sides % 2 == 0, bh[first_inds, None],
+                              bw[first_inds, None])
+    return sides[layout_ids], normalizers[layout_ids]
+
+
 def pointdist2distdelta(point_dists, bbx_proposals, point_counter,
                         mean=0, std=1):
     '''
@@ -305,34 +349,10 @@ def pointdist2distdelta(point_dists, bbx_proposals, point_counter,
     point_num = point_dists.shape[1]
     point_dists = point_dists.float()
     bbx_proposals = bbx_proposals.float()
-    encoding_res = torch.zeros_like(point_dists)
-    bw = bbx_proposals[:, 2] - bbx_proposals[:, 0] + 1.0
-    bh = bbx_proposals[:, 3] - bbx_proposals[:, 1] + 1.0
-    point_counter_index = torch.zeros_like(point_counter)
-    tmp = point_counter.new_zeros(len(point_counter))
-    for i in range(4):
-        tmp += point_counter[:, i]
-        point_counter_index[:, i] = tmp
-    for w in bw.unique():
-        idx = (bw == w).nonzero().squeeze(-1)
-        cur_point_dists = point_dists[idx, :]
-        cur_bw = bw[idx][0]
-        cur_bh = bh[idx][0]
-        cur_point_counter_index = point_counter_index[idx, :][0]
-        cur_encoding_res = torch.zeros_like(cur_point_dists)
-        # normalize dist of top points
-        cur_encoding_res[:, 0:cur_point_counter_index[0]] =\
-            cur_point_dists[:, 0:cur_point_counter_index[0]]/cur_bh
-        # normalize dist of right points
-        cur_encoding_res[:, cur_point_counter_index[0]:cur_point_counter_index[1]] =\
-            cur_point_dists[:, cur_point_counter_index[0]:cur_point_counter_index[1]]/cur_bw
-        # normalize dist of bottom points
-        cur_encoding_res[:, cur_point_counter_index[1]:cur_point_counter_index[2]] = \
-            cur_point_dists[:, cur_point_counter_index[1]:cur_point_counter_index[2]]/cur_bh
-        # normalize dist of left points
-        cur_encoding_res[:, cur_point_counter_index[2]:cur_point_counter_index[3]] = \
-            cur_point_dists[:, cur_point_counter_index[2]:cur_point_counter_index[3]]/cur_bw
-        encoding_res[idx, :] = cur_encoding_res
+    sides, normalizers = contour_point_layouts(bbx_proposals, point_counter,
+                                               point_num)
+    encoding_res = torch.where(sides < 4, point_dists / normalizers,
+                               point_dists.new_zeros(()))
 
     means = encoding_res.new_full(encoding_res.size(), mean)
     stds = encoding_res.new_full(encoding_res.size(), std)
@@ -342,12 +362,15 @@ def pointdist2distdelta(point_dists, bbx_proposals, point_counter,
 
 
 def distdelta2points(pred_point_dists, bbx_proposals, points, point_counter,
-                     mean=0, std=1):
+                     mean=0, std=1, layouts=None):
     '''
     :param point_dists: template points dist to GT mask
     :param bbx_proposals: anchors
     :param mean:
     :param std:
+    :param layouts: sides and normalizers of the anchors, as returned by
+        contour_point_layouts, e.g. computed once for all the anchors of a
+        level and indexed; computed here if None
     :return:decoding results
             decoding_res = (delta * std + mean) * AnchorSide + points
             encoding:
@@ -355,63 +378,25 @@ def distdelta2points(pred_point_dists, bbx_proposals, points, point_counter,
     '''
     assert len(pred_point_dists) == len(bbx_proposals) == len(points) == len(point_counter)
     point_num = pred_point_dists.shape[1]
-    bbx_proposals = bbx_proposals.float()
-    decoding_res = torch.zeros_like(points)
-    bw = bbx_proposals[:, 2] - bbx_proposals[:, 0] + 1.0
-    bh = bbx_proposals[:, 3] - bbx_proposals[:, 1] + 1.0
-    point_counter_index = torch.zeros_like(point_counter)
-    tmp = point_counter.new_zeros(len(point_counter))
-    for i in range(4):
-        tmp += point_counter[:, i]
-        point_counter_index[:, i] = tmp
-    for w in bw.unique():
-        idx = (bw == w).nonzero().squeeze(-1)
-        cur_pred_point_dists = pred_point_dists[idx, :]
-        cur_points = points[idx, :]
-        cur_bw = bw[idx][0]
-        cur_bh = bh[idx][0]
-        cur_point_counter_index = point_counter_index[idx, :][0]
-        cur_decoding_res = decoding_res.new_zeros((len(idx), decoding_res.shape[1]))
-        # top decoding
-        cur_top_dists =\
-            (cur_pred_point_dists[:, 0:cur_point_counter_index[0]] * std + mean) * cur_bh
-        # same x
-        cur_decoding_res[:, 0:cur_point_counter_index[0]*2:2] = \
-            cur_points[:, 0:cur_point_counter_index[0]*2:2]
-        # decode y
-        cur_decoding_res[:, 1:cur_point_counter_index[0]*2:2] = \
-            cur_points[:, 1:cur_point_counter_index[0]*2:2] + cur_top_dists
-        # right decoding
-        cur_right_dists =\
-            (cur_pred_point_dists[:, cur_point_counter_index[0]:cur_point_counter_index[1]] * std + mean) * cur_bw
-        # same y
-        cur_decoding_res[:, cur_point_counter_index[0]*2 + 1:cur_point_counter_index[1]*2:2] = \
-            cur_points[:, cur_point_counter_index[0]*2 + 1:cur_point_counter_index[1]*2:2]
-        # decode x
-        cur_decoding_res[:, cur_point_counter_index[0]*2:cur_point_counter_index[1]*2:2] = \
-            cur_points[:, cur_point_counter_index[0]*2:cur_point_counter_index[1]*2:2] + cur_right_dists
-        # bottom decoding
-        cur_bottom_dists = \
-            (cur_pred_point_dists[:, cur_point_counter_index[1]:cur_point_counter_index[2]] * std + mean) * cur_bh
-        # same x
-        cur_decoding_res[:, cur_point_counter_index[1]*2:cur_point_counter_index[2]*2:2] = \
-            cur_points[:, cur_point_counter_index[1]*2:cur_point_counter_index[2]*2:2]
-        # decode y
-        cur_decoding_res[:, cur_point_counter_index[1]*2 + 1:cur_point_counter_index[2]*2:2] = \
-            cur_points[:, cur_point_counter_index[1]*2 + 1:cur_point_counter_index[2]*2:2] + cur_bottom_dists
-        # left decoding
-        cur_left_dists = \
-            (cur_pred_point_dists[:, cur_point_counter_index[2]:cur_point_counter_index[3]] * std + mean) * cur_bw
-        # same y
-        cur_decoding_res[:, cur_point_counter_index[2]*2 + 1:cur_point_counter_index[3]*2:2] = \
-            cur_points[:, cur_point_counter_index[2]*2 + 1:cur_point_counter_index[3]*2:2]
-        # decode x
-        cur_decoding_res[:, cur_point_counter_index[2]*2:cur_point_counter_index[3]*2:2] = \
-            cur_points[:, cur_point_counter_index[2]*2:cur_point_counter_index[3]*2:2] + cur_left_dists
-
-        decoding_res[idx, :] = cur_decoding_res
-
-    return decoding_res
+    if layouts is None:
+        layouts = contour_point_layouts(bbx_proposals.float(), point_counter,
+                                        point_num)
+    sides, normalizers = layouts
+    valid = sides < 4
+    # top and bottom points move along y by a multiple of h, right and left
+    # points along x by a multiple of w
+    along_y = valid & (sides % 2 == 0)
+    along_x = valid & (sides % 2 == 1)
+    dists = (pred_point_dists * std + mean) * normalizers
+    points = points.view(points.shape[0], points.shape[1] // 2, 2)
+    zeros = points.new_zeros(())
+    decoding_res_x = torch.where(along_x, points[..., 0] + dists,
+                                 torch.where(valid, points[..., 0], zeros))
+    decoding_res_y = torch.where(along_y, points[..., 1] + dists,
+                                 torch.where(valid, points[..., 1], zeros))
+    decoding_res = torch.stack([decoding_res_x, decoding_res_y], dim=-1)
+
+    return decoding_res.view(decoding_res.shape[0], 2 * point_num)
 
 
 def kpts2result(kpts, labels, num_classes):
@@ -1,9 +1,12 @@
 from .class_names import (coco_classes, dataset_aliases, get_classes,
                           imagenet_det_classes, imagenet_vid_classes,
                           voc_classes)
-from .coco_utils import coco_eval, fast_eval_recall, results2json
-from .eval_hooks import (CocoDistEvalmAPHook, CocoDistEvalRecallHook,
-                         DistEvalHook, DistEvalmAPHook, CocoPoseDistEvalmAPHook)
+from .coco_utils import (JsonListWriter, build_coco_eval, coco_eval,
+                         fast_eval_recall, results2dets, results2json)
+from .eval_hooks import (CocoDistEvalHook, CocoDistEvalmAPHook,
+                         CocoDistEvalRecallHook, DistEvalHook,
+                         DistEvalmAPHook, CocoPoseDistEvalmAPHook)
+from .fast_coco_eval import FastCOCOeval
 from .mean_ap import average_precision, eval_map, print_map_summary
 from .recall import (eval_recalls, plot_iou_recall, plot_num_recall,
                      print_recall_summary)
@@ -11,8 +14,9 @@ from .recall import (eval_recalls, plot_iou_recall, plot_num_recall,
 __all__ = [
     'voc_classes', 'imagenet_det_classes', 'imagenet_vid_classes',
     'coco_classes', 'dataset_aliases', 'get_classes', 'coco_eval',
-    'fast_eval_recall', 'results2json', 'DistEvalHook', 'DistEvalmAPHook',
-    'CocoDistEvalRecallHook', 'CocoDistEvalmAPHook', 'average_precision',
+    'fast_eval_recall', 'results2json', 'results2dets', 'JsonListWriter',
+    'build_coco_eval', 'FastCOCOeval', 'DistEvalHook', 'DistEvalmAPHook',
+    'CocoDistEvalRecallHook', 'CocoDistEvalHook', 'CocoDistEvalmAPHook', 'average_precision',
     'eval_map', 'print_map_summary', 'eval_recalls', 'print_recall_summary',
     'plot_num_recall', 'plot_iou_recall', 'CocoPoseDistEvalmAPHook'
 ]
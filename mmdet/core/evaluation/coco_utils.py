@@ -1,4 +1,6 @@
 import itertools
+import json
+from contextlib import ExitStack
 
 import mmcv
 import numpy as np
@@ -6,14 +8,35 @@ from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 from terminaltables import AsciiTable
 
+from mmcv_custom.keypoints import keypoints_xy2xyv
+from .fast_coco_eval import FastCOCOeval
 from .recall import eval_recalls
 
 
+def build_coco_eval(coco_gt, coco_dt, iou_type, evaluator='pycocotools',
+                    nproc=1):
+    """Build a COCO evaluator.
+
+    Args:
+        evaluator (str): 'pycocotools' for `COCOeval`, 'fast' for
+            :class:`FastCOCOeval`, which gives the same results.
+        nproc (int): Number of processes of the fast evaluator.
+    """
+    if evaluator == 'pycocotools':
+        return COCOeval(coco_gt, coco_dt, iou_type)
+    elif evaluator == 'fast':
+        return FastCOCOeval(coco_gt, coco_dt, iou_type, nproc=nproc)
+    else:
+        raise ValueError('Unknown evaluator: {}'.format(evaluator))
+
+
 def coco_eval(result_files,
               result_types,
               coco,
               max_dets=(100, 300, 1000),
-              classwise=False):
+              classwise=False,
+              evaluator='pycocotools',
+              nproc=1):
     for res_type in result_types:
         assert res_type in [
             'proposal', 'proposal_fast', 'bbox', 'segm', 'keypoints'
@@ -36,12 +59,15 @@ def coco_eval(result_files,
             result_file = result_files[res_type]
         else:
             assert TypeError('result_files must be a str or dict')
-        assert result_file.endswith('.json')
+        # in-memory detections (see results2dets) are loaded as they are
+        if mmcv.is_str(result_file):
+            assert result_file.endswith('.json')
 
         coco_dets = coco.loadRes(result_file)
         img_ids = coco.getImgIds()
         iou_type = 'bbox' if res_type == 'proposal' else res_type
-        cocoEval = COCOeval(coco, coco_dets, iou_type)
+        cocoEval = build_coco_eval(coco, coco_dets, iou_type, evaluator,
+                                   nproc)
         cocoEval.params.imgIds = img_ids
         if res_type == 'proposal':
             cocoEval.params.useCats = 0
@@ -128,139 +154,223 @@ def xyxy2xywh(bbox):
     ]
 
 
-def proposal2json(dataset, results):
-    json_results = []
-    for idx in range(len(dataset)):
-        img_id = dataset.img_ids[idx]
-        bboxes = results[idx]
-        for i in range(bboxes.shape[0]):
-            data = dict()
-            data['image_id'] = img_id
-            data['bbox'] = xyxy2xywh(bboxes[i])
-            data['score'] = float(bboxes[i][4])
-            data['category_id'] = 1
-            json_results.append(data)
-    return json_results
+def xyxy2xywh_array(bboxes):
+    """Vectorized xyxy2xywh() over the rows of an (n, >=4) array.
 
+    The arithmetic is done in float64, as xyxy2xywh() does on Python floats,
+    so that both give exactly the same values.
+    """
+    xywh = bboxes[:, :4].astype(np.float64)
+    xywh[:, 2:] -= xywh[:, :2] - 1
+    return xywh
 
-def det2json(dataset, results):
+
+def _det_records(img_id, bboxes, category_id):
+    """JSON records of the (n, 5) bboxes of one image and one category."""
+    xywh = xyxy2xywh_array(bboxes).tolist()
+    scores = bboxes[:, 4].astype(np.float64).tolist()
+    return [
+        dict(image_id=img_id, bbox=bbox, score=score, category_id=category_id)
+        for bbox, score in zip(xywh, scores)
+    ]
+
+
+def _proposal_img2json(dataset, idx, result):
+    return (_det_records(dataset.img_ids[idx], result, 1), )
+
+
+def _det_img2json(dataset, idx, result):
+    img_id = dataset.img_ids[idx]
     json_results = []
-    for idx in range(len(dataset)):
-        img_id = dataset.img_ids[idx]
-        result = results[idx]
-        for label in range(len(result)):
-            bboxes = result[label]
-            for i in range(bboxes.shape[0]):
-                data = dict()
-                data['image_id'] = img_id
-                data['bbox'] = xyxy2xywh(bboxes[i])
-                data['score'] = float(bboxes[i][4])
-                data['category_id'] = dataset.cat_ids[label]
-                json_results.append(data)
-    return json_results
+    for label in range(len(result)):
+        json_results.extend(
+            _det_records(img_id, result[label], dataset.cat_ids[label]))
+    return (json_results, )
 
 
-def segm2json(dataset, results):
+def _segm_img2json(dataset, idx, result):
+    img_id = dataset.img_ids[idx]
+    det, seg = result
     bbox_json_results = []
     segm_json_results = []
-    for idx in range(len(dataset)):
-        img_id = dataset.img_ids[idx]
-        det, seg = results[idx]
-        for label in range(len(det)):
-            # bbox results
-            bboxes = det[label]
-            for i in range(bboxes.shape[0]):
-                data = dict()
-                data['image_id'] = img_id
-                data['bbox'] = xyxy2xywh(bboxes[i])
-                data['score'] = float(bboxes[i][4])
-                data['category_id'] = dataset.cat_ids[label]
-                bbox_json_results.append(data)
-
-            # segm results
-            # some detectors use different score for det and segm
-            if isinstance(seg, tuple):
-                segms = seg[0][label]
-                mask_score = seg[1][label]
-            else:
-                segms = seg[label]
-                mask_score = [bbox[4] for bbox in bboxes]
-            for i in range(bboxes.shape[0]):
-                data = dict()
-                data['image_id'] = img_id
-                data['bbox'] = xyxy2xywh(bboxes[i])
-                data['score'] = float(mask_score[i])
-                data['category_id'] = dataset.cat_ids[label]
-                if isinstance(segms[i]['counts'], bytes):
-                    segms[i]['counts'] = segms[i]['counts'].decode()
-                data['segmentation'] = segms[i]
-                segm_json_results.append(data)
+    for label in range(len(det)):
+        # bbox results
+        bboxes = det[label]
+        records = _det_records(img_id, bboxes, dataset.cat_ids[label])
+        bbox_json_results.extend(records)
+
+        # segm results
+        # some detectors use different score for det and segm
+        if isinstance(seg, tuple):
+            segms = seg[0][label]
+            mask_scores = [float(score) for score in seg[1][label]]
+        else:
+            segms = seg[label]
+            mask_scores = [record['score'] for record in records]
+        for i, record in enumerate(records):
+            data = record.copy()
+            data['score'] = mask_scores[i]
+            if isinstance(segms[i]['counts'], bytes):
+                segms[i]['counts'] = segms[i]['counts'].decode()
+            data['segmentation'] = segms[i]
+            segm_json_results.append(data)
     return bbox_json_results, segm_json_results
 
 
-def kpts2json(dataset, results):
+def _kpts_img2json(dataset, idx, result):
+    img_id = dataset.img_ids[idx]
+    det, kpts = result
     bbox_json_results = []
     kpt_json_results = []
-    for idx in range(len(dataset)):
-        img_id = dataset.img_ids[idx]
-        det = results[idx][0]
-        kpts = results[idx][1]
-        for label in range(len(det)):
-            # bbox results
-            bboxes = det[label]
-            for i in range(bboxes.shape[0]):
-                data = dict()
-                data['image_id'] = img_id
-                data['bbox'] = xyxy2xywh(bboxes[i])
-                data['score'] = float(bboxes[i][4])
-                data['category_id'] = dataset.cat_ids[label]
-                bbox_json_results.append(data)
-
-            # kpt results
-            keypoints = kpts[label]
-            for i in range(bboxes.shape[0]):
-                data = dict()
-                data['image_id'] = img_id
-                data['bbox'] = xyxy2xywh(bboxes[i])
-                data['score'] = float(bboxes[i][4])
-                data['category_id'] = dataset.cat_ids[label]
-                kpt = keypoints[i][:34]
-                kpt = kpt.reshape(-1, 2)
-                vis = np.ones((kpt.shape[0], 1))
-                kpt = np.concatenate((kpt, vis), axis=1)
-                kpt = kpt.reshape(-1)
-                data['keypoints'] = kpt.tolist()
-                kpt_json_results.append(data)
+    for label in range(len(det)):
+        # bbox results
+        records = _det_records(img_id, det[label], dataset.cat_ids[label])
+        bbox_json_results.extend(records)
+
+        # kpt results, the last column of keypoints is the score
+        keypoints = keypoints_xy2xyv(kpts[label][:, :-1]).tolist()
+        for record, keypoint in zip(records, keypoints):
+            data = record.copy()
+            data['keypoints'] = keypoint
+            kpt_json_results.append(data)
     return bbox_json_results, kpt_json_results
 
 
-def results2json(dataset, results, out_file):
-    result_files = dict()
+def _results2json(img2json, dataset, results):
+    json_results = None
+    for idx in range(len(dataset)):
+        img_json_results = img2json(dataset, idx, results[idx])
+        if json_results is None:
+            json_results = tuple([] for _ in img_json_results)
+        for json_result, img_json_result in zip(json_results,
+                                                img_json_results):
+            json_result.extend(img_json_result)
+    return json_results
+
+
+def proposal2json(dataset, results):
+    return _results2json(_proposal_img2json, dataset, results)[0]
+
+
+def det2json(dataset, results):
+    return _results2json(_det_img2json, dataset, results)[0]
+
+
+def segm2json(dataset, results):
+    return _results2json(_segm_img2json, dataset, results)
+
+
+def kpts2json(dataset, results):
+    return _results2json(_kpts_img2json, dataset, results)
+
+
+class JsonListWriter(object):
+    """Write a JSON list to a file chunk by chunk.
+
+    Only the records of one chunk (typically one image) are held in memory.
+    The file content is identical to `mmcv.dump(json_list, filename)`.
+
+    Example:
+        >>> with JsonListWriter('results.bbox.json') as writer:
+        >>>     for img_json_results in ...:
+        >>>         writer.write(img_json_results)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+        self._empty = True
+
+    def __enter__(self):
+        self._file = open(self.filename, 'w')
+        self._file.write('[')
+        return self
+
+    def write(self, records):
+        if not records:
+            return
+        if not self._empty:
+            self._file.write(', ')
+        self._file.write(json.dumps(records)[1:-1])
+        self._empty = False
+
+    def __exit__(self, *args):
+        self._file.write(']')
+        self._file.close()
+
+
+def _result_type(results):
+    """Get the converter and the COCO result types of a list of results."""
     if isinstance(results[0], list):
-        json_results = det2json(dataset, results)
-        result_files['bbox'] = '{}.{}.json'.format(out_file, 'bbox')
-        result_files['proposal'] = '{}.{}.json'.format(out_file, 'bbox')
-        mmcv.dump(json_results, result_files['bbox'])
+        return _det_img2json, ('bbox', )
     elif isinstance(results[0], tuple):
         if not isinstance(results[0][1][0], list) and results[0][1][0].shape[1] == 35:
             # TODO(xiao): dirty! better condition for keypoints.
-            json_results = kpts2json(dataset, results)
-            result_files['bbox'] = '{}.{}.json'.format(out_file, 'bbox')
-            result_files['proposal'] = '{}.{}.json'.format(out_file, 'bbox')
-            result_files['keypoints'] = '{}.{}.json'.format(out_file, 'keypoints')
-            mmcv.dump(json_results[0], result_files['bbox'])
-            mmcv.dump(json_results[1], result_files['keypoints'])
+            return _kpts_img2json, ('bbox', 'keypoints')
         else:
-            json_results = segm2json(dataset, results)
-            result_files['bbox'] = '{}.{}.json'.format(out_file, 'bbox')
-            result_files['proposal'] = '{}.{}.json'.format(out_file, 'bbox')
-            result_files['segm'] = '{}.{}.json'.format(out_file, 'segm')
-            mmcv.dump(json_results[0], result_files['bbox'])
-            mmcv.dump(json_results[1], result_files['segm'])
+            return _segm_img2json, ('bbox', 'segm')
     elif isinstance(results[0], np.ndarray):
-        json_results = proposal2json(dataset, results)
-        result_files['proposal'] = '{}.{}.json'.format(out_file, 'proposal')
-        mmcv.dump(json_results, result_files['proposal'])
+        return _proposal_img2json, ('proposal', )
     else:
         raise TypeError('invalid type of results')
+
+
+def results2json(dataset, results, out_file):
+    """Dump results to "{out_file}.{type}.json", streaming image by image.
+    """
+    img2json, res_types = _result_type(results)
+    result_files = dict()
+    for res_type in res_types:
+        result_files[res_type] = '{}.{}.json'.format(out_file, res_type)
+    if 'bbox' in result_files:
+        result_files['proposal'] = result_files['bbox']
+
+    with ExitStack() as stack:
+        writers = [
+            stack.enter_context(JsonListWriter(result_files[res_type]))
+            for res_type in res_types
+        ]
+        for idx in range(len(dataset)):
+            img_json_results = img2json(dataset, idx, results[idx])
+            for writer, img_json_result in zip(writers, img_json_results):
+                writer.write(img_json_result)
     return result_files
+
+
+def results2dets(dataset, results):
+    """In-memory counterpart of results2json().
+
+    The returned detections can be fed to `COCO.loadRes()` or `coco_eval()`
+    directly, without a round trip through json files. bbox detections are
+    given as an (n, 7) array of [image_id, x, y, w, h, score, category_id]
+    rows, which `COCO.loadRes()` accepts as well.
+
+    Returns:
+        dict: Detections of each result type ("bbox", "proposal", "segm",
+            "keypoints").
+    """
+    img2json, res_types = _result_type(results)
+    if img2json in (_det_img2json, _proposal_img2json):
+        # box only results, build the columns directly
+        dets = []
+        for idx in range(len(dataset)):
+            result = results[idx]
+            if img2json is _proposal_img2json:
+                result, cat_ids = [result], [1]
+            else:
+                cat_ids = dataset.cat_ids
+            for label in range(len(result)):
+                bboxes = result[label]
+                img_dets = np.empty((bboxes.shape[0], 7), dtype=np.float64)
+                img_dets[:, 0] = dataset.img_ids[idx]
+                img_dets[:, 1:5] = xyxy2xywh_array(bboxes)
+                img_dets[:, 5] = bboxes[:, 4]
+                img_dets[:, 6] = cat_ids[label]
+                dets.append(img_dets)
+        dets = np.concatenate(dets) if dets else np.zeros((0, 7))
+        return {res_type: dets for res_type in ('bbox', 'proposal')}
+
+    json_results = _results2json(img2json, dataset, results)
+    result_dets = dict(zip(res_types, json_results))
+    result_dets['proposal'] = result_dets['bbox']
+    return result_dets
@@ -1,23 +1,46 @@
-import os
-import os.path as osp
-
 import mmcv
 import numpy as np
 import torch
 import torch.distributed as dist
-from mmcv.parallel import collate, scatter
+from mmcv.parallel import scatter
 from mmcv.runner import Hook
-from pycocotools.cocoeval import COCOeval
 from torch.utils.data import Dataset
 
 from mmdet import datasets
-from .coco_utils import fast_eval_recall, results2json
+from ..utils import gather_object
+from .coco_utils import build_coco_eval, fast_eval_recall, results2dets
 from .mean_ap import eval_map
 
 
 class DistEvalHook(Hook):
+    """Run the test pipeline over `dataset` on every rank and evaluate.
+
+    The dataset is read through a :class:`DataLoader` with a non-shuffling
+    :class:`DistributedSampler`, so loading and test-time augmentation run
+    in `workers_per_gpu` worker processes. Only the loading is batched: the
+    model still runs one image at a time (the detectors only support a
+    single image per test forward, and the GroupNorm statistics would
+    change with the padding of a batch). The images are padded to a common
+    size in the collated batch (see `test_collate`) and each is cropped back
+    to its own `pad_shape`, hence the results do not depend on
+    `load_imgs_per_gpu`.
+
+    Args:
+        dataset (:obj:`Dataset` | dict): The dataset or its config.
+        interval (int): Evaluation interval (by epochs).
+        load_imgs_per_gpu (int): Images per collated batch of the loader on
+            each rank, they are still fed to the model one by one.
+        workers_per_gpu (int): Loader worker processes on each rank.
+        prefetch (bool): Move the next batch to the GPU while the current one
+            runs, see :class:`DataPrefetcher`.
+    """
 
-    def __init__(self, dataset, interval=1):
+    def __init__(self,
+                 dataset,
+                 interval=1,
+                 load_imgs_per_gpu=1,
+                 workers_per_gpu=2,
+                 prefetch=False):
         if isinstance(dataset, Dataset):
             self.dataset = dataset
         elif isinstance(dataset, dict):
@@ -27,46 +50,88 @@ class DistEvalHook(Hook):
                 'dataset must be a Dataset object or a dict, not {}'.format(
                     type(dataset)))
         self.interval = interval
+        self.load_imgs_per_gpu = load_imgs_per_gpu
+        self.workers_per_gpu = workers_per_gpu
+        self.prefetch = prefetch
+        self._data_loader = None
+
+    @property
+    def data_loader(self):
+        # built lazily, the process group is only guaranteed to be up once
+        # training has started
+        if self._data_loader is None:
+            data_loader = datasets.build_dataloader(
+                self.dataset,
+                self.load_imgs_per_gpu,
+                self.workers_per_gpu,
+                dist=True,
+                shuffle=False,
+                pin_memory=self.prefetch,
+                test_mode=True)
+            if self.prefetch:
+                data_loader = datasets.DataPrefetcher(
+                    data_loader, [torch.cuda.current_device()])
+            self._data_loader = data_loader
+        return self._data_loader
+
+    @staticmethod
+    def _split_batch(data):
+        """Split a scattered test batch into the single-image inputs of the
+        model."""
+        imgs, img_metas = data['img'], data['img_meta']
+        num_imgs = len(img_metas[0])
+        if num_imgs == 1:
+            yield data
+            return
+        for i in range(num_imgs):
+            img_i, img_meta_i = [], []
+            for img, img_meta in zip(imgs, img_metas):
+                h, w = img_meta[i]['pad_shape'][:2]
+                img_i.append(img[i:i + 1, :, :h, :w])
+                img_meta_i.append([img_meta[i]])
+            yield dict(data, img=img_i, img_meta=img_meta_i)
 
     def after_train_epoch(self, runner):
         if not self.every_n_epochs(runner, self.interval):
             return
         runner.model.eval()
-        results = [None for _ in range(len(self.dataset))]
+        data_loader = self.data_loader
+        result_part = []
         if runner.rank == 0:
             prog_bar = mmcv.ProgressBar(len(self.dataset))
-        for idx in range(runner.rank, len(self.dataset), runner.world_size):
-            data = self.dataset[idx]
-            data_gpu = scatter(
-                collate([data], samples_per_gpu=1),
-                [torch.cuda.current_device()])[0]
+            num_done = 0
+        for data in data_loader:
+            data_gpu = scatter(data, [torch.cuda.current_device()])[0]
 
             # compute output
-            with torch.no_grad():
-                result = runner.model(
-                    return_loss=False, rescale=True, **data_gpu)
-            results[idx] = result
+            batch_size = 0
+            for data_single in self._split_batch(data_gpu):
+                with torch.no_grad():
+                    result = runner.model(
+                        return_loss=False, rescale=True, **data_single)
+                result_part.append(result)
+                batch_size += 1
 
-            batch_size = runner.world_size
             if runner.rank == 0:
-                for _ in range(batch_size):
+                # the padded tail of the sampler is not part of the dataset
+                num_new = min(batch_size * runner.world_size,
+                              len(self.dataset) - num_done)
+                for _ in range(num_new):
                     prog_bar.update()
+                num_done += num_new
 
         if runner.rank == 0:
             print('\n')
-            dist.barrier()
-            for i in range(1, runner.world_size):
-                tmp_file = osp.join(runner.work_dir, 'temp_{}.pkl'.format(i))
-                tmp_results = mmcv.load(tmp_file)
-                for idx in range(i, len(results), runner.world_size):
-                    results[idx] = tmp_results[idx]
-                os.remove(tmp_file)
-            self.evaluate(runner, results)
-        else:
-            tmp_file = osp.join(runner.work_dir,
-                                'temp_{}.pkl'.format(runner.rank))
-            mmcv.dump(results, tmp_file)
-            dist.barrier()
+        # collect the results of each rank on rank 0 through the process
+        # group instead of temporary pickle files in work_dir
+        result_parts = gather_object(result_part, dst=0)
+        if runner.rank == 0:
+            # the sampler deals indices out round-robin and pads the tail
+            # with the first ones, undo both
+            results = [None for _ in range(data_loader.sampler.total_size)]
+            for i, result_part in enumerate(result_parts):
+                results[i::runner.world_size] = result_part
+            self.evaluate(runner, results[:len(self.dataset)])
         dist.barrier()
 
     def evaluate(self):
@@ -119,9 +184,10 @@ class CocoDistEvalRecallHook(DistEvalHook):
                  dataset,
                  interval=1,
                  proposal_nums=(100, 300, 1000),
-                 iou_thrs=np.arange(0.5, 0.96, 0.05)):
+                 iou_thrs=np.arange(0.5, 0.96, 0.05),
+                 **kwargs):
         super(CocoDistEvalRecallHook, self).__init__(
-            dataset, interval=interval)
+            dataset, interval=interval, **kwargs)
         self.proposal_nums = np.array(proposal_nums, dtype=np.int32)
         self.iou_thrs = np.array(iou_thrs, dtype=np.float32)
 
@@ -135,11 +201,33 @@ class CocoDistEvalRecallHook(DistEvalHook):
         runner.log_buffer.ready = True
 
 
-class CocoDistEvalmAPHook(DistEvalHook):
+class CocoDistEvalHook(DistEvalHook):
+    """Base of the COCO mAP hooks.
+
+    Args:
+        evaluator (str): 'pycocotools' or 'fast', see
+            :func:`build_coco_eval`.
+        eval_nproc (int): Number of processes of the fast evaluator.
+    """
+
+    def __init__(self,
+                 dataset,
+                 evaluator='pycocotools',
+                 eval_nproc=1,
+                 **kwargs):
+        super(CocoDistEvalHook, self).__init__(dataset, **kwargs)
+        self.evaluator = evaluator
+        self.eval_nproc = eval_nproc
+
+    def coco_eval(self, coco_gt, coco_dt, iou_type):
+        return build_coco_eval(coco_gt, coco_dt, iou_type, self.evaluator,
+                               self.eval_nproc)
+
+
+class CocoDistEvalmAPHook(CocoDistEvalHook):
 
     def evaluate(self, runner, results):
-        tmp_file = osp.join(runner.work_dir, 'temp_0')
-        result_files = results2json(self.dataset, results, tmp_file)
+        result_dets = results2dets(self.dataset, results)
 
         res_types = ['bbox', 'segm'
                      ] if runner.model.module.with_mask else ['bbox']
@@ -147,12 +235,12 @@ class CocoDistEvalmAPHook(DistEvalHook):
         imgIds = cocoGt.getImgIds()
         for res_type in res_types:
             try:
-                cocoDt = cocoGt.loadRes(result_files[res_type])
+                cocoDt = cocoGt.loadRes(result_dets[res_type])
             except IndexError:
                 print('No prediction found.')
                 break
             iou_type = res_type
-            cocoEval = COCOeval(cocoGt, cocoDt, iou_type)
+            cocoEval = self.coco_eval(cocoGt, cocoDt, iou_type)
             cocoEval.params.imgIds = imgIds
             cocoEval.evaluate()
             cocoEval.accumulate()
@@ -166,22 +254,19 @@ class CocoDistEvalmAPHook(DistEvalHook):
                 '{ap[0]:.3f} {ap[1]:.3f} {ap[2]:.3f} {ap[3]:.3f} '
                 '{ap[4]:.3f} {ap[5]:.3f}').format(ap=cocoEval.stats[:6])
         runner.log_buffer.ready = True
-        for res_type in res_types:
-            os.remove(result_files[res_type])
 
 
-class CocoPoseDistEvalmAPHook(DistEvalHook):
+class CocoPoseDistEvalmAPHook(CocoDistEvalHook):
     
     def evaluate(self, runner, results):
-        tmp_file = osp.join(runner.work_dir, 'temp_0')
-        result_files = results2json(self.dataset, results, tmp_file)
+        result_dets = results2dets(self.dataset, results)
 
         if True:
             cocoGt = self.dataset.coco
-            cocoDt = cocoGt.loadRes(result_files['bbox'])
+            cocoDt = cocoGt.loadRes(result_dets['bbox'])
             imgIds = cocoGt.getImgIds()
             iou_type = 'bbox'
-            cocoEval = COCOeval(cocoGt, cocoDt, iou_type)
+            cocoEval = self.coco_eval(cocoGt, cocoDt, iou_type)
             cocoEval.params.imgIds = imgIds
             cocoEval.evaluate()
             cocoEval.accumulate()
@@ -208,10 +293,10 @@ class CocoPoseDistEvalmAPHook(DistEvalHook):
 
         if True:
             cocoGt = self.dataset.coco
-            cocoDt = cocoGt.loadRes(result_files['keypoints'])
+            cocoDt = cocoGt.loadRes(result_dets['keypoints'])
             imgIds = cocoGt.getImgIds()
             iou_type = 'keypoints'
-            cocoEval = COCOeval(cocoGt, cocoDt, iou_type)
+            cocoEval = self.coco_eval(cocoGt, cocoDt, iou_type)
             cocoEval.params.imgIds = imgIds
             cocoEval.evaluate()
             cocoEval.accumulate()
@@ -244,5 +329,3 @@ class CocoPoseDistEvalmAPHook(DistEvalHook):
         #         '{ap[4]:.3f} {ap[5]:.3f}').format(ap=cocoEval.stats[:6])
 
         runner.log_buffer.ready = True
-        os.remove(result_files['bbox'])
-        os.remove(result_files['keypoints'])
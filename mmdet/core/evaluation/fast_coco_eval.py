@@ -0,0 +1,424 @@
+import copy
+import datetime
+import time
+from collections import defaultdict
+from multiprocessing import Pool
+
+import numpy as np
+from pycocotools.cocoeval import COCOeval
+
+
+def bbox_ious(dt_bboxes, gt_bboxes, gt_crowd):
+    """IoUs of bboxes in the (x, y, w, h) format, as `maskUtils.iou`.
+
+    The union of a crowd gt is the area of the detection.
+
+    Args:
+        dt_bboxes (ndarray): Shape (d, 4).
+        gt_bboxes (ndarray): Shape (g, 4).
+        gt_crowd (ndarray): Crowd flags of the gts, shape (g, ).
+
+    Returns:
+        ndarray: Shape (d, g).
+    """
+    d = dt_bboxes[:, None]
+    g = gt_bboxes[None]
+    da = d[..., 2] * d[..., 3]
+    ga = g[..., 2] * g[..., 3]
+    w = np.minimum(d[..., 2] + d[..., 0], g[..., 2] + g[..., 0]) - \
+        np.maximum(d[..., 0], g[..., 0])
+    h = np.minimum(d[..., 3] + d[..., 1], g[..., 3] + g[..., 1]) - \
+        np.maximum(d[..., 1], g[..., 1])
+    inter = w * h
+    union = np.where(gt_crowd[None], da, da + ga - inter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ious = inter / union
+    return np.where((w > 0) & (h > 0), ious, 0.)
+
+
+def keypoint_oks(dt_kpts, gt_kpts, gt_bboxes, gt_areas, sigmas):
+    """OKS of keypoints, as `COCOeval.computeOks`.
+
+    Args:
+        dt_kpts (ndarray): Shape (d, k * 3).
+        gt_kpts (ndarray): Shape (g, k * 3).
+        gt_bboxes (ndarray): Shape (g, 4), the keypoints of gts without
+            visible keypoints are compared to their bbox.
+        gt_areas (ndarray): Shape (g, ).
+        sigmas (ndarray): Shape (k, ).
+
+    Returns:
+        ndarray: Shape (d, g).
+    """
+    variances = (sigmas * 2)**2
+    xd = dt_kpts[:, 0::3]
+    yd = dt_kpts[:, 1::3]
+    ious = np.zeros((len(dt_kpts), len(gt_kpts)))
+    for j, (g, bb, area) in enumerate(zip(gt_kpts, gt_bboxes, gt_areas)):
+        xg = g[0::3]
+        yg = g[1::3]
+        vis = g[2::3] > 0
+        if vis.any():
+            dx = xd - xg
+            dy = yd - yg
+        else:
+            x0 = bb[0] - bb[2]
+            x1 = bb[0] + bb[2] * 2
+            y0 = bb[1] - bb[3]
+            y1 = bb[1] + bb[3] * 2
+            dx = np.maximum(0, x0 - xd) + np.maximum(0, xd - x1)
+            dy = np.maximum(0, y0 - yd) + np.maximum(0, yd - y1)
+        e = (dx**2 + dy**2) / variances / (area + np.spacing(1)) / 2
+        if vis.any():
+            e = e[:, vis]
+        ious[:, j] = np.sum(np.exp(-e), axis=1) / e.shape[1]
+    return ious
+
+
+def match_chunk(args):
+    """Greedy matching of the detections of a chunk of (image, category)
+    pairs at all the area ranges and IoU thresholds, as
+    `COCOeval.evaluateImg`.
+
+    The pairs are padded to the same number of detections and gts, the
+    detections are processed in order of scores for all the pairs at once.
+    """
+    (ious, dt_valid, dt_out, gt_valid, gt_crowd, gt_ig, gt_ids,
+     iou_thrs) = args
+    num_pairs, num_dts, num_gts = ious.shape
+    num_areas = gt_ig.shape[1]
+    if num_gts == 0:
+        shape = (num_pairs, num_areas, len(iou_thrs), num_dts)
+        return np.zeros(shape, dtype=bool), np.broadcast_to(
+            dt_out[:, :, None, :], shape).copy()
+    thrs = np.minimum(iou_thrs, 1 - 1e-10)[None, None, :, None]
+    gt_matched = np.zeros((num_pairs, num_areas, len(iou_thrs), num_gts),
+                          dtype=bool)
+    dt_gt = np.full((num_pairs, num_areas, len(iou_thrs), num_dts), -1)
+    avail_crowd = (gt_crowd & gt_valid)[:, None, None, :]
+    ig = gt_ig[:, :, None, :]
+    for d in range(num_dts):
+        iou = ious[:, d][:, None, None, :]
+        cand = (iou >= thrs) & ((~gt_matched & gt_valid[:, None, None, :])
+                                | avail_crowd)
+        cand &= dt_valid[:, d][:, None, None, None]
+        # gts which are not ignored come first, only the max iou counts
+        # and the last of equal ones is kept
+        not_ig = cand & ~ig
+        cand = np.where(not_ig.any(axis=-1, keepdims=True), not_ig, cand & ig)
+        found = cand.any(axis=-1)
+        masked = np.where(cand, iou, -np.inf)[..., ::-1]
+        m = num_gts - 1 - masked.argmax(axis=-1)
+        np.put_along_axis(
+            gt_matched, m[..., None],
+            np.take_along_axis(gt_matched, m[..., None], -1)
+            | found[..., None], -1)
+        dt_gt[..., d] = np.where(found, m, -1)
+
+    found = dt_gt >= 0
+    m = np.maximum(dt_gt, 0)
+    gt_ig_m = np.take_along_axis(
+        np.broadcast_to(ig, found.shape[:3] + (num_gts, )), m, -1)
+    gt_ids_m = np.take_along_axis(
+        np.broadcast_to(gt_ids[:, None, None, :], found.shape[:3] +
+                        (num_gts, )), m, -1)
+    # a detection matched to a gt of id 0 counts as unmatched, as in
+    # COCOeval
+    matched = found & (gt_ids_m != 0)
+    dt_ig = (found & gt_ig_m) | (~matched & dt_out[:, :, None, :])
+    return matched, dt_ig
+
+
+class FastCOCOeval(COCOeval):
+    """A drop-in replacement of `COCOeval` for bbox and keypoints, with the
+    same results.
+
+    The IoUs / OKS are computed with array ops, and the greedy matching of
+    `evaluateImg` is run for all the images, area ranges and IoU thresholds
+    at once (by chunks of `chunk_size` (image, category) pairs, on `nproc`
+    processes). `accumulate` then works on the flat arrays of all the
+    detections. `evalImgs` is not filled, and segm is evaluated by
+    `COCOeval`.
+
+    Args:
+        cocoGt, cocoDt, iouType: Same as `COCOeval`.
+        nproc (int): Number of processes of the matching.
+        chunk_size (int): Number of pairs matched at once.
+    """
+
+    def __init__(self,
+                 cocoGt=None,
+                 cocoDt=None,
+                 iouType='segm',
+                 nproc=1,
+                 chunk_size=512):
+        super(FastCOCOeval, self).__init__(cocoGt, cocoDt, iouType)
+        self.nproc = nproc
+        self.chunk_size = chunk_size
+        self._matches = None
+
+    def evaluate(self):
+        p = self.params
+        if p.useSegm is not None:
+            p.iouType = 'segm' if p.useSegm == 1 else 'bbox'
+        if p.iouType == 'segm':
+            self._matches = None
+            return super(FastCOCOeval, self).evaluate()
+        tic = time.time()
+        print('Running per image evaluation...')
+        print('Evaluate annotation type *{}*'.format(p.iouType))
+        p.imgIds = list(np.unique(p.imgIds))
+        if p.useCats:
+            p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self.params = p
+
+        pairs = self._prepare_pairs()
+        results = self._match(pairs)
+        self._matches = self._flatten(pairs, results)
+        self.evalImgs = []
+        self._paramsEval = copy.deepcopy(self.params)
+        print('DONE (t={:0.2f}s).'.format(time.time() - tic))
+
+    def _prepare_pairs(self):
+        """Gts and detections of each (image, category) pair which has any,
+        in the order of `COCOeval.evalImgs`."""
+        p = self.params
+        if p.useCats:
+            gts = self.cocoGt.loadAnns(
+                self.cocoGt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
+            dts = self.cocoDt.loadAnns(
+                self.cocoDt.getAnnIds(imgIds=p.imgIds, catIds=p.catIds))
+        else:
+            gts = self.cocoGt.loadAnns(self.cocoGt.getAnnIds(imgIds=p.imgIds))
+            dts = self.cocoDt.loadAnns(self.cocoDt.getAnnIds(imgIds=p.imgIds))
+        _gts = defaultdict(list)
+        _dts = defaultdict(list)
+        for gt in gts:
+            _gts[gt['image_id'], gt['category_id']].append(gt)
+        for dt in dts:
+            _dts[dt['image_id'], dt['category_id']].append(dt)
+
+        cat_ids = p.catIds if p.useCats else [-1]
+        area_rngs = np.array(p.areaRng, dtype=np.float64)
+        max_det = p.maxDets[-1]
+        pairs = []
+        for k, cat_id in enumerate(cat_ids):
+            for i, img_id in enumerate(p.imgIds):
+                if p.useCats:
+                    gt = _gts[img_id, cat_id]
+                    dt = _dts[img_id, cat_id]
+                else:
+                    gt = [g for c in p.catIds for g in _gts[img_id, c]]
+                    dt = [d for c in p.catIds for d in _dts[img_id, c]]
+                if len(gt) == 0 and len(dt) == 0:
+                    continue
+                inds = np.argsort([-d['score'] for d in dt], kind='mergesort')
+                dt = [dt[j] for j in inds[:max_det]]
+                gt_crowd = np.array([bool(g.get('iscrowd', 0)) for g in gt],
+                                    dtype=bool)
+                gt_ignore = gt_crowd.copy()
+                if p.iouType == 'keypoints':
+                    gt_ignore |= np.array(
+                        [g['num_keypoints'] == 0 for g in gt], dtype=bool)
+                gt_areas = np.array([g['area'] for g in gt], dtype=np.float64)
+                dt_areas = np.array([d['area'] for d in dt], dtype=np.float64)
+                if len(gt) == 0 or len(dt) == 0 or (
+                        p.iouType == 'keypoints' and not p.useCats):
+                    # `computeOks` looks up the gts of category -1 without
+                    # categories, nothing is matched then
+                    ious = np.full((len(dt), len(gt)), -np.inf)
+                elif p.iouType == 'bbox':
+                    ious = bbox_ious(
+                        np.array([d['bbox'] for d in dt], dtype=np.float64),
+                        np.array([g['bbox'] for g in gt], dtype=np.float64),
+                        gt_crowd)
+                else:
+                    ious = keypoint_oks(
+                        np.array([d['keypoints'] for d in dt],
+                                 dtype=np.float64),
+                        np.array([g['keypoints'] for g in gt],
+                                 dtype=np.float64),
+                        np.array([g['bbox'] for g in gt], dtype=np.float64),
+                        gt_areas, np.array(p.kpt_oks_sigmas))
+                pairs.append(
+                    dict(
+                        cat=k,
+                        img=i,
+                        ious=ious,
+                        gt_crowd=gt_crowd,
+                        gt_ig=gt_ignore[None] |
+                        (gt_areas[None] < area_rngs[:, :1]) |
+                        (gt_areas[None] > area_rngs[:, 1:]),
+                        gt_ids=np.array([g['id'] for g in gt], dtype=np.int64),
+                        dt_out=(dt_areas[None] < area_rngs[:, :1]) |
+                        (dt_areas[None] > area_rngs[:, 1:]),
+                        dt_scores=np.array([d['score'] for d in dt],
+                                           dtype=np.float64)))
+        return pairs
+
+    def _match(self, pairs):
+        """Matches of the detections of all the pairs, see `match_chunk`."""
+        iou_thrs = np.array(self.params.iouThrs)
+        num_areas = len(self.params.areaRng)
+        # similar sizes are padded together
+        order = sorted(
+            range(len(pairs)),
+            key=lambda n: (pairs[n]['ious'].shape[1],
+                           pairs[n]['ious'].shape[0]))
+        chunks = [
+            order[i:i + self.chunk_size]
+            for i in range(0, len(order), self.chunk_size)
+        ]
+
+        def chunk_args(chunk):
+            num_dts = max(pairs[n]['ious'].shape[0] for n in chunk)
+            num_gts = max(pairs[n]['ious'].shape[1] for n in chunk)
+            ious = np.full((len(chunk), num_dts, num_gts), -np.inf)
+            dt_valid = np.zeros((len(chunk), num_dts), dtype=bool)
+            dt_out = np.zeros((len(chunk), num_areas, num_dts), dtype=bool)
+            gt_valid = np.zeros((len(chunk), num_gts), dtype=bool)
+            gt_crowd = np.zeros((len(chunk), num_gts), dtype=bool)
+            gt_ig = np.zeros((len(chunk), num_areas, num_gts), dtype=bool)
+            gt_ids = np.zeros((len(chunk), num_gts), dtype=np.int64)
+            for c, n in enumerate(chunk):
+                pair = pairs[n]
+                d, g = pair['ious'].shape
+                ious[c, :d, :g] = pair['ious']
+                dt_valid[c, :d] = True
+                dt_out[c, :, :d] = pair['dt_out']
+                gt_valid[c, :g] = True
+                gt_crowd[c, :g] = pair['gt_crowd']
+                gt_ig[c, :, :g] = pair['gt_ig']
+                gt_ids[c, :g] = pair['gt_ids']
+            return (ious, dt_valid, dt_out, gt_valid, gt_crowd, gt_ig,
+                    gt_ids, iou_thrs)
+
+        args = (chunk_args(chunk) for chunk in chunks)
+        if self.nproc > 1:
+            with Pool(self.nproc) as pool:
+                chunk_results = pool.map(match_chunk, list(args))
+        else:
+            chunk_results = [match_chunk(arg) for arg in args]
+
+        results = [None] * len(pairs)
+        for chunk, (matched, dt_ig) in zip(chunks, chunk_results):
+            for c, n in enumerate(chunk):
+                d = pairs[n]['ious'].shape[0]
+                results[n] = (matched[c, ..., :d], dt_ig[c, ..., :d])
+        return results
+
+    def _flatten(self, pairs, results):
+        """Concatenate the detections of all the pairs, which are sorted by
+        category then image."""
+        num_areas = len(self.params.areaRng)
+        num_thrs = len(self.params.iouThrs)
+
+        def cat(arrays, shape, dtype, axis=0):
+            return np.concatenate(arrays, axis=axis) if arrays else \
+                np.zeros(shape, dtype=dtype)
+
+        return dict(
+            pair_cat=np.array([pair['cat'] for pair in pairs], dtype=np.int64),
+            pair_img=np.array([pair['img'] for pair in pairs], dtype=np.int64),
+            # number of gts which are not ignored, per area range
+            pair_npig=cat([(~pair['gt_ig']).sum(axis=1)[None]
+                           for pair in pairs], (0, num_areas), np.int64),
+            dt_pair=cat([
+                np.full(len(pair['dt_scores']), n, dtype=np.int64)
+                for n, pair in enumerate(pairs)
+            ], (0, ), np.int64),
+            dt_rank=cat([
+                np.arange(len(pair['dt_scores']), dtype=np.int64)
+                for pair in pairs
+            ], (0, ), np.int64),
+            dt_scores=cat([pair['dt_scores'] for pair in pairs], (0, ),
+                          np.float64),
+            dt_matched=cat([res[0] for res in results],
+                           (num_areas, num_thrs, 0), bool, axis=-1),
+            dt_ig=cat([res[1] for res in results], (num_areas, num_thrs, 0),
+                      bool, axis=-1))
+
+    def accumulate(self, p=None):
+        if self._matches is None:
+            return super(FastCOCOeval, self).accumulate(p)
+        print('Accumulating evaluation results...')
+        tic = time.time()
+        if p is None:
+            p = self.params
+        p.catIds = p.catIds if p.useCats == 1 else [-1]
+        T = len(p.iouThrs)
+        R = len(p.recThrs)
+        K = len(p.catIds) if p.useCats else 1
+        A = len(p.areaRng)
+        M = len(p.maxDets)
+        precision = -np.ones((T, R, K, A, M))
+        recall = -np.ones((T, K, A, M))
+        scores = -np.ones((T, R, K, A, M))
+
+        _pe = self._paramsEval
+        cat_ids = _pe.catIds if _pe.useCats else [-1]
+        setK = set(cat_ids)
+        setA = set(map(tuple, _pe.areaRng))
+        setM = set(_pe.maxDets)
+        setI = set(_pe.imgIds)
+        k_list = [n for n, k in enumerate(p.catIds) if k in setK]
+        m_list = [m for n, m in enumerate(p.maxDets) if m in setM]
+        a_list = [
+            n for n, a in enumerate(map(lambda x: tuple(x), p.areaRng))
+            if a in setA
+        ]
+        i_list = [n for n, i in enumerate(p.imgIds) if i in setI]
+        # the indices refer to the evaluated params, as in COCOeval
+        img_mask = np.zeros(len(_pe.imgIds), dtype=bool)
+        img_mask[[i for i in i_list if i < len(_pe.imgIds)]] = True
+
+        res = self._matches
+        pair_mask = img_mask[res['pair_img']]
+        dt_mask = pair_mask[res['dt_pair']]
+        dt_cat = res['pair_cat'][res['dt_pair']]
+        for k, k0 in enumerate(k_list):
+            pairs_k = (res['pair_cat'] == k0) & pair_mask
+            if not pairs_k.any():
+                continue
+            dts_k = (dt_cat == k0) & dt_mask
+            for a, a0 in enumerate(a_list):
+                npig = int(res['pair_npig'][pairs_k, a0].sum())
+                if npig == 0:
+                    continue
+                for m, max_det in enumerate(m_list):
+                    sel = np.nonzero(dts_k & (res['dt_rank'] < max_det))[0]
+                    dt_scores = res['dt_scores'][sel]
+                    inds = np.argsort(-dt_scores, kind='mergesort')
+                    dt_scores_sorted = dt_scores[inds]
+                    dtm = res['dt_matched'][a0][:, sel[inds]]
+                    dt_ig = res['dt_ig'][a0][:, sel[inds]]
+                    tps = np.logical_and(dtm, np.logical_not(dt_ig))
+                    fps = np.logical_and(
+                        np.logical_not(dtm), np.logical_not(dt_ig))
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
+                    nd = tp_sum.shape[1]
+                    rc = tp_sum / npig
+                    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+                    recall[:, k, a, m] = rc[:, -1] if nd else 0
+                    # precision envelope
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    for t in range(T):
+                        inds = np.searchsorted(rc[t], p.recThrs, side='left')
+                        valid = inds < nd
+                        q = np.zeros(R)
+                        ss = np.zeros(R)
+                        q[valid] = pr[t, inds[valid]]
+                        ss[valid] = dt_scores_sorted[inds[valid]]
+                        precision[t, :, k, a, m] = q
+                        scores[t, :, k, a, m] = ss
+        self.eval = {
+            'params': p,
+            'counts': [T, R, K, A, M],
+            'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'precision': precision,
+            'recall': recall,
+            'scores': scores,
+        }
+        print('DONE (t={:0.2f}s).'.format(time.time() - tic))
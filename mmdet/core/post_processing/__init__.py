@@ -1,9 +1,13 @@
 from .bbox_nms import multiclass_nms
 from .kpts_nms import kpts_nms, kpts_nms_vis
-from .merge_augs import (merge_aug_bboxes, merge_aug_masks,
-                         merge_aug_proposals, merge_aug_scores)
+from .merge_augs import (batch_aug_imgs, merge_aug_bboxes, merge_aug_masks,
+                         merge_aug_proposals, merge_aug_scores,
+                         prune_aug_candidates)
+from .merge_tiles import shift_points, tile_img_metas, tile_windows
 
 __all__ = [
     'multiclass_nms', 'merge_aug_proposals', 'merge_aug_bboxes',
-    'merge_aug_scores', 'merge_aug_masks', 'kpts_nms', 'kpts_nms_vis'
+    'merge_aug_scores', 'merge_aug_masks', 'kpts_nms', 'kpts_nms_vis',
+    'batch_aug_imgs', 'prune_aug_candidates', 'tile_windows',
+    'tile_img_metas', 'shift_points'
 ]
@@ -99,3 +99,52 @@ def merge_aug_masks(aug_masks, img_metas, rcnn_test_cfg, weights=None):
         merged_masks = np.average(
             np.array(recovered_masks), axis=0, weights=np.array(weights))
     return merged_masks
+
+
+def batch_aug_imgs(imgs, img_metas):
+    """Batch the augmented images of the same padded shape, e.g. the flipped
+    and unflipped images of a scale, to run them in a single forward pass.
+
+    Args:
+        imgs (list[Tensor]): Augmented images, shape (1, C, H, W).
+        img_metas (list[list[dict]]): Meta info of each augmented image.
+
+    Returns:
+        list[tuple]: (img, img_meta, aug_inds) of each batch, with the
+            concatenated images, the list of their meta info and their
+            indices in `imgs`. Batches are sorted by increasing image size.
+    """
+    groups = {}
+    for i, img in enumerate(imgs):
+        groups.setdefault(tuple(img.shape[1:]), []).append(i)
+    batches = []
+    for shape in sorted(groups, key=lambda s: (s[-2] * s[-1], s)):
+        inds = groups[shape]
+        batches.append((torch.cat([imgs[i] for i in inds]),
+                        [img_meta for i in inds for img_meta in img_metas[i]],
+                        inds))
+    return batches
+
+
+def prune_aug_candidates(scores, score_thr, max_num=-1):
+    """Select the candidates of an augmented image to merge.
+
+    Candidates whose scores are all below `score_thr` are dropped by the nms
+    after the merge anyway. With `max_num`, only the best scored ones are
+    kept, which bounds the cost of the nms of the merged candidates.
+
+    Args:
+        scores (Tensor): Scores of shape (n, #class), the first class is the
+            background.
+        score_thr (float): Score threshold of the nms.
+        max_num (int): Maximum number of candidates, -1 for all.
+
+    Returns:
+        Tensor: Indices of the kept candidates.
+    """
+    max_scores, _ = scores[:, 1:].max(dim=1)
+    inds = (max_scores > score_thr).nonzero().view(-1)
+    if 0 < max_num < inds.numel():
+        _, topk_inds = max_scores[inds].topk(max_num)
+        inds = inds[topk_inds]
+    return inds
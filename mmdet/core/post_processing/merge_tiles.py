@@ -0,0 +1,48 @@
+def tile_windows(img_size, tile_size, overlap):
+    """Windows of the overlapping tiles covering an image.
+
+    The tiles all have the same size, the last ones of each row and column
+    are aligned to the border of the image, so that the tiles can be run as
+    a batch. Images smaller than a tile give a single tile of their size.
+
+    Args:
+        img_size (tuple): (h, w) of the (padded) image.
+        tile_size (tuple): (h, w) of the tiles.
+        overlap (int): Minimum overlap of adjacent tiles in pixels.
+
+    Returns:
+        list[tuple]: (x1, y1, x2, y2) of each tile.
+    """
+    starts = []
+    for size, tile in zip(img_size, tile_size):
+        tile = min(tile, size)
+        step = max(tile - overlap, 1)
+        axis_starts = list(range(0, size - tile, step)) + [size - tile]
+        starts.append((axis_starts, tile))
+    (ys, tile_h), (xs, tile_w) = starts
+    return [(x, y, x + tile_w, y + tile_h) for y in ys for x in xs]
+
+
+def tile_img_metas(img_meta, windows):
+    """Meta info of the tiles of an image, see :func:`tile_windows`."""
+    img_h, img_w = img_meta['img_shape'][:2]
+    channels = img_meta['img_shape'][2:]
+    tile_metas = []
+    for x1, y1, x2, y2 in windows:
+        tile_meta = dict(img_meta)
+        tile_meta['img_shape'] = (min(y2, img_h) - y1,
+                                  min(x2, img_w) - x1) + tuple(channels)
+        tile_meta['pad_shape'] = (y2 - y1, x2 - x1) + tuple(channels)
+        tile_meta['tile'] = (x1, y1, x2, y2)
+        tile_metas.append(tile_meta)
+    return tile_metas
+
+
+def shift_points(points, dx, dy):
+    """Shift points in the (x1, y1, x2, y2, ...) format (e.g. bboxes, poses
+    or mask contours) from the coordinates of a tile to the ones of the
+    image."""
+    if points.numel() == 0:
+        return points
+    offset = points.new_tensor([dx, dy]).repeat(points.shape[-1] // 2)
+    return points + offset
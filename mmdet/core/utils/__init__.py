@@ -1,7 +1,8 @@
-from .dist_utils import DistOptimizerHook, allreduce_grads, TextLoggerAccHook
-from .misc import multi_apply, tensor2imgs, unmap
+from .dist_utils import (DistOptimizerHook, TextLoggerAccHook,
+                         allreduce_grads, gather_object)
+from .misc import multi_apply, normalize_img_batch, tensor2imgs, unmap
 
 __all__ = [
-    'allreduce_grads', 'DistOptimizerHook', 'tensor2imgs', 'unmap',
-    'multi_apply', 'TextLoggerAccHook'
+    'allreduce_grads', 'gather_object', 'DistOptimizerHook', 'tensor2imgs',
+    'unmap', 'multi_apply', 'normalize_img_batch', 'TextLoggerAccHook'
 ]
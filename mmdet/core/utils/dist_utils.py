@@ -1,5 +1,7 @@
+import pickle
 from collections import OrderedDict
 
+import torch
 import torch.distributed as dist
 from mmcv.runner import OptimizerHook
 from torch._utils import (_flatten_dense_tensors, _take_tensors,
@@ -41,6 +43,56 @@ def allreduce_grads(params, coalesce=True, bucket_size_mb=-1):
             dist.all_reduce(tensor.div_(world_size))
 
 
+def gather_object(obj, dst=0):
+    """Gather a picklable object from every rank on the rank `dst`, without
+    touching the disk.
+
+    :func:`torch.distributed.gather_object` is used when available.
+    Otherwise the object is pickled into a uint8 tensor, which is padded to
+    the largest size over all ranks and exchanged with `gather` (or with
+    `all_gather` on NCCL, which has no `gather` in those versions).
+
+    Returns:
+        list | None: The objects of all ranks in rank order on `dst`, None
+            on the other ranks.
+    """
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    if hasattr(dist, 'gather_object'):
+        objs = [None for _ in range(world_size)] if rank == dst else None
+        dist.gather_object(obj, objs, dst=dst)
+        return objs
+
+    nccl = dist.get_backend() == 'nccl'
+    if nccl:
+        device = torch.device('cuda', torch.cuda.current_device())
+    else:
+        device = torch.device('cpu')
+    buf = torch.tensor(
+        bytearray(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)),
+        dtype=torch.uint8,
+        device=device)
+    size = torch.tensor([buf.numel()], dtype=torch.long, device=device)
+    size_list = [size.clone() for _ in range(world_size)]
+    dist.all_gather(size_list, size)
+    max_size = int(max(size_list).item())
+    padded = buf.new_zeros((max_size, ))
+    padded[:buf.numel()] = buf
+    padded_list = [padded.new_empty((max_size, )) for _ in range(world_size)]
+    if nccl:
+        dist.all_gather(padded_list, padded)
+    elif rank == dst:
+        dist.gather(padded, padded_list, dst=dst)
+    else:
+        dist.gather(padded, dst=dst)
+    if rank != dst:
+        return None
+    return [
+        pickle.loads(recv[:int(recv_size.item())].cpu().numpy().tobytes())
+        for recv, recv_size in zip(padded_list, size_list)
+    ]
+
+
 class DistOptimizerHook(OptimizerHook):
 
     def __init__(self, grad_clip=None, coalesce=True, bucket_size_mb=-1):
@@ -2,6 +2,7 @@ from functools import partial
 
 import mmcv
 import numpy as np
+import torch
 from six.moves import map, zip
 
 
@@ -12,12 +13,47 @@ def tensor2imgs(tensor, mean=(0, 0, 0), std=(1, 1, 1), to_rgb=True):
     imgs = []
     for img_id in range(num_imgs):
         img = tensor[img_id, ...].cpu().numpy().transpose(1, 2, 0)
-        img = mmcv.imdenormalize(
-            img, mean, std, to_bgr=to_rgb).astype(np.uint8)
+        # uint8 images have not been normalized yet (Normalize(on_device))
+        if img.dtype != np.uint8:
+            img = mmcv.imdenormalize(
+                img, mean, std, to_bgr=to_rgb).astype(np.uint8)
         imgs.append(np.ascontiguousarray(img))
     return imgs
 
 
+def normalize_img_batch(img, img_metas):
+    """Normalize a batch of uint8 images on the device they live on.
+
+    This is the batched counterpart of the `Normalize` + `Pad` pipeline
+    stages, used when the pipeline runs `Normalize(on_device=True)`. Float
+    inputs are assumed to be normalized already and are returned unchanged.
+
+    Args:
+        img (Tensor): uint8 images of shape (N, 3, H, W), zero padded.
+        img_metas (list[dict]): Meta info of each image, providing
+            "img_norm_cfg" and "img_shape".
+
+    Returns:
+        Tensor: float32 images of shape (N, 3, H, W), with the padded area
+            set to 0 as in the CPU pipeline.
+    """
+    if img.dtype != torch.uint8:
+        return img
+    norm_cfg = img_metas[0]['img_norm_cfg']
+    if norm_cfg['to_rgb']:
+        img = img.flip(1)
+    # the subtraction and division are in place on the float copy
+    img = img.float()
+    mean = img.new_tensor(norm_cfg['mean']).view(1, -1, 1, 1)
+    std = img.new_tensor(norm_cfg['std']).view(1, -1, 1, 1)
+    img.sub_(mean).div_(std)
+    for i, img_meta in enumerate(img_metas):
+        h, w = img_meta['img_shape'][:2]
+        img[i, :, h:, :] = 0
+        img[i, :, :h, w:] = 0
+    return img
+
+
 def multi_apply(func, *args, **kwargs):
     pfunc = partial(func, **kwargs) if kwargs else func
     map_results = map(pfunc, *args)
@@ -3,17 +3,20 @@ from .cityscapes import CityscapesDataset
 from .coco import CocoDataset
 from .custom import CustomDataset
 from .dataset_wrappers import ConcatDataset, RepeatDataset
-from .loader import DistributedGroupSampler, GroupSampler, build_dataloader
+from .loader import (DataPrefetcher, DistributedGroupSampler, GroupSampler,
+                     build_dataloader)
 from .registry import DATASETS
 from .voc import VOCDataset
 from .wider_face import WIDERFaceDataset
 from .xml_style import XMLDataset
 from .coco_pose import CocoPoseDataset
+from .synthetic import SyntheticCocoDataset, SyntheticCocoPoseDataset
 
 
 __all__ = [
     'CustomDataset', 'XMLDataset', 'CocoDataset', 'VOCDataset',
     'CityscapesDataset', 'GroupSampler', 'DistributedGroupSampler',
     'build_dataloader', 'ConcatDataset', 'RepeatDataset', 'WIDERFaceDataset',
-    'DATASETS', 'build_dataset', 'CocoPoseDataset'
+    'DATASETS', 'build_dataset', 'CocoPoseDataset', 'DataPrefetcher',
+    'SyntheticCocoDataset', 'SyntheticCocoPoseDataset'
 ]
@@ -26,7 +26,10 @@ class CocoDataset(CustomDataset):
                'vase', 'scissors', 'teddy_bear', 'hair_drier', 'toothbrush')
 
     def load_annotations(self, ann_file):
-        self.coco = COCO(ann_file)
+        return self.load_coco(COCO(ann_file))
+
+    def load_coco(self, coco):
+        self.coco = coco
         self.cat_ids = self.coco.getCatIds()
         self.cat2label = {
             cat_id: i + 1
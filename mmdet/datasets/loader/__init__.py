@@ -1,4 +1,8 @@
 from .build_loader import build_dataloader
+from .prefetcher import DataPrefetcher
 from .sampler import DistributedGroupSampler, GroupSampler
 
-__all__ = ['GroupSampler', 'DistributedGroupSampler', 'build_dataloader']
+__all__ = [
+    'GroupSampler', 'DistributedGroupSampler', 'build_dataloader',
+    'DataPrefetcher'
+]
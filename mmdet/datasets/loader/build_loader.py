@@ -1,7 +1,8 @@
 import platform
 from functools import partial
 
-from mmcv.parallel import collate
+import torch
+from mmcv.parallel import DataContainer, collate
 from mmcv.runner import get_dist_info
 from torch.utils.data import DataLoader
 
@@ -14,12 +15,76 @@ if platform.system() != 'Windows':
     resource.setrlimit(resource.RLIMIT_NOFILE, (4096, rlimit[1]))
 
 
+class PinnableDataContainer(DataContainer):
+    """A DataContainer that the DataLoader pin-memory thread can pin.
+
+    The pin-memory thread of :class:`DataLoader` only recurses into tensors,
+    sequences and mappings, so the tensors wrapped by a plain DataContainer
+    would never be page-locked.
+    """
+
+    def pin_memory(self):
+        if self.cpu_only:
+            return self
+        if isinstance(self._data, torch.Tensor):
+            self._data = self._data.pin_memory()
+        else:
+            self._data = [
+                d.pin_memory() if isinstance(d, torch.Tensor) else d
+                for d in self._data
+            ]
+        return self
+
+
+def _to_pinnable(data):
+    if isinstance(data, DataContainer):
+        return PinnableDataContainer(
+            data.data,
+            stack=data.stack,
+            padding_value=data.padding_value,
+            cpu_only=data.cpu_only)
+    elif isinstance(data, dict):
+        return {k: _to_pinnable(v) for k, v in data.items()}
+    elif isinstance(data, list):
+        return [_to_pinnable(d) for d in data]
+    return data
+
+
+def test_collate(batch, samples_per_gpu=1):
+    """Collate test samples, padding their images to a common size.
+
+    The test pipelines end in `ImageToTensor` + `Collect`, which leave each
+    augmentation of the image as a plain tensor that `collate` would stack
+    as is. They are wrapped in stacked DataContainers first, so that they
+    are padded to the largest image of the batch as in training.
+    """
+    if len(batch) % samples_per_gpu != 0:
+        # the last batch of a rank is short when the dataset is not a
+        # multiple of `imgs_per_gpu` (the test sampler does not pad it)
+        samples_per_gpu = len(batch)
+    batch = [
+        dict(
+            sample,
+            img=[
+                img if isinstance(img, DataContainer) else DataContainer(
+                    img, stack=True) for img in sample['img']
+            ]) for sample in batch
+    ]
+    return collate(batch, samples_per_gpu=samples_per_gpu)
+
+
+def pinnable_collate(batch, samples_per_gpu=1, collate_fn=collate):
+    return _to_pinnable(collate_fn(batch, samples_per_gpu=samples_per_gpu))
+
+
 def build_dataloader(dataset,
                      imgs_per_gpu,
                      workers_per_gpu,
                      num_gpus=1,
                      dist=True,
                      shuffle=True,
+                     pin_memory=False,
+                     test_mode=False,
                      **kwargs):
     if dist:
         rank, world_size = get_dist_info()
@@ -36,13 +101,16 @@ def build_dataloader(dataset,
         batch_size = num_gpus * imgs_per_gpu
         num_workers = num_gpus * workers_per_gpu
 
+    collate_fn = test_collate if test_mode else collate
+    if pin_memory:
+        collate_fn = partial(pinnable_collate, collate_fn=collate_fn)
     data_loader = DataLoader(
         dataset,
         batch_size=batch_size,
         sampler=sampler,
         num_workers=num_workers,
-        collate_fn=partial(collate, samples_per_gpu=imgs_per_gpu),
-        pin_memory=False,
+        collate_fn=partial(collate_fn, samples_per_gpu=imgs_per_gpu),
+        pin_memory=pin_memory,
         **kwargs)
 
     return data_loader
@@ -0,0 +1,97 @@
+import torch
+from mmcv.parallel import DataContainer
+
+from mmdet.core.utils import normalize_img_batch
+
+
+class DataPrefetcher(object):
+    """Move the next batch to the device while the current step runs.
+
+    The images of the next batch are copied to their target device and
+    normalized there (see `Normalize(on_device=True)`) as soon as the current
+    batch is handed out. On CUDA the copy and the normalization are issued on
+    a side stream, so they overlap with the current training step; on CPU
+    the same path is taken without streams and the normalization is done in
+    place. The images must be collated into DataContainers, test loaders are
+    built with `test_mode=True` for that (see `test_collate`).
+
+    The wrapper behaves like the wrapped loader otherwise, so the runner and
+    hooks can keep using `len()`, `sampler`, `dataset`, etc.
+
+    Args:
+        data_loader (:obj:`DataLoader`): The loader to wrap.
+        devices (list[int], optional): One device per chunk of the collated
+            batch (i.e. per GPU). `None` means the current CUDA device if CUDA
+            is available, otherwise the CPU.
+    """
+
+    def __init__(self, data_loader, devices=None):
+        self.data_loader = data_loader
+        if devices is None:
+            devices = [torch.cuda.current_device()
+                       ] if torch.cuda.is_available() else []
+        self.devices = [torch.device('cuda', d) for d in devices]
+        self.streams = {d: torch.cuda.Stream(d) for d in self.devices}
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __getattr__(self, name):
+        # only called for attributes not found on the prefetcher itself
+        if name == 'data_loader':
+            raise AttributeError(name)
+        return getattr(self.data_loader, name)
+
+    def _to_device(self, img, img_metas, device):
+        if device is None:
+            return normalize_img_batch(img, img_metas)
+        with torch.cuda.stream(self.streams[device]):
+            img = img.to(device, non_blocking=True)
+            return normalize_img_batch(img, img_metas)
+
+    def _preload(self, data):
+        img_dcs, meta_dcs = data['img'], data['img_meta']
+        if not isinstance(img_dcs, list):
+            img_dcs, meta_dcs = [img_dcs], [meta_dcs]
+        for img_dc, meta_dc in zip(img_dcs, meta_dcs):
+            if not isinstance(img_dc, DataContainer):
+                raise TypeError(
+                    'the images must be collated into DataContainers, build '
+                    'the test loaders with test_mode=True')
+            # one stacked tensor per device chunk, modified in place so that
+            # the DataContainer flags are kept as is
+            for i, img_metas in enumerate(meta_dc.data):
+                device = self.devices[i] if self.devices else None
+                img_dc.data[i] = self._to_device(img_dc.data[i], img_metas,
+                                                 device)
+        # mark the end of the copies of this batch only, the side streams
+        # may already hold the copies of the next one when we wait
+        events = {}
+        for device in self.devices:
+            events[device] = torch.cuda.Event()
+            events[device].record(self.streams[device])
+        return data, events
+
+    def _wait(self, data, events):
+        for device, event in events.items():
+            torch.cuda.current_stream(device).wait_event(event)
+        img_dcs = data['img']
+        if not isinstance(img_dcs, list):
+            img_dcs = [img_dcs]
+        for img_dc in img_dcs:
+            for img in img_dc.data:
+                if img.is_cuda:
+                    img.record_stream(torch.cuda.current_stream(img.device))
+        return data
+
+    def __iter__(self):
+        prev = None
+        for data in self.data_loader:
+            # issue the copies of this batch before handing out the previous
+            # one, so that they overlap with the previous training step
+            data = self._preload(data)
+            if prev is not None:
+                yield self._wait(*prev)
+            prev = data
+        if prev is not None:
+            yield self._wait(*prev)
@@ -1,7 +1,9 @@
 from .compose import Compose
 from .formating import (Collect, ImageToTensor, ToDataContainer, ToTensor,
                         Transpose, to_tensor)
-from .loading import LoadAnnotations, LoadImageFromFile, LoadProposals
+from .loading import (LoadAnnotations, LoadImageFromFile, LoadProposals,
+                      LoadSyntheticImage)
+from .targets import ComputePointSetTargets
 from .test_aug import MultiScaleFlipAug
 from .transforms import (Albu, Expand, MinIoURandomCrop, Normalize, Pad,
                          PhotoMetricDistortion, RandomCrop, RandomFlip, Resize,
@@ -10,7 +12,7 @@ from .transforms import (Albu, Expand, MinIoURandomCrop, Normalize, Pad,
 __all__ = [
     'Compose', 'to_tensor', 'ToTensor', 'ImageToTensor', 'ToDataContainer',
     'Transpose', 'Collect', 'LoadAnnotations', 'LoadImageFromFile',
-    'LoadProposals', 'MultiScaleFlipAug', 'Resize', 'RandomFlip', 'Pad',
-    'RandomCrop', 'Normalize', 'SegResizeFlipPadRescale', 'MinIoURandomCrop',
-    'Expand', 'PhotoMetricDistortion', 'Albu'
+    'LoadProposals', 'LoadSyntheticImage', 'MultiScaleFlipAug', 'Resize',
+    'RandomFlip', 'Pad', 'RandomCrop', 'Normalize', 'SegResizeFlipPadRescale',
+    'MinIoURandomCrop', 'Expand', 'PhotoMetricDistortion', 'Albu', 'ComputePointSetTargets'
 ]
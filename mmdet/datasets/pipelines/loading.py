@@ -1,6 +1,7 @@
 import os.path as osp
 import warnings
 
+import cv2
 import mmcv
 import numpy as np
 import pycocotools.mask as maskUtils
@@ -34,6 +35,41 @@ class LoadImageFromFile(object):
             self.to_float32)
 
 
+@PIPELINES.register_module
+class LoadSyntheticImage(object):
+    """Render the image of a synthetic dataset instead of reading a file.
+
+    The polygons in `img_info['polygons']` are filled with random colors on
+    a smooth noise background, the colors only depend on `img_info['seed']`.
+    """
+
+    def __init__(self, to_float32=False):
+        self.to_float32 = to_float32
+
+    def __call__(self, results):
+        img_info = results['img_info']
+        h, w = img_info['height'], img_info['width']
+        rng = np.random.RandomState(img_info['seed'] + [1])
+        img = mmcv.imresize(
+            rng.randint(0, 256, (h // 16 + 1, w // 16 + 1, 3),
+                        dtype=np.uint8), (w, h))
+        for polygon in img_info['polygons']:
+            pts = np.round(np.array(polygon).reshape(-1, 1, 2)).astype(
+                np.int32)
+            cv2.fillPoly(img, [pts], rng.randint(0, 256, 3).tolist())
+        if self.to_float32:
+            img = img.astype(np.float32)
+        results['filename'] = img_info['filename']
+        results['img'] = img
+        results['img_shape'] = img.shape
+        results['ori_shape'] = img.shape
+        return results
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(to_float32={})'.format(
+            self.to_float32)
+
+
 @PIPELINES.register_module
 class LoadAnnotations(object):
 
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import os.path as osp
+import tempfile
+
+import mmcv
+import torch
+from mmcv.parallel import DataContainer as DC
+
+from ..registry import PIPELINES
+from .formating import to_tensor
+
+
+class TargetCache(object):
+    """On-disk cache of the targets of `ComputePointSetTargets`.
+
+    Each entry is a file named after the hash of its key. Data workers of all
+    the processes share the directory: files are written atomically, and the
+    least recently used ones are removed once the directory grows larger
+    than `max_size` bytes.
+
+    Args:
+        cache_dir (str): Directory of the cache files.
+        max_size (int): Size limit of the cache directory in bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=20 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._size = None
+        mmcv.mkdir_or_exist(cache_dir)
+
+    def _path(self, key):
+        return osp.join(self.cache_dir,
+                        hashlib.sha1(key.encode()).hexdigest() + '.pth')
+
+    def _files(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pth'):
+                continue
+            path = osp.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def get(self, key):
+        """Cached data of `key`, or None on a miss.
+
+        A file that cannot be loaded (truncated, corrupted or written by an
+        incompatible version) is a miss too, and is removed so that the
+        entry is recomputed and written again.
+        """
+        path = self._path(key)
+        try:
+            data = torch.load(path)
+            # refresh the entry for the eviction
+            os.utime(path)
+        except Exception:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        return data
+
+    def put(self, key, data):
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(data, f)
+        size = osp.getsize(tmp_path)
+        os.replace(tmp_path, self._path(key))
+        if self._size is None:
+            self._size = sum(f[1] for f in self._files())
+        else:
+            self._size += size
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries, down to 90% of the
+        size limit."""
+        files = sorted(self._files())
+        self._size = sum(f[1] for f in files)
+        for _, size, path in files:
+            if self._size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+
+@PIPELINES.register_module
+class ComputePointSetTargets(object):
+    """Compute the anchor targets of the head in the data workers.
+
+    The classification and regression targets of the default anchors are
+    computed on the feature maps of the padded image, in the compact format
+    of :func:`mmdet.core.compact_target`, and the heatmap targets (if a heat
+    head is given) per output stride of the heat head. The head loss then
+    only has to move them to the batch feature maps, see
+    :func:`mmdet.core.compact_targets_to_levels`.
+
+    This stage must be placed after "Pad" and before "DefaultFormatBundle".
+    Added keys are "point_set_targets" and "heat_targets", which have to be
+    collected by "Collect" to be passed to the detector.
+
+    With `cache_dir`, the targets are cached on disk by image, resized shape,
+    padded shape, flip and a hash of the configs, see :class:`TargetCache`.
+    This is only valid if the transforms before are deterministic given
+    those, e.g. "Resize" and "RandomFlip" but no random crop. Use the
+    `scale_step` of "Resize" in the "range" mode, so that the same scales
+    come back over the epochs.
+
+    Args:
+        bbox_head (dict): Config of the head of the detector.
+        train_cfg (dict): Training config of the detector.
+        heat_head (dict, optional): Config of the heat head of the detector.
+        cache_dir (str, optional): Directory of the target cache.
+        cache_size (int): Size limit of the target cache in bytes.
+    """
+
+    def __init__(self,
+                 bbox_head,
+                 train_cfg,
+                 heat_head=None,
+                 cache_dir=None,
+                 cache_size=20 * 1024**3):
+        # models are imported here as they depend on the datasets
+        from mmdet.models import build_head
+        # only the anchors and the target computation of the heads are used,
+        # their layers are not built in every worker
+        self.bbox_head = build_head(dict(bbox_head, with_layers=False))
+        self.heat_head = build_head(dict(heat_head, with_layers=False)) \
+            if heat_head is not None else None
+        self.train_cfg = mmcv.Config(train_cfg)
+        self.cache = TargetCache(cache_dir, cache_size) \
+            if cache_dir is not None else None
+        self.cfg_hash = hashlib.sha1(
+            json.dumps([bbox_head, train_cfg, heat_head],
+                       sort_keys=True,
+                       default=str).encode()).hexdigest()
+
+    def cache_key(self, results):
+        img_info = results['img_info']
+        return '{}_{}_{}_{}_{}'.format(
+            img_info.get('id', img_info['filename']),
+            tuple(results['img_shape'][:2]), tuple(results['pad_shape'][:2]),
+            results['flip'], self.cfg_hash)
+
+    def __call__(self, results):
+        if self.cache is not None:
+            key = self.cache_key(results)
+            cached = self.cache.get(key)
+            if cached is not None:
+                results.update({k: DC(v, cpu_only=True)
+                                for k, v in cached.items()})
+                return results
+        results = self.compute_targets(results)
+        if self.cache is not None:
+            self.cache.put(key, {
+                k: results[k].data
+                for k in ['point_set_targets', 'heat_targets'] if k in results
+            })
+        return results
+
+    def compute_targets(self, results):
+        img_meta = {
+            key: results[key]
+            for key in ['ori_shape', 'img_shape', 'pad_shape', 'scale_factor',
+                        'flip']
+        }
+        gt_bboxes = to_tensor(results['gt_bboxes'])
+        gt_labels = to_tensor(results['gt_labels'])
+        gt_bboxes_ignore = to_tensor(results['gt_bboxes_ignore']) \
+            if 'gt_bboxes_ignore' in results else None
+        # contiguous like the scattered batches, the crops can leave the
+        # keypoints transposed in memory
+        gt_keypoints = to_tensor(
+            results['gt_keypoints']).float().contiguous() \
+            if 'gt_keypoints' in results else None
+        with torch.no_grad():
+            targets = self.bbox_head.get_compact_targets(
+                img_meta,
+                self.train_cfg,
+                gt_bboxes,
+                gt_labels,
+                gt_keypoints=gt_keypoints,
+                gt_masks=results.get('gt_masks'),
+                gt_bboxes_ignore=gt_bboxes_ignore)
+            results['point_set_targets'] = DC(targets, cpu_only=True)
+            if self.heat_head is not None:
+                heat_targets = self.heat_head.get_compact_targets(
+                    gt_keypoints, results['pad_shape'])
+                results['heat_targets'] = DC(heat_targets, cpu_only=True)
+        return results
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(heat_head={}, cache_dir={})'.format(
+            self.heat_head is not None,
+            None if self.cache is None else self.cache.cache_dir)
@@ -1,4 +1,6 @@
 import inspect
+import os
+import os.path as osp
 
 import albumentations
 import mmcv
@@ -7,6 +9,7 @@ from albumentations import Compose
 from imagecorruptions import corrupt
 from numpy import random
 
+from mmcv_custom.keypoints import COCO_FLIP_INDEX, flip_keypoints_numpy
 from mmdet.core.evaluation.bbox_overlaps import bbox_overlaps
 from ..registry import PIPELINES
 
@@ -35,13 +38,18 @@ class Resize(object):
         ratio_range (tuple[float]): (min_ratio, max_ratio)
         keep_ratio (bool): Whether to keep the aspect ratio when resizing the
             image.
+        scale_step (int, optional): Only sample edges which are a multiple of
+            `scale_step` away from the minimum edge in the "range" mode, so
+            that a limited number of scales is used (e.g. to cache targets,
+            see `ComputePointSetTargets`).
     """
 
     def __init__(self,
                  img_scale=None,
                  multiscale_mode='range',
                  ratio_range=None,
-                 keep_ratio=True):
+                 keep_ratio=True,
+                 scale_step=None):
         if img_scale is None:
             self.img_scale = None
         else:
@@ -61,6 +69,7 @@ class Resize(object):
         self.multiscale_mode = multiscale_mode
         self.ratio_range = ratio_range
         self.keep_ratio = keep_ratio
+        self.scale_step = scale_step
 
     @staticmethod
     def random_select(img_scales):
@@ -70,16 +79,23 @@ class Resize(object):
         return img_scale, scale_idx
 
     @staticmethod
-    def random_sample(img_scales):
+    def random_sample(img_scales, scale_step=None):
         assert mmcv.is_list_of(img_scales, tuple) and len(img_scales) == 2
         img_scale_long = [max(s) for s in img_scales]
         img_scale_short = [min(s) for s in img_scales]
-        long_edge = np.random.randint(
-            min(img_scale_long),
-            max(img_scale_long) + 1)
-        short_edge = np.random.randint(
-            min(img_scale_short),
-            max(img_scale_short) + 1)
+        if scale_step is None:
+            long_edge = np.random.randint(
+                min(img_scale_long),
+                max(img_scale_long) + 1)
+            short_edge = np.random.randint(
+                min(img_scale_short),
+                max(img_scale_short) + 1)
+        else:
+            long_edge = min(img_scale_long) + scale_step * np.random.randint(
+                (max(img_scale_long) - min(img_scale_long)) // scale_step + 1)
+            short_edge = min(img_scale_short) + scale_step * np.random.randint(
+                (max(img_scale_short) - min(img_scale_short)) // scale_step +
+                1)
         img_scale = (long_edge, short_edge)
         return img_scale, None
 
@@ -99,7 +115,8 @@ class Resize(object):
         elif len(self.img_scale) == 1:
             scale, scale_idx = self.img_scale[0], 0
         elif self.multiscale_mode == 'range':
-            scale, scale_idx = self.random_sample(self.img_scale)
+            scale, scale_idx = self.random_sample(self.img_scale,
+                                                  self.scale_step)
         elif self.multiscale_mode == 'value':
             scale, scale_idx = self.random_select(self.img_scale)
         else:
@@ -136,7 +153,9 @@ class Resize(object):
         scale_factor = results['scale_factor']
         for key in results.get('keypoint_fields', []):
             gt_kpts = results[key]
-            gt_kpts = gt_kpts.reshape(-1, 17, 3)
+            if gt_kpts.ndim == 2:
+                gt_kpts = gt_kpts.reshape(gt_kpts.shape[0],
+                                          gt_kpts.shape[1] // 3, 3)
             gt_kpts[..., 0] *= scale_factor
             gt_kpts[..., 1] *= scale_factor
             # gt_kpts[..., 0] = np.clip(gt_kpts[..., 0], 0, img_shape[1] - 1)
@@ -187,10 +206,9 @@ class Resize(object):
     def __repr__(self):
         repr_str = self.__class__.__name__
         repr_str += ('(img_scale={}, multiscale_mode={}, ratio_range={}, '
-                     'keep_ratio={})').format(self.img_scale,
-                                              self.multiscale_mode,
-                                              self.ratio_range,
-                                              self.keep_ratio)
+                     'keep_ratio={}, scale_step={})').format(
+                         self.img_scale, self.multiscale_mode,
+                         self.ratio_range, self.keep_ratio, self.scale_step)
         return repr_str
 
 
@@ -204,11 +222,23 @@ class RandomFlip(object):
 
     Args:
         flip_ratio (float, optional): The flipping probability.
+        keypoint_flip_index (sequence[int], optional): Permutation swapping
+            the left/right keypoints, see
+            :func:`mmcv_custom.keypoints.get_flip_index`. Defaults to the
+            17 COCO keypoints.
     """
 
-    def __init__(self, flip_ratio=None, direction='horizontal'):
+    def __init__(self,
+                 flip_ratio=None,
+                 direction='horizontal',
+                 keypoint_flip_index=None):
         self.flip_ratio = flip_ratio
         self.direction = direction
+        if keypoint_flip_index is None:
+            self.keypoint_flip_index = COCO_FLIP_INDEX
+        else:
+            self.keypoint_flip_index = np.array(
+                keypoint_flip_index, dtype=np.int64)
         if flip_ratio is not None:
             assert flip_ratio >= 0 and flip_ratio <= 1
         assert direction in ['horizontal', 'vertical']
@@ -236,54 +266,16 @@ class RandomFlip(object):
         return flipped
 
     def kpts_flip(self, keypoint_coords, img_shape):
-        """Left/right flip keypoint_coords. keypoints and keypoint_flip_map are
-        accessible from get_keypoints().
+        """Left/right flip keypoint_coords of shape (n, num_keypoints, 3).
         """
-        flipped_kps = keypoint_coords.copy()
-        keypoints = [
-            'nose',
-            'left_eye',
-            'right_eye',
-            'left_ear',
-            'right_ear',
-            'left_shoulder',
-            'right_shoulder',
-            'left_elbow',
-            'right_elbow',
-            'left_wrist',
-            'right_wrist',
-            'left_hip',
-            'right_hip',
-            'left_knee',
-            'right_knee',
-            'left_ankle',
-            'right_ankle'
-        ]
-        keypoint_flip_map = {
-            'left_eye': 'right_eye',
-            'left_ear': 'right_ear',
-            'left_shoulder': 'right_shoulder',
-            'left_elbow': 'right_elbow',
-            'left_wrist': 'right_wrist',
-            'left_hip': 'right_hip',
-            'left_knee': 'right_knee',
-            'left_ankle': 'right_ankle'
-        }
         width = img_shape[1]
-        for lkp, rkp in keypoint_flip_map.items():
-            lid = keypoints.index(lkp)
-            rid = keypoints.index(rkp)
-            flipped_kps[:, lid, :] = keypoint_coords[:, rid, :]
-            flipped_kps[:, rid, :] = keypoint_coords[:, lid, :]
-
-        # Flip x coordinates
-        flipped_kps[..., 0] = width - flipped_kps[..., 0] - 1
+        flipped_kps = flip_keypoints_numpy(keypoint_coords, width,
+                                           self.keypoint_flip_index)
         # Maintain COCO convention that if visibility == 0, then x, y = 0
         inds = flipped_kps[..., 2] == 0
         flipped_kps[inds] = 0
         return flipped_kps
 
-
     def poly_mask_flip(self, poly_masks, img_shape, direction):
         flippeds = []
         for poly_mask in poly_masks:
@@ -403,24 +395,32 @@ class Normalize(object):
         std (sequence): Std values of 3 channels.
         to_rgb (bool): Whether to convert the image from BGR to RGB,
             default is true.
+        on_device (bool): If True, only record "img_norm_cfg" and keep the
+            image as uint8. The batch is then normalized on the training
+            device by :func:`mmdet.core.normalize_img_batch`, which cuts the
+            bytes sent through the loader by 4x.
     """
 
-    def __init__(self, mean, std, to_rgb=True):
+    def __init__(self, mean, std, to_rgb=True, on_device=False):
         self.mean = np.array(mean, dtype=np.float32)
         self.std = np.array(std, dtype=np.float32)
         self.to_rgb = to_rgb
+        self.on_device = on_device
 
     def __call__(self, results):
-        results['img'] = mmcv.imnormalize(results['img'], self.mean, self.std,
-                                          self.to_rgb)
+        if self.on_device:
+            results['img'] = results['img'].astype(np.uint8, copy=False)
+        else:
+            results['img'] = mmcv.imnormalize(results['img'], self.mean,
+                                              self.std, self.to_rgb)
         results['img_norm_cfg'] = dict(
             mean=self.mean, std=self.std, to_rgb=self.to_rgb)
         return results
 
     def __repr__(self):
         repr_str = self.__class__.__name__
-        repr_str += '(mean={}, std={}, to_rgb={})'.format(
-            self.mean, self.std, self.to_rgb)
+        repr_str += '(mean={}, std={}, to_rgb={}, on_device={})'.format(
+            self.mean, self.std, self.to_rgb, self.on_device)
         return repr_str
 
 
@@ -787,22 +787,49 @@ class MinIoURandomCrop(object):
 
 @PIPELINES.register_module
 class Corrupt(object):
+    """Corrupt the image with `imagecorruptions`.
 
-    def __init__(self, corruption, severity=1):
+    Args:
+        corruption (str): Corruption name.
+        severity (int): Corruption severity, from 1 to 5.
+        cache_dir (str, optional): The corrupted images are saved (losslessly)
+            in `cache_dir/corruption/severity/` the first time and loaded
+            from there afterwards, so that they are computed once for all the
+            models and runs.
+    """
+
+    def __init__(self, corruption, severity=1, cache_dir=None):
         self.corruption = corruption
         self.severity = severity
+        self.cache_dir = cache_dir
 
     def __call__(self, results):
+        cache_file = None
+        if self.cache_dir is not None:
+            cache_file = osp.join(
+                self.cache_dir, self.corruption, str(self.severity),
+                osp.splitext(results['img_info']['filename'])[0] + '.png')
+            if osp.isfile(cache_file):
+                results['img'] = mmcv.imread(cache_file)
+                return results
         results['img'] = corrupt(
             results['img'].astype(np.uint8),
             corruption_name=self.corruption,
             severity=self.severity)
+        if cache_file is not None:
+            # written under another name first, the loader workers of
+            # several runs may write the same image and an interrupted run
+            # must not leave a partial one
+            tmp_file = '{}.{}.png'.format(
+                osp.splitext(cache_file)[0], os.getpid())
+            mmcv.imwrite(results['img'], tmp_file)
+            os.replace(tmp_file, cache_file)
         return results
 
     def __repr__(self):
         repr_str = self.__class__.__name__
-        repr_str += '(corruption={}, severity={})'.format(
-            self.corruption, self.severity)
+        repr_str += '(corruption={}, severity={}, cache_dir={})'.format(
+            self.corruption, self.severity, self.cache_dir)
         return repr_str
 
 
@@ -0,0 +1,330 @@
+import numpy as np
+from pycocotools.coco import COCO
+
+from mmcv_custom.keypoints import get_keypoints
+from .coco import CocoDataset
+from .coco_pose import CocoPoseDataset
+from .registry import DATASETS
+
+# COCO keypoints of a standing person of height 1, centered between the hips
+PERSON_TEMPLATE = np.array([
+    [0., -.42], [.03, -.45], [-.03, -.45], [.06, -.43], [-.06, -.43],
+    [.12, -.3], [-.12, -.3], [.16, -.12], [-.16, -.12], [.18, .03],
+    [-.18, .03], [.08, .03], [-.08, .03], [.09, .27], [-.09, .27],
+    [.09, .5], [-.09, .5]
+])
+# keypoints from the hips down, unlabeled on truncated persons
+LOWER_BODY = np.arange(11, 17)
+
+
+def rand_ints(rng, value, n):
+    """n ints, equal to `value` or random in the [min, max] range of a
+    tuple."""
+    if isinstance(value, int):
+        return np.full(n, value, dtype=np.int64)
+    return rng.randint(value[0], value[1] + 1, n)
+
+
+def rand_sizes(rng, size_range, n):
+    """n sizes log-uniformly distributed in the range."""
+    return np.exp(rng.uniform(*np.log(size_range), n))
+
+
+def random_polygons(rng, cx, cy, rx, ry, num_vertices, img_w, img_h):
+    """Star-shaped polygons around ellipses, clipped to the image.
+
+    Args:
+        cx, cy, rx, ry (ndarray): Centers and radii of the ellipses, shape
+            (m, ).
+        num_vertices (ndarray): Number of vertices of each polygon, at least
+            3, shape (m, ).
+
+    Returns:
+        tuple: The flattened polygons (x1, y1, x2, y2, ...) as lists, their
+            areas (m, ) and bboxes (m, 4) in the (x1, y1, x2, y2) format.
+    """
+    m = len(cx)
+    if m == 0:
+        return [], np.zeros(0), np.zeros((0, 4))
+    max_v = num_vertices.max()
+    valid = np.arange(max_v) < num_vertices[:, None]
+    # the angles of the padding vertices are sorted last
+    angles = np.sort(
+        np.where(valid, rng.uniform(0, 2 * np.pi, (m, max_v)), np.inf),
+        axis=1)
+    angles[~valid] = 0
+    radii = np.clip(1 + .15 * rng.randn(m, max_v), .5, 1.5)
+    xs = np.clip(cx[:, None] + rx[:, None] * radii * np.cos(angles), 0,
+                 img_w - 1)
+    ys = np.clip(cy[:, None] + ry[:, None] * radii * np.sin(angles), 0,
+                 img_h - 1)
+    nxt = (np.arange(max_v) + 1) % num_vertices[:, None]
+    xn = np.take_along_axis(xs, nxt, axis=1)
+    yn = np.take_along_axis(ys, nxt, axis=1)
+    areas = .5 * np.abs(((xs * yn - ys * xn) * valid).sum(axis=1))
+    bboxes = np.stack([
+        np.where(valid, xs, np.inf).min(axis=1),
+        np.where(valid, ys, np.inf).min(axis=1),
+        np.where(valid, xs, -np.inf).max(axis=1),
+        np.where(valid, ys, -np.inf).max(axis=1)
+    ],
+                      axis=1)
+    polygons = [
+        np.stack([x[:k], y[:k]], axis=1).ravel().tolist()
+        for x, y, k in zip(xs, ys, num_vertices)
+    ]
+    return polygons, areas, bboxes
+
+
+def valid_objects(areas, bboxes):
+    """Objects which are not empty, as the dataset filters them."""
+    return (areas > 0) & (bboxes[:, 2] - bboxes[:, 0] >= 1) & (
+        bboxes[:, 3] - bboxes[:, 1] >= 1)
+
+
+def xywh(bbox):
+    return [
+        float(bbox[0]),
+        float(bbox[1]),
+        float(bbox[2] - bbox[0]),
+        float(bbox[3] - bbox[1])
+    ]
+
+
+class SyntheticCocoMixin(object):
+    """Procedurally generated COCO annotations, see
+    :class:`SyntheticCocoDataset`.
+
+    The annotations of an image only depend on `seed` and its index, the
+    image is rendered by the `LoadSyntheticImage` pipeline from the
+    polygons kept in its info.
+    """
+
+    def load_annotations(self, ann_file):
+        images = []
+        annotations = []
+        for i in range(self.num_imgs):
+            rng = np.random.RandomState([self.seed, i])
+            if isinstance(self.img_scale, list):
+                img_w, img_h = self.img_scale[rng.randint(
+                    len(self.img_scale))]
+            else:
+                img_w, img_h = self.img_scale
+            img_id = i + 1
+            images.append(
+                dict(
+                    id=img_id,
+                    file_name='synthetic_{:08d}.jpg'.format(img_id),
+                    width=img_w,
+                    height=img_h,
+                    seed=[self.seed, i]))
+            num_objs = int(rand_ints(rng, self.num_objs, 1)[0])
+            anns = self.random_anns(rng, num_objs, img_w, img_h)
+            crowd = rng.rand(len(anns)) < self.crowd_ratio
+            for ann, iscrowd in zip(anns, crowd):
+                ann.update(
+                    id=len(annotations) + 1,
+                    image_id=img_id,
+                    iscrowd=int(iscrowd))
+                annotations.append(ann)
+        coco = COCO()
+        coco.dataset = dict(
+            images=images,
+            annotations=annotations,
+            categories=self.categories())
+        coco.createIndex()
+        img_infos = self.load_coco(coco)
+        for info in img_infos:
+            anns = coco.imgToAnns[info['id']]
+            info['polygons'] = [p for ann in anns for p in ann['segmentation']]
+        return img_infos
+
+
+@DATASETS.register_module
+class SyntheticCocoDataset(SyntheticCocoMixin, CocoDataset):
+    """A COCO detection dataset of random polygons, for benchmarks and tests
+    without any data on disk.
+
+    Args:
+        pipeline (list[dict]): Processing pipeline, starting with
+            `LoadSyntheticImage`.
+        num_imgs (int): Number of images.
+        img_scale (tuple | list[tuple]): (w, h) of the images, or a list to
+            pick from.
+        num_objs (int | tuple): Number of objects per image, or its
+            [min, max] range.
+        obj_size (tuple): Range of the object sizes.
+        num_vertices (int | tuple): Number of vertices per polygon.
+        num_parts (int | tuple): Number of polygons per object.
+        crowd_ratio (float): Probability of a crowd annotation.
+        seed (int): Seed of the generation.
+    """
+
+    def __init__(self,
+                 pipeline,
+                 num_imgs=100,
+                 img_scale=(640, 480),
+                 num_objs=(1, 20),
+                 obj_size=(16, 400),
+                 num_vertices=(8, 24),
+                 num_parts=1,
+                 crowd_ratio=0.,
+                 seed=0,
+                 **kwargs):
+        self.num_imgs = num_imgs
+        self.img_scale = img_scale
+        self.num_objs = num_objs
+        self.obj_size = obj_size
+        self.num_vertices = num_vertices
+        self.num_parts = num_parts
+        self.crowd_ratio = crowd_ratio
+        self.seed = seed
+        super(SyntheticCocoDataset, self).__init__(None, pipeline, **kwargs)
+
+    def categories(self):
+        return [
+            dict(id=i + 1, name=name, supercategory=name)
+            for i, name in enumerate(self.CLASSES)
+        ]
+
+    def random_anns(self, rng, n, img_w, img_h):
+        if n == 0:
+            return []
+        sizes = rand_sizes(rng, self.obj_size, n)
+        ratios = rand_sizes(rng, (.5, 2.), n)
+        rx, ry = sizes * np.sqrt(ratios) / 2, sizes / np.sqrt(ratios) / 2
+        cx, cy = rng.uniform(0, img_w, n), rng.uniform(0, img_h, n)
+        num_parts = rand_ints(rng, self.num_parts, n)
+        obj_inds = np.repeat(np.arange(n), num_parts)
+        first = np.ones(len(obj_inds), dtype=bool)
+        first[1:] = obj_inds[1:] != obj_inds[:-1]
+        # the other parts are smaller and around the first one
+        scales = np.where(first, 1., rng.uniform(.2, .5, len(obj_inds)))
+        dx, dy = np.where(first, 0., rng.uniform(-1, 1, (2, len(obj_inds))))
+        polygons, areas, bboxes = random_polygons(
+            rng, cx[obj_inds] + dx * rx[obj_inds],
+            cy[obj_inds] + dy * ry[obj_inds], rx[obj_inds] * scales,
+            ry[obj_inds] * scales,
+            rand_ints(rng, self.num_vertices, len(obj_inds)), img_w, img_h)
+        labels = rng.randint(len(self.CLASSES), size=n) + 1
+        anns = []
+        starts = np.nonzero(first)[0]
+        areas = np.add.reduceat(areas, starts)
+        bboxes = np.concatenate([
+            np.minimum.reduceat(bboxes[:, :2], starts),
+            np.maximum.reduceat(bboxes[:, 2:], starts)
+        ],
+                                axis=1)
+        ends = np.append(starts[1:], len(obj_inds))
+        for i in np.nonzero(valid_objects(areas, bboxes))[0]:
+            anns.append(
+                dict(
+                    category_id=int(labels[i]),
+                    segmentation=polygons[starts[i]:ends[i]],
+                    bbox=xywh(bboxes[i]),
+                    area=float(areas[i])))
+        return anns
+
+
+@DATASETS.register_module
+class SyntheticCocoPoseDataset(SyntheticCocoMixin, CocoPoseDataset):
+    """A COCO keypoints dataset of randomly posed persons, for benchmarks and
+    tests without any data on disk.
+
+    The persons are jittered, rotated and possibly mirrored copies of a
+    standing template, with a polygon around them.
+
+    Args:
+        pipeline (list[dict]): Processing pipeline, starting with
+            `LoadSyntheticImage`.
+        num_imgs (int): Number of images.
+        img_scale (tuple | list[tuple]): (w, h) of the images, or a list to
+            pick from.
+        num_persons (int | tuple): Number of persons per image, or its
+            [min, max] range.
+        person_size (tuple): Range of the person heights.
+        keypoint_visibility (tuple): Probabilities of a keypoint to be
+            visible (v=2) and occluded (v=1), it is unlabeled (v=0)
+            otherwise or out of the image.
+        truncation_ratio (float): Probability of a person without labeled
+            keypoints from the hips down.
+        num_vertices (int | tuple): Number of vertices of the polygons.
+        crowd_ratio (float): Probability of a crowd annotation.
+        seed (int): Seed of the generation.
+    """
+
+    def __init__(self,
+                 pipeline,
+                 num_imgs=100,
+                 img_scale=(640, 480),
+                 num_persons=(1, 20),
+                 person_size=(32, 400),
+                 keypoint_visibility=(.6, .25),
+                 truncation_ratio=.1,
+                 num_vertices=(8, 24),
+                 crowd_ratio=0.,
+                 seed=0,
+                 **kwargs):
+        self.num_imgs = num_imgs
+        self.img_scale = img_scale
+        self.num_objs = num_persons
+        self.person_size = person_size
+        self.keypoint_visibility = keypoint_visibility
+        self.truncation_ratio = truncation_ratio
+        self.num_vertices = num_vertices
+        self.crowd_ratio = crowd_ratio
+        self.seed = seed
+        super(SyntheticCocoPoseDataset, self).__init__(None, pipeline,
+                                                       **kwargs)
+
+    def categories(self):
+        keypoints, _ = get_keypoints()
+        return [
+            dict(
+                id=1,
+                name='person',
+                supercategory='person',
+                keypoints=keypoints,
+                skeleton=[])
+        ]
+
+    def random_anns(self, rng, n, img_w, img_h):
+        heights = rand_sizes(rng, self.person_size, n)
+        angles = rng.uniform(-.3, .3, n)
+        # mirrored when seen from the back
+        mirror = np.where(rng.rand(n) < .5, 1., -1.)
+        x = PERSON_TEMPLATE[:, 0] * mirror[:, None] + .03 * rng.randn(n, 17)
+        y = PERSON_TEMPLATE[:, 1] + .03 * rng.randn(n, 17)
+        cos, sin = np.cos(angles)[:, None], np.sin(angles)[:, None]
+        xs = (x * cos - y * sin) * heights[:, None] + rng.uniform(
+            0, img_w, (n, 1))
+        ys = (x * sin + y * cos) * heights[:, None] + rng.uniform(
+            0, img_h, (n, 1))
+
+        p_vis, p_occ = self.keypoint_visibility
+        r = rng.rand(n, 17)
+        v = np.where(r < p_vis, 2, np.where(r < p_vis + p_occ, 1, 0))
+        truncated = rng.rand(n) < self.truncation_ratio
+        v[np.ix_(truncated, LOWER_BODY)] = 0
+        v[(xs < 0) | (xs >= img_w) | (ys < 0) | (ys >= img_h)] = 0
+        labeled = v > 0
+        keypoints = np.stack([xs * labeled, ys * labeled, v], axis=2)
+
+        margins = .05 * heights
+        x1, x2 = xs.min(axis=1), xs.max(axis=1)
+        y1, y2 = ys.min(axis=1), ys.max(axis=1)
+        polygons, areas, bboxes = random_polygons(
+            rng, (x1 + x2) / 2, (y1 + y2) / 2, (x2 - x1) / 2 + margins,
+            (y2 - y1) / 2 + margins, rand_ints(rng, self.num_vertices, n),
+            img_w, img_h)
+        anns = []
+        for i in np.nonzero(valid_objects(areas, bboxes))[0]:
+            anns.append(
+                dict(
+                    category_id=1,
+                    segmentation=[polygons[i]],
+                    bbox=xywh(bboxes[i]),
+                    area=float(areas[i]),
+                    keypoints=keypoints[i].ravel().tolist(),
+                    num_keypoints=int(labeled[i].sum())))
+        return anns
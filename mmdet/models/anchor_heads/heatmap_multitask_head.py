@@ -35,7 +35,8 @@ class HeatmapMultitaskHead(nn.Module):
                  separate_out_conv=False,
                  with_offset=False,
                  conv_cfg=None,
-                 norm_cfg=None):
+                 norm_cfg=None,
+                 with_layers=True):
         super(HeatmapMultitaskHead, self).__init__()
         self.stacked_heat_convs = stacked_heat_convs
         self.stacked_offset_convs = stacked_offset_convs
@@ -60,8 +61,11 @@ class HeatmapMultitaskHead(nn.Module):
         self.deconv_num_kernels = deconv_num_kernels
         self.deconv_with_bias = deconv_with_bias
 
-        self._init_layers()
-        self.init_weights()
+        # without layers, the head only computes targets (see the
+        # ComputePointSetTargets pipeline stage)
+        if with_layers:
+            self._init_layers()
+            self.init_weights()
 
     def _get_deconv_cfg(self, deconv_kernel, index):
         if deconv_kernel == 4:
@@ -239,52 +243,59 @@ class HeatmapMultitaskHead(nn.Module):
             return multi_apply(self.forward_single, feats, range(len(self.stride)))
         return self.forward_single(feats)
 
+    def get_target_single(self, gt_keypoints, output_size, idx):
+        downsample = self.stride[idx]
+        output_h, output_w = output_size
+        kpt_num = gt_keypoints.shape[1]
+        keypoints_heat = gt_keypoints.new_zeros((kpt_num, output_h, output_w), dtype=torch.float32)
+        keypoints_heat_offset = None
+        keypoints_heat_offset_weight = None
+        if self.with_offset:
+            keypoints_heat_offset = gt_keypoints.new_zeros((kpt_num * 2, output_h, output_w),
+                                                           dtype=torch.float32)
+            keypoints_heat_offset_weight = gt_keypoints.new_zeros((kpt_num * 2, output_h, output_w),
+                                                                  dtype=torch.float32)
+        for i in range(len(gt_keypoints)):
+            keypoint = gt_keypoints[i].reshape(kpt_num, 3)
+            keypoint_visable = keypoint[keypoint[:, 2] > 0]
+            keypoint_visable = keypoint_visable[:, 0:2].reshape(1, -1)
+            bbox = pose2bbox_minmax(keypoint_visable)[0] / downsample
+            h, w = bbox[3] - bbox[1], bbox[2] - bbox[0]
+            if self.guassian_sigma:
+                radius = 3*self.guassian_sigma
+            else:
+                radius = gaussian_radius((torch.ceil(h), torch.ceil(w)))
+            radius = max(0, int(radius))
+
+            img_h = keypoints_heat.shape[-2] * downsample
+            img_w = keypoints_heat.shape[-1] * downsample
+            is_valid = (keypoint[:, 2] > 0) * (keypoint[:, 0] >= 0) * (keypoint[:, 0] < img_w) * (
+                        keypoint[:, 1] >= 0) * (keypoint[:, 1] < img_h)
+
+            kpts_int = (keypoint[:, :2] / downsample).to(torch.int32)
+            kpts_offset = (keypoint[:, :2] % downsample) / downsample
+            for j in range(kpt_num):
+                if is_valid[j]:
+                    pt_int = kpts_int[j]
+                    if self.with_offset:
+                        pt_offset = kpts_offset[j]
+                        x, y = int(pt_int[0]), int(pt_int[1])
+                        keypoints_heat_offset[2 * j:2 * j + 2][:, y, x] = pt_offset
+                        keypoints_heat_offset_weight[2 * j:2 * j + 2][:, y, x] = 1
+                    draw_gaussian(keypoints_heat[j], pt_int, radius)
+        return keypoints_heat, keypoints_heat_offset, keypoints_heat_offset_weight
+
     def get_target(self,
                    pred_heatmaps_batch,
                    gt_keypoints_list,
                    # gt_bboxes_list,
                    idx):
-        downsample = self.stride[idx]
         gt_heatmaps_batch = []
         gt_offset_batch = []
         gt_offset_weight_batch = []
         for pred_heatmaps, gt_keypoints in zip(pred_heatmaps_batch, gt_keypoints_list):
-            output_h, output_w = pred_heatmaps.shape[-2:]
-            kpt_num = gt_keypoints.shape[1]
-            keypoints_heat = gt_keypoints.new_zeros((kpt_num, output_h, output_w), dtype=torch.float32)
-            if self.with_offset:
-                keypoints_heat_offset = gt_keypoints.new_zeros((kpt_num * 2, output_h, output_w),
-                                                               dtype=torch.float32)
-                keypoints_heat_offset_weight = gt_keypoints.new_zeros((kpt_num * 2, output_h, output_w),
-                                                                      dtype=torch.float32)
-            for i in range(len(gt_keypoints)):
-                keypoint = gt_keypoints[i].reshape(kpt_num, 3)
-                keypoint_visable = keypoint[keypoint[:, 2] > 0]
-                keypoint_visable = keypoint_visable[:, 0:2].reshape(1, -1)
-                bbox = pose2bbox_minmax(keypoint_visable)[0] / downsample
-                h, w = bbox[3] - bbox[1], bbox[2] - bbox[0]
-                if self.guassian_sigma:
-                    radius = 3*self.guassian_sigma
-                else:
-                    radius = gaussian_radius((torch.ceil(h), torch.ceil(w)))
-                radius = max(0, int(radius))
-
-                img_h = keypoints_heat.shape[-2] * downsample
-                img_w = keypoints_heat.shape[-1] * downsample
-                is_valid = (keypoint[:, 2] > 0) * (keypoint[:, 0] >= 0) * (keypoint[:, 0] < img_w) * (
-                            keypoint[:, 1] >= 0) * (keypoint[:, 1] < img_h)
-
-                kpts_int = (keypoint[:, :2] / downsample).to(torch.int32)
-                kpts_offset = (keypoint[:, :2] % downsample) / downsample
-                for j in range(kpt_num):
-                    if is_valid[j]:
-                        pt_int = kpts_int[j]
-                        if self.with_offset:
-                            pt_offset = kpts_offset[j]
-                            x, y = int(pt_int[0]), int(pt_int[1])
-                            keypoints_heat_offset[2 * j:2 * j + 2][:, y, x] = pt_offset
-                            keypoints_heat_offset_weight[2 * j:2 * j + 2][:, y, x] = 1
-                        draw_gaussian(keypoints_heat[j], pt_int, radius)
+            keypoints_heat, keypoints_heat_offset, keypoints_heat_offset_weight = \
+                self.get_target_single(gt_keypoints, pred_heatmaps.shape[-2:], idx)
             gt_heatmaps_batch.append(keypoints_heat)
             if self.with_offset:
                 gt_offset_batch.append(keypoints_heat_offset)
@@ -296,6 +307,51 @@ class HeatmapMultitaskHead(nn.Module):
             return gt_heatmaps_batch, pred_heatmaps_batch, gt_offset_batch, gt_offset_weight_batch
         return gt_heatmaps_batch, pred_heatmaps_batch, None, None
 
+    def get_compact_targets(self, gt_keypoints, pad_shape):
+        """Targets of a single image, one dict per output stride.
+
+        Used by the `ComputePointSetTargets` pipeline stage. The heatmaps are
+        kept dense, the offsets only where their weights are set.
+        """
+        h, w = pad_shape[:2]
+        compact_targets = []
+        for idx, stride in enumerate(self.stride):
+            output_size = (int(np.ceil(h / stride)), int(np.ceil(w / stride)))
+            heat, offset, offset_weight = self.get_target_single(
+                gt_keypoints, output_size, idx)
+            targets = dict(heat=heat)
+            if self.with_offset:
+                offset_inds = offset_weight.nonzero()
+                targets['offset_inds'] = offset_inds
+                targets['offset'] = offset[tuple(offset_inds.t())]
+            compact_targets.append(targets)
+        return compact_targets
+
+    def get_target_from_compact(self, pred_heatmaps_batch, compact_targets,
+                                idx):
+        """Same as `get_target`, from the targets of `get_compact_targets`.
+
+        Returns None if the targets were computed for another output size,
+        e.g. for images padded to a larger batch shape.
+        """
+        output_size = pred_heatmaps_batch.shape[-2:]
+        if any(targets[idx]['heat'].shape[-2:] != output_size
+               for targets in compact_targets):
+            return None
+        device = pred_heatmaps_batch.device
+        gt_heatmaps_batch = torch.stack(
+            [targets[idx]['heat'] for targets in compact_targets]).to(device)
+        if not self.with_offset:
+            return gt_heatmaps_batch, pred_heatmaps_batch, None, None
+        gt_offset_batch = gt_heatmaps_batch.new_zeros(
+            (len(compact_targets), 2 * gt_heatmaps_batch.shape[1]) + tuple(output_size))
+        gt_offset_weight_batch = torch.zeros_like(gt_offset_batch)
+        for i, targets in enumerate(compact_targets):
+            offset_inds = tuple(targets[idx]['offset_inds'].to(device).t())
+            gt_offset_batch[i][offset_inds] = targets[idx]['offset'].to(device)
+            gt_offset_weight_batch[i][offset_inds] = 1
+        return gt_heatmaps_batch, pred_heatmaps_batch, gt_offset_batch, gt_offset_weight_batch
+
     def loss_single(self, gt_heat, gt_offset, gt_offset_weight, pred_heat, offset):
         assert pred_heat.size()[-2:] == gt_heat.size()[-2:]
         if self.loss_heatmap == 'focal_loss':
@@ -2,15 +2,17 @@ import torch
 import torch.nn as nn
 from mmcv.cnn import normal_init
 
-from mmdet.core import (force_fp32, multi_apply, point_set_anchor_target,
+from mmdet.core import (AnchorCache, force_fp32, multi_apply, point_set_anchor_target,
                         delta2bbox, delta2points, distdelta2points,
-                        get_corner_points_from_anchor_points)
+                        contour_point_layouts, get_corner_points_from_anchor_points,
+                        compact_target, compact_targets_to_levels)
 from mmdet.ops import ModulatedDeformConvPack
 
 from ..builder import build_loss
 from ..registry import HEADS
 from .anchor_head import AnchorHead
 from ..utils import ConvModule, Scale, bias_init_with_prob, build_norm_layer
+from ..utils.sparse_head import topk_anchor_inds, split_anchor_inds, conv2d_at
 from mmdet.ops.nms import nms_wrapper
 import numpy as np
 import math
@@ -31,7 +33,11 @@ class PointSetAnchorHead(AnchorHead):
                  loss_corner=None,
                  conv_cfg=None,
                  norm_cfg=None,
+                 with_layers=True,
                  **kwargs):
+        # without layers, the head only computes targets (see the
+        # ComputePointSetTargets pipeline stage)
+        self.with_layers = with_layers
         self.stacked_convs = stacked_convs
         self.octave_base_scale = octave_base_scale
         self.scales_per_octave = scales_per_octave
@@ -50,9 +56,13 @@ class PointSetAnchorHead(AnchorHead):
         self.loss_corner = build_loss(loss_corner) if loss_corner is not None else None
         self.loss_mask_type = loss_mask.type
         self.mask_binary = mask_binary
+        # anchors of the test shapes, see get_test_anchors
+        self.test_anchor_cache = AnchorCache()
 
 
     def _init_layers(self):
+        if not self.with_layers:
+            return
         self.relu = nn.ReLU(inplace=True)
         self.cls_convs = nn.ModuleList()
         self.reg_convs = nn.ModuleList()
@@ -119,7 +129,13 @@ class PointSetAnchorHead(AnchorHead):
         normal_init(self.anchor_points_mask, std=0.01)
         normal_init(self.anchor_points_corner, std=0.01)
 
-    def forward_single(self, x):
+    def forward(self, feats, sparse_topk=None):
+        return multi_apply(self.forward_single, feats, sparse_topk=sparse_topk)
+
+    def forward_single(self, x, sparse_topk=None):
+        # with sparse_topk, the bbox, corner and mask predictions are only
+        # computed for the anchors kept by nms_pre in get_bboxes, the others
+        # are 0
         cls_feat = x
         reg_feat = x
         mask_corner_feat = x
@@ -132,12 +148,40 @@ class PointSetAnchorHead(AnchorHead):
             mask_corner_feat = mask_corner_conv(mask_corner_feat)
 
         cls_score = self.anchor_points_cls(cls_feat)
-        bbox_pred = self.anchor_points_reg(reg_feat)
-        mask_pred = self.anchor_points_mask(mask_corner_feat)
-        corner_pred = self.anchor_points_corner(mask_corner_feat)
+        inds_list = None
+        if sparse_topk is not None:
+            inds_list = topk_anchor_inds(cls_score, self.cls_out_channels,
+                                         sparse_topk, self.use_sigmoid_cls)
+        if inds_list is None:
+            bbox_pred = self.anchor_points_reg(reg_feat)
+            mask_pred = self.anchor_points_mask(mask_corner_feat)
+            corner_pred = self.anchor_points_corner(mask_corner_feat)
+        else:
+            bbox_pred = self.sparse_pred(self.anchor_points_reg, reg_feat,
+                                         inds_list)
+            mask_pred = self.sparse_pred(self.anchor_points_mask,
+                                         mask_corner_feat, inds_list)
+            corner_pred = self.sparse_pred(self.anchor_points_corner,
+                                           mask_corner_feat, inds_list)
 
         return cls_score, bbox_pred, corner_pred, mask_pred
 
+    def sparse_pred(self, conv, feat, inds_list):
+        """Output of a prediction conv at the given anchors of each image,
+        0 elsewhere."""
+        num_imgs, _, h, w = feat.shape
+        pred = feat.new_zeros((num_imgs, conv.out_channels, h, w))
+        for img_id, inds in enumerate(inds_list):
+            ys, xs, anchor_ids = split_anchor_inds(inds, w, self.num_anchors)
+            # all the channels of a location are computed at once, as several
+            # anchors of a location are usually kept
+            locs = torch.unique(ys * w + xs)
+            loc_ys, loc_xs = locs // w, locs % w
+            pred[img_id][:, loc_ys, loc_xs] = conv2d_at(
+                feat[img_id], conv.weight, conv.bias, loc_ys, loc_xs,
+                conv.padding[0]).t()
+        return pred
+
 
     def generate_anchor_points(self,
                                anchors,
@@ -300,68 +344,77 @@ class PointSetAnchorHead(AnchorHead):
         return merged_gt_masks_list
 
 
-    def loss_single(self, cls_score, bbox_pred, corner_pred, mask_pred, labels, label_weights,
-                    bbox_targets, bbox_weights, mask_targets, mask_weights, mask_binary,
-                    corner_targets, corner_weights, contour_targets, anchors, anchor_points,
-                    num_total_samples, cfg):
+    def _loss_pos(self, loss_func, pred, pos_inds, targets, weights,
+                  num_total_samples):
+        # regression losses only see the positives, the other anchors have
+        # zero weights anyway
+        if pos_inds.numel() == 0:
+            return pred.sum() * 0
+        return loss_func(
+            pred[pos_inds], targets, weights, avg_factor=num_total_samples)
+
+    def loss_cls_levels(self, cls_scores, labels_list, label_weights_list, num_total_samples):
         '''
-        apply loss on each feature map
+        apply the classification loss on all feature maps in a single call
         '''
-        # classification loss
-        labels = labels.reshape(-1)
-        label_weights = label_weights.reshape(-1)
-        cls_score = cls_score.permute(0, 2, 3, 1).reshape(-1, self.cls_out_channels)
-        loss_cls = self.loss_cls(
+        cls_score = torch.cat([
+            cls_score.permute(0, 2, 3, 1).reshape(-1, self.cls_out_channels)
+            for cls_score in cls_scores
+        ])
+        labels = torch.cat([labels.reshape(-1) for labels in labels_list])
+        label_weights = torch.cat(
+            [label_weights.reshape(-1) for label_weights in label_weights_list])
+        return self.loss_cls(
             cls_score, labels, label_weights, avg_factor=num_total_samples)
+
+    def loss_single(self, bbox_pred, corner_pred, mask_pred,
+                    pos_inds, bbox_targets, bbox_weights, mask_targets, mask_weights, mask_binary,
+                    corner_targets, corner_weights, contour_targets,
+                    num_total_samples, cfg):
+        '''
+        apply the regression losses on each feature map, regression targets
+        are given for the positives (`pos_inds`) only
+        '''
         # bbx regression loss
-        bbox_targets = bbox_targets.reshape(-1, 4)
-        bbox_weights = bbox_weights.reshape(-1, 4)
         bbox_pred = bbox_pred.permute(0, 2, 3, 1).reshape(-1, 4)
-        loss_bbox = self.loss_bbox(
+        loss_bbox = self._loss_pos(
+            self.loss_bbox,
             bbox_pred,
+            pos_inds,
             bbox_targets,
             bbox_weights,
-            avg_factor=num_total_samples)
+            num_total_samples)
         # corner regression loss
-        corner_targets = corner_targets.reshape(-1, self.corner_out_channels)
-        corner_weights = corner_weights.reshape(-1, self.corner_out_channels)
         corner_pred = corner_pred.permute(0, 2, 3, 1).reshape(-1, self.corner_out_channels)
-        loss_corner = self.loss_corner(
+        loss_corner = self._loss_pos(
+            self.loss_corner,
             corner_pred,
+            pos_inds,
             corner_targets,
             corner_weights,
-            avg_factor=num_total_samples)
+            num_total_samples)
         # mask regression loss
-        mask_targets = mask_targets.reshape(-1, self.mask_out_channels)
-        mask_weights = mask_weights.reshape(-1, self.mask_out_channels)
-        mask_binary = mask_binary.reshape(-1, self.mask_out_channels)
         mask_pred = mask_pred.permute(0, 2, 3, 1).reshape(-1, self.mask_out_channels)
         if self.mask_binary:
             mask_weights = mask_weights * mask_binary
-        loss_mask = self.loss_mask(
+        loss_mask = self._loss_pos(
+            self.loss_mask,
             mask_pred,
+            pos_inds,
             mask_targets,
             mask_weights,
-            avg_factor=num_total_samples)
-        return loss_cls, loss_bbox, loss_corner, loss_mask
-
-    @force_fp32(apply_to=('cls_scores', 'bbox_preds', 'corner_preds', 'mask_preds'))
-    def loss(self,
-             cls_scores,
-             bbox_preds,
-             corner_preds,
-             mask_preds,
-             gt_bboxes,
-             gt_labels,
-             gt_masks,
-             img_metas,
-             cfg,
-             gt_bboxes_ignore=None):
-        featmap_sizes = [featmap.size()[-2:] for featmap in cls_scores]
-        assert len(featmap_sizes) == len(self.anchor_generators)
-
-        device = cls_scores[0].device
-
+            num_total_samples)
+        return loss_bbox, loss_corner, loss_mask
+
+    def get_targets(self,
+                    featmap_sizes,
+                    gt_bboxes,
+                    gt_labels,
+                    gt_masks,
+                    img_metas,
+                    cfg,
+                    gt_bboxes_ignore=None,
+                    device='cuda'):
         anchor_list, valid_flag_list = self.get_anchors(
             featmap_sizes, img_metas, device=device)
         anchor_points_list, anchor_points_count_list = \
@@ -370,7 +423,7 @@ class PointSetAnchorHead(AnchorHead):
                                      device=device)
         gt_masks = self.mask_points_merge(gt_masks)
         label_channels = self.cls_out_channels if self.use_sigmoid_cls else 1
-        cls_reg_targets = point_set_anchor_target(
+        return point_set_anchor_target(
             anchor_points_list,
             anchor_points_count_list,
             anchor_list,
@@ -387,23 +440,85 @@ class PointSetAnchorHead(AnchorHead):
             gt_masks_list=gt_masks,
             label_channels=label_channels,
             sampling=self.sampling)
+
+    def get_compact_targets(self,
+                            img_meta,
+                            cfg,
+                            gt_bboxes,
+                            gt_labels,
+                            gt_masks=None,
+                            gt_bboxes_ignore=None,
+                            **kwargs):
+        '''
+        targets of a single image on the feature maps of its padded shape,
+        used by the `ComputePointSetTargets` pipeline stage, see
+        `compact_target`. Returns None if the image has no valid anchor.
+        '''
+        h, w = img_meta['pad_shape'][:2]
+        featmap_sizes = [(int(np.ceil(h / stride)), int(np.ceil(w / stride)))
+                         for stride in self.anchor_strides]
+        cls_reg_targets = self.get_targets(
+            featmap_sizes, [gt_bboxes], [gt_labels], [gt_masks], [img_meta],
+            cfg,
+            gt_bboxes_ignore=None
+            if gt_bboxes_ignore is None else [gt_bboxes_ignore],
+            device=gt_bboxes.device)
         if cls_reg_targets is None:
             return None
-        (labels_list, label_weights_list, bbox_targets_list, bbox_weights_list,
-         mask_targets_list, mask_weights_list, mask_binary_list,
+        return compact_target(featmap_sizes, cls_reg_targets[0],
+                              cls_reg_targets[1], cls_reg_targets[2],
+                              list(cls_reg_targets[3:-2]),
+                              cls_reg_targets[-2], cls_reg_targets[-1])
+
+    @force_fp32(apply_to=('cls_scores', 'bbox_preds', 'corner_preds', 'mask_preds'))
+    def loss(self,
+             cls_scores,
+             bbox_preds,
+             corner_preds,
+             mask_preds,
+             gt_bboxes,
+             gt_labels,
+             gt_masks,
+             img_metas,
+             cfg,
+             gt_bboxes_ignore=None,
+             precomputed_targets=None):
+        '''
+        `precomputed_targets` are the targets of each image computed by
+        `get_compact_targets` (e.g. in the data workers), they are used
+        instead of computing the targets here when given
+        '''
+        featmap_sizes = [featmap.size()[-2:] for featmap in cls_scores]
+        assert len(featmap_sizes) == len(self.anchor_generators)
+
+        device = cls_scores[0].device
+
+        cls_reg_targets = None
+        if precomputed_targets is not None and \
+                all(t is not None for t in precomputed_targets):
+            cls_reg_targets = compact_targets_to_levels(
+                precomputed_targets, featmap_sizes,
+                self.anchor_generators[0].num_base_anchors, device)
+        if cls_reg_targets is None:
+            cls_reg_targets = self.get_targets(
+                featmap_sizes, gt_bboxes, gt_labels, gt_masks, img_metas, cfg,
+                gt_bboxes_ignore=gt_bboxes_ignore, device=device)
+        if cls_reg_targets is None:
+            return None
+        (labels_list, label_weights_list, pos_inds_list, bbox_targets_list,
+         bbox_weights_list, mask_targets_list, mask_weights_list, mask_binary_list,
          corner_targets_list, corner_weights_list, contour_targets_list,
-         anchor_list, anchor_points_list, num_total_pos, num_total_neg) \
-            = cls_reg_targets
+         num_total_pos, num_total_neg) = cls_reg_targets
         num_total_samples = (
             num_total_pos + num_total_neg if self.sampling else num_total_pos)
-        losses_cls, losses_bbox, losses_corner, losses_mask = multi_apply(
+        loss_cls = self.loss_cls_levels(cls_scores, labels_list, label_weights_list,
+                                        num_total_samples)
+        losses_bbox, losses_corner, losses_mask = multi_apply(
             self.loss_single,
-            cls_scores,
             bbox_preds,
             corner_preds,
             mask_preds,
-            labels_list,
-            label_weights_list,
+            pos_inds_list,
             bbox_targets_list,
             bbox_weights_list,
             mask_targets_list,
@@ -412,11 +527,9 @@ class PointSetAnchorHead(AnchorHead):
             corner_targets_list,
             corner_weights_list,
             contour_targets_list,
-            anchor_list,
-            anchor_points_list,
             num_total_samples=num_total_samples,
             cfg=cfg)
-        return dict(loss_cls=losses_cls, loss_bbox=losses_bbox,
+        return dict(loss_cls=loss_cls, loss_bbox=losses_bbox,
                     loss_corner=losses_corner, loss_mask=losses_mask)
 
     # inference
@@ -427,15 +540,9 @@ class PointSetAnchorHead(AnchorHead):
         device = cls_scores[0].device
         num_levels = len(cls_scores)
         featmap_sizes = [featmap.size()[-2:] for featmap in cls_scores]
-        anchor_list, valid_flag_list = self.get_anchors(
-            featmap_sizes, img_metas, device=device)
-        anchor_points_list, anchor_points_count_list =\
-            self.get_anchor_points(anchor_list,
-                                     self.anchor_points_number,
-                                     device=device)
-        mlvl_anchors = anchor_list[0]
-        mlvl_anchor_points = anchor_points_list[0]
-        mlvl_anchor_points_count = anchor_points_count_list[0]
+        mlvl_anchors, mlvl_anchor_points, mlvl_anchor_points_count, \
+            mlvl_layouts = self.get_test_anchors(
+                featmap_sizes, img_metas, device=device)
         # proposals for len(img_metas) images
         result_list = []
         for img_id in range(len(img_metas)):
@@ -456,11 +563,34 @@ class PointSetAnchorHead(AnchorHead):
             proposals = self.get_inference_res_single(cls_score_list, bbox_pred_list,
                                                       corner_pred_list, mask_pred_list,
                                                       mlvl_anchors, mlvl_anchor_points,
-                                                      mlvl_anchor_points_count, img_shape,
+                                                      mlvl_anchor_points_count, mlvl_layouts, img_shape,
                                                       scale_factor, cfg, rescale, nms)
             result_list.append(proposals)
         return result_list
 
+    def get_test_anchors(self, featmap_sizes, img_metas, device='cuda'):
+        """Anchors, anchor points and contour layouts (see
+        `contour_point_layouts`) of all levels for inference, cached by the
+        feature map sizes."""
+
+        def compute():
+            anchor_list, _ = self.get_anchors(
+                featmap_sizes, img_metas[:1], device=device)
+            anchor_points_list, anchor_points_count_list = \
+                self.get_anchor_points(anchor_list,
+                                       self.anchor_points_number,
+                                       device=device)
+            mlvl_layouts = [
+                contour_point_layouts(anchors, anchor_points_count,
+                                      self.anchor_points_number)
+                for anchors, anchor_points_count in zip(
+                    anchor_list[0], anchor_points_count_list[0])
+            ]
+            return (anchor_list[0], anchor_points_list[0],
+                    anchor_points_count_list[0], mlvl_layouts)
+
+        key = (tuple(tuple(size) for size in featmap_sizes), str(device))
+        return self.test_anchor_cache.get(key, compute)
 
     def get_inference_res_single(self,
                                  cls_score_list,
@@ -470,6 +600,7 @@ class PointSetAnchorHead(AnchorHead):
                                  mlvl_anchors,
                                  mlvl_anchor_points,
                                  mlvl_anchor_points_count,
+                                 mlvl_layouts,
                                  img_shape,
                                  scale_factor,
                                  cfg,
@@ -481,13 +612,13 @@ class PointSetAnchorHead(AnchorHead):
         assert len(cls_score_list) == len(bbox_pred_list) == \
                len(mask_pred_list) == len(corner_pred_list) ==\
                len(mlvl_anchors) == len(mlvl_anchor_points) ==\
-               len(mlvl_anchor_points_count)
+               len(mlvl_anchor_points_count) == len(mlvl_layouts)
         mlvl_bboxes = []
         mlvl_scores = []
         mlvl_masks = []
-        for cls_score, bbox_pred, corner_pred, mask_pred, anchors, anchor_points, anchor_points_count in \
+        for cls_score, bbox_pred, corner_pred, mask_pred, anchors, anchor_points, anchor_points_count, layouts in \
                 zip(cls_score_list, bbox_pred_list, corner_pred_list, mask_pred_list,
-                    mlvl_anchors, mlvl_anchor_points, mlvl_anchor_points_count):
+                    mlvl_anchors, mlvl_anchor_points, mlvl_anchor_points_count, mlvl_layouts):
             assert cls_score.size()[-2:] == bbox_pred.size()[-2:] == \
                    corner_pred.size()[-2:] == mask_pred.size()[-2:]
             cls_score = cls_score.permute(1, 2,
@@ -510,6 +641,7 @@ class PointSetAnchorHead(AnchorHead):
                 anchors = anchors[topk_inds, :]
                 anchor_points = anchor_points[topk_inds, :]
                 anchor_points_count = anchor_points_count[topk_inds, :]
+                layouts = [layout[topk_inds, :] for layout in layouts]
                 bbox_pred = bbox_pred[topk_inds, :]
                 corner_pred = corner_pred[topk_inds, :]
                 mask_pred = mask_pred[topk_inds, :]
@@ -519,7 +651,8 @@ class PointSetAnchorHead(AnchorHead):
             # corner decoding
             corner_points = get_corner_points_from_anchor_points(anchor_points)
             corners = delta2points(corner_points, anchors, corner_pred, 0, 1)
-            masks = distdelta2points(mask_pred, anchors, anchor_points, anchor_points_count, 0, 1)
+            masks = distdelta2points(mask_pred, anchors, anchor_points, anchor_points_count, 0, 1,
+                                     layouts=layouts)
             masks = self.point_ensemble(corners, masks, anchor_points_count, img_shape)
             mlvl_bboxes.append(bboxes)
             mlvl_masks.append(masks)
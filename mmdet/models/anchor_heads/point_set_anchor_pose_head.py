@@ -3,13 +3,16 @@ from __future__ import division
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from mmdet.ops import ModulatedDeformConv, DeformConv
 from mmcv.cnn import normal_init
 from mmdet.models.utils.norm import build_norm_layer
 from ..utils import ConvModule, bias_init_with_prob
+from ..utils.sparse_head import deform_conv2d_at, group_norm_stats, norm_at
 
-from mmdet.core import (TemplateGenerator, AnchorGenerator, template_target, force_fp32,
-                        multi_apply, kpts_nms, pose2bbox_minmax, delta2bbox)
+from mmdet.core import (TemplateGenerator, AnchorGenerator, AnchorCache, template_target, force_fp32,
+                        multi_apply, kpts_nms, pose2bbox_minmax, delta2bbox,
+                        compact_target, compact_targets_to_levels)
 from ..builder import build_loss
 from ..registry import HEADS
 from mmdet.ops.nms import nms_wrapper
@@ -268,6 +271,8 @@ class PointSetAnchorPoseHead(nn.Module):
                  feat_channels=256,
                  stacked_convs=4,
                  norm_cfg=dict(type='BN', requires_grad=True),
+                 fuse_towers=False,
+                 fuse_pred_convs=False,
                  # template/anchor
                  octave_base_scale=4,
                  scales_per_octave=3,
@@ -292,9 +297,9 @@ class PointSetAnchorPoseHead(nn.Module):
                      loss_weight=1.0),
                  loss_reg=dict(
                      type='SmoothL1Loss', beta=1.0 / 9.0, loss_weight=1.0),
-                 loss_bbox=dict(type='SmoothL1Loss', beta=0.11, loss_weight=1.0)
+                 loss_bbox=dict(type='SmoothL1Loss', beta=0.11, loss_weight=1.0),
                  # loss
-                 ):
+                 with_layers=True):
         super(PointSetAnchorPoseHead, self).__init__()
         self.in_channels = in_channels
         self.num_classes = num_classes
@@ -302,6 +307,10 @@ class PointSetAnchorPoseHead(nn.Module):
         self.stacked_convs = stacked_convs
         self.use_out_scale = use_out_scale
         self.norm_cfg = norm_cfg
+        # run the cls, reg and reg_bbx towers as a single grouped tower
+        self.fuse_towers = fuse_towers
+        # run the prediction convs of all the anchor shapes as one grouped conv
+        self.fuse_pred_convs = fuse_pred_convs
 
         self.use_shape_index_feature = use_shape_index_feature
         self.modulated_dcn = modulated_dcn
@@ -325,6 +334,13 @@ class PointSetAnchorPoseHead(nn.Module):
                 rot_temps.append(rotate_templates(self.templates, rot))
             self.templates = np.concatenate(rot_temps)
         self.anchor_generators = []
+        # anchors of the test shapes, see get_test_anchors
+        self.test_anchor_cache = AnchorCache()
+        # when set to a dict, the GN statistics of the shape aligned features
+        # of the first image are recorded in it by level index and norm layer
+        # (the levels share the norm layers), to evaluate the head on tracked
+        # poses of the next frames (see forward_track)
+        self.norm_stats = None
         # bbx anchor generators
         self.anchor_generators_bbx = []
         anchor_ratios = get_ratio_from_pose_template(self.templates)
@@ -350,7 +366,10 @@ class PointSetAnchorPoseHead(nn.Module):
         self.loss_bbox = build_loss(loss_bbox)
         self.fp16_enabled = False
 
-        self._init_layers()
+        # without layers, the head only computes targets (see the
+        # ComputePointSetTargets pipeline stage)
+        if with_layers:
+            self._init_layers()
 
     def _init_cls_and_reg_layers(self, num_anchors):
         conv_cls = nn.ModuleList()
@@ -363,6 +382,18 @@ class PointSetAnchorPoseHead(nn.Module):
             conv_reg_bbx.append(nn.Conv2d(channels, 4, 1))
         return conv_cls, conv_reg, conv_reg_bbx
 
+    def _init_fused_cls_and_reg_layers(self, num_anchors):
+        """The 1x1 prediction convs of the anchor shapes as one conv with
+        `num_anchors` groups per branch. Its output channels are those of
+        the shapes in order, as the concatenation of the separate convs."""
+        channels = self.feat_channels if self.use_shape_index_feature else self.in_channels
+        conv_cls = nn.Conv2d(channels * num_anchors, self.cls_out_channels * num_anchors, 1,
+                             groups=num_anchors)
+        conv_reg = nn.Conv2d(channels * num_anchors, 2 * TEMPLATE_POINTS_NUM * num_anchors, 1,
+                             groups=num_anchors)
+        conv_reg_bbx = nn.Conv2d(channels * num_anchors, 4 * num_anchors, 1, groups=num_anchors)
+        return conv_cls, conv_reg, conv_reg_bbx
+
     def _init_cls_and_reg_pre_layers(self, stacked_convs):
         cls_convs = nn.ModuleList()
         reg_convs = nn.ModuleList()
@@ -406,6 +437,31 @@ class PointSetAnchorPoseHead(nn.Module):
                 ))
         return cls_convs, reg_convs, reg_convs_bbx
 
+    def _init_fused_pre_layers(self, stacked_convs):
+        """The cls, reg and reg_bbx towers as one tower with 3 groups of
+        channels, in this order. The first conv reads the shared input, the
+        next ones are grouped convs, and the norm layers have 3 times the
+        groups of norm_cfg (GN groups are contiguous channels)."""
+        norm_cfg = self.norm_cfg
+        if norm_cfg is not None and norm_cfg['type'] == 'GN':
+            norm_cfg = dict(norm_cfg, num_groups=norm_cfg['num_groups'] * 3)
+        pre_convs = nn.ModuleList()
+        for i in range(stacked_convs):
+            pre_convs.append(
+                ConvModule(
+                    self.in_channels if i == 0 else self.in_channels * 3,
+                    self.in_channels * 3,
+                    3,
+                    stride=1,
+                    padding=1,
+                    groups=1 if i == 0 else 3,
+                    conv_cfg=None,
+                    norm_cfg=norm_cfg,
+                    activation='relu',
+                    inplace=False,
+                ))
+        return pre_convs
+
     def _init_shape_index_layers(self, num_anchors):
         shape_align_conv = nn.ModuleList()
         norm = nn.ModuleList()
@@ -436,19 +492,28 @@ class PointSetAnchorPoseHead(nn.Module):
     def _init_layers(self):
         self.relu = nn.ReLU(inplace=False)
 
-        self.conv_cls_list = nn.ModuleList()
-        self.conv_reg_list = nn.ModuleList()
-        self.conv_reg_bbx_list = nn.ModuleList()
-        conv_cls, conv_reg, conv_reg_bbx = self._init_cls_and_reg_layers(self.num_anchors)
-        self.conv_cls_list.append(conv_cls)
-        self.conv_reg_list.append(conv_reg)
-        self.conv_reg_bbx_list.append(conv_reg_bbx)
-        for i in range(len(self.anchor_strides) - 1):
+        if self.fuse_pred_convs:
+            # shared by all levels, as the separate convs below
+            self.conv_cls, self.conv_reg, self.conv_reg_bbx = \
+                self._init_fused_cls_and_reg_layers(self.num_anchors)
+        else:
+            self.conv_cls_list = nn.ModuleList()
+            self.conv_reg_list = nn.ModuleList()
+            self.conv_reg_bbx_list = nn.ModuleList()
+            conv_cls, conv_reg, conv_reg_bbx = self._init_cls_and_reg_layers(self.num_anchors)
             self.conv_cls_list.append(conv_cls)
             self.conv_reg_list.append(conv_reg)
             self.conv_reg_bbx_list.append(conv_reg_bbx)
+            for i in range(len(self.anchor_strides) - 1):
+                self.conv_cls_list.append(conv_cls)
+                self.conv_reg_list.append(conv_reg)
+                self.conv_reg_bbx_list.append(conv_reg_bbx)
 
-        self.pre_cls_convs, self.pre_reg_convs, self.pre_reg_bbx_convs = self._init_cls_and_reg_pre_layers(self.stacked_convs)
+        if self.fuse_towers:
+            self.pre_convs = self._init_fused_pre_layers(self.stacked_convs)
+        else:
+            self.pre_cls_convs, self.pre_reg_convs, self.pre_reg_bbx_convs = \
+                self._init_cls_and_reg_pre_layers(self.stacked_convs)
 
         if self.use_shape_index_feature:
             self.shape_align_conv_list, self.norm_list = self._init_shape_index_layers_pack()
@@ -457,18 +522,27 @@ class PointSetAnchorPoseHead(nn.Module):
             self.shape_align_conv_list_reg_bbx, self.norm_list_reg_bbx = self._init_shape_index_layers_pack()
 
     def init_weights(self):
-        for i in range(len(self.conv_cls_list)):
-            for j in range(len(self.conv_cls_list[i])):
-                normal_init(self.conv_cls_list[i][j], std=0.01)
-                normal_init(self.conv_reg_list[i][j], std=0.01)
-                normal_init(self.conv_reg_bbx_list[i][j], std=0.01)
-
-        for m in self.pre_cls_convs:
-            normal_init(m.conv, std=0.01)
-        for m in self.pre_reg_convs:
-            normal_init(m.conv, std=0.01)
-        for m in self.pre_reg_bbx_convs:
-            normal_init(m.conv, std=0.01)
+        if self.fuse_pred_convs:
+            normal_init(self.conv_cls, std=0.01)
+            normal_init(self.conv_reg, std=0.01)
+            normal_init(self.conv_reg_bbx, std=0.01)
+        else:
+            for i in range(len(self.conv_cls_list)):
+                for j in range(len(self.conv_cls_list[i])):
+                    normal_init(self.conv_cls_list[i][j], std=0.01)
+                    normal_init(self.conv_reg_list[i][j], std=0.01)
+                    normal_init(self.conv_reg_bbx_list[i][j], std=0.01)
+
+        if self.fuse_towers:
+            for m in self.pre_convs:
+                normal_init(m.conv, std=0.01)
+        else:
+            for m in self.pre_cls_convs:
+                normal_init(m.conv, std=0.01)
+            for m in self.pre_reg_convs:
+                normal_init(m.conv, std=0.01)
+            for m in self.pre_reg_bbx_convs:
+                normal_init(m.conv, std=0.01)
 
         if self.use_shape_index_feature:
             for i in range(len(self.norm_list)):
@@ -482,7 +556,11 @@ class PointSetAnchorPoseHead(nn.Module):
                     nn.init.constant_(self.norm_list_reg_bbx[i][j].weight, 1)
                     nn.init.constant_(self.norm_list_reg_bbx[i][j].bias, 0)
 
-    def forward_single(self, x, anchors_, valid_flags_, anchors_zero_, index):
+    def forward_single(self, x, anchors_, valid_flags_, anchors_zero_, index, with_reg_bbx=True):
+        # without with_reg_bbx, the bbox regression branch is skipped and
+        # reg_bbx_pred is None (e.g. at test time, see get_bboxes)
+        anchors_dcn = None
+        valid_flags = None
         if self.use_shape_index_feature:
             anchors = anchors_.clone()
             valid_flags = valid_flags_.clone()
@@ -491,53 +569,231 @@ class PointSetAnchorPoseHead(nn.Module):
             anchors_dcn = anchors_dcn.view((x.shape[0], x.shape[-2], x.shape[-1], -1, TEMPLATE_POINTS_NUM, 2))
             valid_flags = valid_flags.view((x.shape[0], x.shape[-2], x.shape[-1], -1, 1))
 
-            cls_feat = x
-            reg_feat = x
-            reg_bbx_feat = x
-            for cls_conv in self.pre_cls_convs:
-                cls_feat = cls_conv(cls_feat)
-            for reg_conv in self.pre_reg_convs:
-                reg_feat = reg_conv(reg_feat)
-            for reg_bbx_conv in self.pre_reg_bbx_convs:
-                reg_bbx_feat = reg_bbx_conv(reg_bbx_feat)
-            fea_cls = self.shape_align_single(
-                cls_feat, anchors_dcn, valid_flags, index, self.norm_list_cls, self.shape_align_conv_list_cls)
-            fea_reg = self.shape_align_single(
-                reg_feat, anchors_dcn, valid_flags, index, self.norm_list_reg, self.shape_align_conv_list_reg)
-            fea_reg_bbx = self.shape_align_single(
-                reg_bbx_feat, anchors_dcn, valid_flags, index, self.norm_list_reg_bbx, self.shape_align_conv_list_reg_bbx)
+        cls_feat, reg_feat, reg_bbx_feat = self.forward_towers(x, with_reg_bbx)
+        fea_cls = self.shape_feature(cls_feat, anchors_dcn, valid_flags, index,
+                                     self.norm_list_cls, self.shape_align_conv_list_cls)
+        cls_score = self.predict('conv_cls', fea_cls, index)
+
+        fea_reg = self.shape_feature(reg_feat, anchors_dcn, valid_flags, index,
+                                     self.norm_list_reg, self.shape_align_conv_list_reg)
+        reg_pred = self.predict('conv_reg', fea_reg, index)
+
+        reg_bbx_pred = None
+        if with_reg_bbx:
+            fea_reg_bbx = self.shape_feature(reg_bbx_feat, anchors_dcn, valid_flags, index,
+                                             self.norm_list_reg_bbx, self.shape_align_conv_list_reg_bbx)
+            reg_bbx_pred = self.predict('conv_reg_bbx', fea_reg_bbx, index)
+        return cls_score, reg_pred, reg_bbx_pred
+
+    def shape_feature(self, feat, anchors_dcn, valid_flags, index, norm_list, shape_align_conv_list):
+        """Features of each anchor shape, aligned to the shapes with
+        `use_shape_index_feature`."""
+        if self.use_shape_index_feature:
+            return self.shape_align_single(feat, anchors_dcn, valid_flags, index, norm_list,
+                                           shape_align_conv_list)
+        return [feat for _ in range(self.num_anchors)]
+
+    def predict(self, name, feats, index):
+        """Predictions of the branch `name` (e.g. 'conv_cls') for all the
+        anchor shapes, concatenated along the channels."""
+        if self.fuse_pred_convs:
+            return self.forward_fused_pred(getattr(self, name), feats)
+        conv_list = getattr(self, name + '_list')
+        return torch.cat([conv_list[index][n_shape](feats[n_shape])
+                          for n_shape in range(self.num_anchors)], dim=1)
+
+    def dcn_offsets(self, anchors_dcn, index):
+        """Offsets of `shape_align_single` for anchors of shape
+        (n, TEMPLATE_POINTS_NUM, 2), as (n, 2 * num_points)."""
+        offset = anchors_dcn / self.anchor_strides[index]
+        offset = offset[:, self.fea_point_index, :]
+        offset = torch.stack([offset[..., 1], offset[..., 0]], dim=-1)
+        return offset.view(offset.shape[0], -1) - self.dcn_base_offset.type_as(offset)
+
+    def shape_feature_at(self, feat, anchors_dcn, ys, xs, index, n_shape, norm_list,
+                         shape_align_conv_list, stat_feats=None, norm_stats=None):
+        """`shape_feature` of the anchor shape `n_shape` of a single image
+        (C, h, w) at some locations only, as (n, C).
+
+        The GN statistics are the ones of `stat_feats` (the shape aligned
+        features of other locations before the norm) or the ones recorded in
+        `norm_stats` (see `norm_stats` in `shape_align_single`).
+        """
+        if not self.use_shape_index_feature:
+            return feat[:, ys, xs].t()
+        conv = shape_align_conv_list[index][n_shape]
+        norm = norm_list[index][n_shape]
+        fea = deform_conv2d_at(feat, conv.weight, self.dcn_offsets(anchors_dcn, index), ys, xs,
+                               self.dcn_pad)
+        stats = norm_stats.get((index, norm)) if norm_stats is not None else None
+        return self.relu(norm_at(norm, fea, stat_feats, stats))
+
+    def predict_at(self, name, fea, index, n_shape):
+        """`predict` of the anchor shape `n_shape` for the features (n, C) of
+        some locations, as (n, channels)."""
+        if self.fuse_pred_convs:
+            conv = getattr(self, name)
+            channels = conv.out_channels // self.num_anchors
+            weight = conv.weight[n_shape * channels:(n_shape + 1) * channels]
+            bias = conv.bias[n_shape * channels:(n_shape + 1) * channels]
         else:
-            cls_feat = x
-            reg_feat = x
-            reg_bbx_feat = x
-            for cls_conv in self.pre_cls_convs:
-                cls_feat = cls_conv(cls_feat)
-            for reg_conv in self.pre_reg_convs:
-                reg_feat = reg_conv(reg_feat)
+            conv = getattr(self, name + '_list')[index][n_shape]
+            weight, bias = conv.weight, conv.bias
+        return fea.mm(weight.view(weight.size(0), -1).t()) + bias
+
+    def get_track_anchors(self, poses, featmap_sizes):
+        """Anchors of the refinement of poses tracked from a previous frame.
+
+        Each pose becomes the anchor of a single location, as the decoded
+        poses of the previous stage: its level and anchor shape are those of
+        the default anchor closest to it (normalized by the anchor scale), and
+        its location the one of its pelvis.
+
+        Args:
+            poses (Tensor): Poses in the coordinates of the input image,
+                shape (n, TEMPLATE_POINTS_NUM * 2).
+            featmap_sizes (list[tuple]): Feature map sizes of the levels.
+
+        Returns:
+            list[dict]: For each level, the indices of its poses (`inds`),
+                their locations (`ys`, `xs`), anchor shapes (`shapes`),
+                `anchors`, `anchors_zero` and `anchors_scales`.
+        """
+        pts = poses.view(-1, TEMPLATE_POINTS_NUM, 2)
+        pelvis = (pts[:, 11] + pts[:, 12]) / 2
+        costs = []
+        for generator in self.anchor_generators:
+            base = generator.base_anchors.type_as(poses).view(-1, TEMPLATE_POINTS_NUM, 2)
+            base_pelvis = (base[:, 11] + base[:, 12]) / 2
+            dists = ((pts - pelvis[:, None])[:, None] - (base - base_pelvis[:, None])[None]).norm(dim=-1)
+            costs.append(dists.mean(dim=-1) / generator.base_anchors_scales.type_as(poses).view(1, -1))
+        best = torch.cat(costs, dim=1).argmin(dim=1)
+
+        track_anchors = []
+        for index, generator in enumerate(self.anchor_generators):
+            inds = ((best >= index * self.num_anchors) &
+                    (best < (index + 1) * self.num_anchors)).nonzero().view(-1)
+            shapes = best[inds] - index * self.num_anchors
+            base = generator.base_anchors.type_as(poses).view(-1, TEMPLATE_POINTS_NUM, 2)[shapes]
+            base_pelvis = (base[:, 11] + base[:, 12]) / 2
+            stride = self.anchor_strides[index]
+            feat_h, feat_w = featmap_sizes[index]
+            loc = ((pelvis[inds] - base_pelvis) / stride).round().long()
+            xs = loc[:, 0].clamp(min=0, max=feat_w - 1)
+            ys = loc[:, 1].clamp(min=0, max=feat_h - 1)
+            anchors_zero = torch.stack([xs, ys], dim=-1).type_as(poses).repeat(1, TEMPLATE_POINTS_NUM) * stride
+            track_anchors.append(dict(
+                inds=inds, ys=ys, xs=xs, shapes=shapes, anchors=poses[inds],
+                anchors_zero=anchors_zero,
+                anchors_scales=generator.base_anchors_scales.type_as(poses)[shapes]))
+        return track_anchors
+
+    def forward_track(self, feats, track_anchors, norm_stats=None):
+        """Scores and pose regression of the anchors of `get_track_anchors`
+        for a single image, evaluated at their locations only.
+
+        The towers are run on the levels with anchors only. The GN statistics
+        of the shape aligned features are the ones of `norm_stats`, recorded
+        on a previous frame (see `norm_stats` in `shape_align_single`).
+
+        Returns:
+            tuple[Tensor]: cls_score (n, cls_out_channels) and reg_pred
+                (n, TEMPLATE_POINTS_NUM * 2), in the order of the poses given
+                to `get_track_anchors`.
+        """
+        num_poses = sum(level['inds'].numel() for level in track_anchors)
+        cls_score = feats[0].new_zeros((num_poses, self.cls_out_channels))
+        reg_pred = feats[0].new_zeros((num_poses, 2 * TEMPLATE_POINTS_NUM))
+        for index, (x, level) in enumerate(zip(feats, track_anchors)):
+            if level['inds'].numel() == 0:
+                continue
+            assert x.size(0) == 1
+            cls_feat, reg_feat, _ = self.forward_towers(x, with_reg_bbx=False)
+            anchors_dcn = (level['anchors'] - level['anchors_zero']).view(-1, TEMPLATE_POINTS_NUM, 2)
+            for n_shape in level['shapes'].unique().tolist():
+                sel = level['shapes'] == n_shape
+                inds, ys, xs = level['inds'][sel], level['ys'][sel], level['xs'][sel]
+                fea_cls = self.shape_feature_at(cls_feat[0], anchors_dcn[sel], ys, xs, index, n_shape,
+                                                self.norm_list_cls, self.shape_align_conv_list_cls,
+                                                norm_stats=norm_stats)
+                cls_score[inds] = self.predict_at('conv_cls', fea_cls, index, n_shape)
+                fea_reg = self.shape_feature_at(reg_feat[0], anchors_dcn[sel], ys, xs, index, n_shape,
+                                                self.norm_list_reg, self.shape_align_conv_list_reg,
+                                                norm_stats=norm_stats)
+                reg_pred[inds] = self.predict_at('conv_reg', fea_reg, index, n_shape)
+        return cls_score, reg_pred
+
+    @staticmethod
+    def forward_fused_pred(conv, feats):
+        """Apply a fused prediction conv to the features of each shape."""
+        if all(feat is feats[0] for feat in feats):
+            # the grouped weights are those of a conv over the shared feature
+            return F.conv2d(feats[0], conv.weight, conv.bias)
+        return conv(torch.cat(feats, dim=1))
+
+    def forward_towers(self, x, with_reg_bbx=True):
+        if self.fuse_towers:
+            # the reg_bbx channels of the grouped convs are computed anyway
+            feat = x
+            for conv in self.pre_convs:
+                feat = conv(feat)
+            return feat.chunk(3, dim=1)
+        cls_feat = x
+        reg_feat = x
+        reg_bbx_feat = x
+        for cls_conv in self.pre_cls_convs:
+            cls_feat = cls_conv(cls_feat)
+        for reg_conv in self.pre_reg_convs:
+            reg_feat = reg_conv(reg_feat)
+        if with_reg_bbx:
             for reg_bbx_conv in self.pre_reg_bbx_convs:
                 reg_bbx_feat = reg_bbx_conv(reg_bbx_feat)
-            fea_cls = []
-            for n_shape in range(self.num_anchors):
-                fea_cls.append(cls_feat)
-            fea_reg = []
-            for n_shape in range(self.num_anchors):
-                fea_reg.append(reg_feat)
-            fea_reg_bbx = []
-            for n_shape in range(self.num_anchors):
-                fea_reg_bbx.append(reg_bbx_feat)
-
-        cls_score = []
-        reg_pred = []
-        reg_bbx_pred = []
-        for n_shape in range(self.num_anchors):
-            cls_score.append(self.conv_cls_list[index][n_shape](fea_cls[n_shape]))
-            reg_pred.append(self.conv_reg_list[index][n_shape](fea_reg[n_shape]))
-            reg_bbx_pred.append(self.conv_reg_bbx_list[index][n_shape](fea_reg_bbx[n_shape]))
-
-        cls_score = torch.cat(cls_score, dim=1)
-        reg_pred = torch.cat(reg_pred, dim=1)
-        reg_bbx_pred = torch.cat(reg_bbx_pred, dim=1)
-        return cls_score, reg_pred, reg_bbx_pred
+        return cls_feat, reg_feat, reg_bbx_feat
+
+    def remap_state_dict(self, state_dict, prefix=''):
+        """Convert in place the weights of a checkpoint saved with the
+        separate towers or prediction convs to the layers of this head
+        (`fuse_towers`, `fuse_pred_convs`).
+
+        Called by `mmcv_custom.load_checkpoint`, and by
+        `_load_from_state_dict` for `load_state_dict`.
+        """
+        if self.fuse_pred_convs:
+            for branch in ['conv_cls', 'conv_reg', 'conv_reg_bbx']:
+                # the convs are shared by the levels, those of level 0 are kept
+                old_prefix = '{}{}_list.'.format(prefix, branch)
+                old_keys = [k for k in state_dict if k.startswith(old_prefix)]
+                if not old_keys:
+                    continue
+                for name in ['weight', 'bias']:
+                    # a KeyError, as for the towers, rather than leaving the
+                    # fused conv at its init when a shape is missing
+                    params = [
+                        state_dict['{}0.{}.{}'.format(old_prefix, n, name)]
+                        for n in range(self.num_anchors)
+                    ]
+                    state_dict['{}{}.{}'.format(prefix, branch, name)] = torch.cat(params)
+                for k in old_keys:
+                    state_dict.pop(k)
+        if not self.fuse_towers:
+            return
+        towers = ['pre_cls_convs', 'pre_reg_convs', 'pre_reg_bbx_convs']
+        for i in range(self.stacked_convs):
+            old_prefix = '{}{}.{}.'.format(prefix, towers[0], i)
+            for key in [k for k in state_dict if k.startswith(old_prefix)]:
+                name = key[len(old_prefix):]
+                params = [
+                    state_dict.pop('{}{}.{}.{}'.format(prefix, tower, i, name))
+                    for tower in towers
+                ]
+                # e.g. num_batches_tracked of BN
+                fused = params[0] if params[0].dim() == 0 else torch.cat(params)
+                state_dict['{}pre_convs.{}.{}'.format(prefix, i, name)] = fused
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self.remap_state_dict(state_dict, prefix)
+        super(PointSetAnchorPoseHead, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
 
     def shape_align_single(self, x, anchor, valid_flag, index, norm_list, shape_align_conv_list):
         stride = self.anchor_strides[index]
@@ -558,20 +814,23 @@ class PointSetAnchorPoseHead(nn.Module):
             _off = off.clone()
             mask = _off.new_ones(_off.shape)
             if self.modulated_dcn:
-                a_fea = self.relu(norm_list[index][n_shape](
-                    shape_align_conv_list[index][n_shape](x, _off, mask)))
+                a_fea = shape_align_conv_list[index][n_shape](x, _off, mask)
             else:
-                a_fea = self.relu(norm_list[index][n_shape](
-                    shape_align_conv_list[index][n_shape](x, _off)))
+                a_fea = shape_align_conv_list[index][n_shape](x, _off)
+            norm = norm_list[index][n_shape]
+            if self.norm_stats is not None and isinstance(norm, nn.GroupNorm):
+                self.norm_stats[(index, norm)] = group_norm_stats(
+                    norm, a_fea[0].detach().view(a_fea.size(1), -1).t())
+            a_fea = self.relu(norm(a_fea))
             aligned_fea.append(a_fea)
         return aligned_fea
 
-    def forward(self, feats, anchor_list, valid_flag_list, anchor_zero_list):
+    def forward(self, feats, anchor_list, valid_flag_list, anchor_zero_list, with_reg_bbx=True):
         anchor_list = permute_first_second(anchor_list)
         valid_flag_list = permute_first_second(valid_flag_list)
         anchor_zero_list = permute_first_second(anchor_zero_list)
         return multi_apply(self.forward_single, feats, anchor_list, valid_flag_list, anchor_zero_list,
-                           range(len(feats)))
+                           range(len(feats)), with_reg_bbx=with_reg_bbx)
 
     def get_anchors(self, featmap_sizes, img_metas, device='cuda'):
         num_imgs = len(img_metas)
@@ -616,56 +875,72 @@ class PointSetAnchorPoseHead(nn.Module):
 
         return anchor_list, anchor_bbx_list, valid_flag_list, anchor_zero_list, anchor_scale_list
 
-    def loss_single(self, cls_score, reg_pred, reg_bbx_pred, labels, label_weights,
-                    reg_targets, reg_weights, reg_bbx_targets, reg_bbx_weights, anchors, anchor_scales, num_total_samples, cfg):
-        # classification loss
-        labels = labels.reshape(-1)
-        label_weights = label_weights.reshape(-1)
-        cls_score = cls_score.permute(0, 2, 3,
-                                      1).reshape(-1, self.cls_out_channels)
-        loss_cls = self.loss_cls(
+    def get_test_anchors(self, featmap_sizes, img_metas, device='cuda'):
+        """Same as `get_anchors`, cached by the feature map sizes and the
+        padded image shapes for inference."""
+        key = (tuple(tuple(size) for size in featmap_sizes),
+               tuple(tuple(img_meta['pad_shape']) for img_meta in img_metas), str(device))
+        return self.test_anchor_cache.get(
+            key, lambda: self.get_anchors(featmap_sizes, img_metas, device=device))
+
+    def _loss_pos(self, loss_func, pred, pos_inds, targets, weights,
+                  num_total_samples):
+        # regression losses only see the positives, the other anchors have
+        # zero weights anyway
+        if pos_inds.numel() == 0:
+            return pred.sum() * 0
+        return loss_func(
+            pred[pos_inds], targets, weights, avg_factor=num_total_samples)
+
+    def loss_cls_levels(self, cls_scores, labels_list, label_weights_list, num_total_samples):
+        """Classification loss of all levels in a single call."""
+        cls_score = torch.cat([
+            cls_score.permute(0, 2, 3, 1).reshape(-1, self.cls_out_channels)
+            for cls_score in cls_scores
+        ])
+        labels = torch.cat([labels.reshape(-1) for labels in labels_list])
+        label_weights = torch.cat(
+            [label_weights.reshape(-1) for label_weights in label_weights_list])
+        return self.loss_cls(
             cls_score, labels, label_weights, avg_factor=num_total_samples)
+
+    def loss_single(self, reg_pred, reg_bbx_pred, pos_inds, reg_targets, reg_weights,
+                    reg_bbx_targets, reg_bbx_weights, num_total_samples, cfg):
         # regression loss
-        reg_targets = reg_targets.reshape(-1, 2 * TEMPLATE_POINTS_NUM)
-        reg_weights = reg_weights.reshape(-1, 2 * TEMPLATE_POINTS_NUM)
         reg_pred = reg_pred.permute(0, 2, 3, 1).reshape(-1, 2 * TEMPLATE_POINTS_NUM)
-        loss_reg = self.loss_reg(
+        loss_reg = self._loss_pos(
+            self.loss_reg,
             reg_pred,
+            pos_inds,
             reg_targets,
             reg_weights,
-            avg_factor=num_total_samples)
+            num_total_samples)
         # bbx regression loss
-        reg_bbx_targets = reg_bbx_targets.reshape(-1, 4)
-        reg_bbx_weights = reg_bbx_weights.reshape(-1, 4)
         reg_bbx_pred = reg_bbx_pred.permute(0, 2, 3, 1).reshape(-1, 4)
-        loss_bbx = self.loss_bbox(
+        loss_bbx = self._loss_pos(
+            self.loss_bbox,
             reg_bbx_pred,
+            pos_inds,
             reg_bbx_targets,
             reg_bbx_weights,
-            avg_factor=num_total_samples)
-        return loss_cls, loss_reg, loss_bbx
-
-    @force_fp32(apply_to=('cls_scores', 'reg_preds', 'reg_bbx_preds'))
-    def loss(self,
-             cls_scores,
-             reg_preds,
-             reg_bbx_preds,
-             gt_labels,
-             img_metas,
-             cfg,
-             gt_keypoints=None,
-             gt_bboxes=None,
-             out_anchor_list=None,
-             out_anchor_bbx_list=None,
-             out_valid_flag_list=None,
-             out_anchor_scale_list=None,
-             gt_bboxes_ignore=None
-             ):
-        featmap_sizes = [featmap.size()[-2:] for featmap in cls_scores]
-        assert len(featmap_sizes) == len(self.anchor_generators)
-
-        device = cls_scores[0].device
-
+            num_total_samples)
+        return loss_reg, loss_bbx
+
+    def get_targets(self,
+                    featmap_sizes,
+                    gt_labels,
+                    img_metas,
+                    cfg,
+                    gt_keypoints=None,
+                    gt_bboxes=None,
+                    out_anchor_list=None,
+                    out_anchor_bbx_list=None,
+                    out_valid_flag_list=None,
+                    out_anchor_scale_list=None,
+                    gt_bboxes_ignore=None,
+                    device='cuda',
+                    assign_candidates=None,
+                    return_assign_candidates=False):
         if out_anchor_list is None:
             anchor_list, anchor_bbx_list, valid_flag_list, anchor_zero_list, anchor_scale_list = self.get_anchors(
                 featmap_sizes, img_metas, device=device)
@@ -683,7 +958,7 @@ class PointSetAnchorPoseHead(nn.Module):
             'point_anchor_dim': self.anchor_generators[0].base_anchors.shape[1]
         }
 
-        cls_reg_targets = template_target(
+        return template_target(
             anchor_list,
             anchor_bbx_list,
             anchor_scale_list,
@@ -699,46 +974,135 @@ class PointSetAnchorPoseHead(nn.Module):
             cfg,
             gt_labels_list=gt_labels,
             label_channels=label_channels,
-            sampling=self.sampling)
+            sampling=self.sampling,
+            assign_candidates_list=assign_candidates,
+            return_assign_candidates=return_assign_candidates)
+
+    def get_compact_targets(self,
+                            img_meta,
+                            cfg,
+                            gt_bboxes,
+                            gt_labels,
+                            gt_keypoints=None,
+                            gt_bboxes_ignore=None,
+                            **kwargs):
+        """Targets of a single image on the feature maps of its padded shape.
+
+        Used by the `ComputePointSetTargets` pipeline stage to compute the
+        targets of the default anchors in the data workers, see
+        :func:`compact_target`. Returns None if the image has no valid anchor.
+        """
+        h, w = img_meta['pad_shape'][:2]
+        featmap_sizes = [(int(np.ceil(h / stride)), int(np.ceil(w / stride)))
+                         for stride in self.anchor_strides]
+        cls_reg_targets = self.get_targets(
+            featmap_sizes, [gt_labels], [img_meta],
+            cfg,
+            gt_keypoints=[gt_keypoints],
+            gt_bboxes=[gt_bboxes],
+            gt_bboxes_ignore=None
+            if gt_bboxes_ignore is None else [gt_bboxes_ignore],
+            device=gt_bboxes.device)
+        if cls_reg_targets is None:
+            return None
+        (labels_list, label_weights_list, pos_inds_list, reg_targets_list,
+         reg_weights_list, reg_bbx_targets_list, reg_bbx_weights_list,
+         num_total_pos, num_total_neg) = cls_reg_targets
+        return compact_target(
+            featmap_sizes, labels_list, label_weights_list, pos_inds_list,
+            [reg_targets_list, reg_weights_list, reg_bbx_targets_list,
+             reg_bbx_weights_list], num_total_pos, num_total_neg)
+
+    @force_fp32(apply_to=('cls_scores', 'reg_preds', 'reg_bbx_preds'))
+    def loss(self,
+             cls_scores,
+             reg_preds,
+             reg_bbx_preds,
+             gt_labels,
+             img_metas,
+             cfg,
+             gt_keypoints=None,
+             gt_bboxes=None,
+             out_anchor_list=None,
+             out_anchor_bbx_list=None,
+             out_valid_flag_list=None,
+             out_anchor_scale_list=None,
+             gt_bboxes_ignore=None,
+             precomputed_targets=None,
+             assign_candidates=None,
+             return_assign_candidates=False
+             ):
+        """
+        `precomputed_targets` are the targets of the default anchors of each
+        image computed by `get_compact_targets` (e.g. in the data workers),
+        they are used instead of computing the targets here when given.
+
+        `assign_candidates` are the (gt, anchor) candidate pairs of each image
+        returned by the loss of the previous stage: only the OKS of those
+        pairs is computed to assign the refined anchors, the others are taken
+        as 0. With `return_assign_candidates`, the candidates of this stage
+        are returned with the losses (None if precomputed targets are used).
+        """
+        featmap_sizes = [featmap.size()[-2:] for featmap in cls_scores]
+        assert len(featmap_sizes) == len(self.anchor_generators)
+
+        device = cls_scores[0].device
+
+        cls_reg_targets = None
+        candidates = None
+        if precomputed_targets is not None and \
+                all(t is not None for t in precomputed_targets):
+            cls_reg_targets = compact_targets_to_levels(
+                precomputed_targets, featmap_sizes,
+                self.anchor_generators[0].num_base_anchors, device)
+        if cls_reg_targets is None:
+            cls_reg_targets = self.get_targets(
+                featmap_sizes,
+                gt_labels,
+                img_metas,
+                cfg,
+                gt_keypoints=gt_keypoints,
+                gt_bboxes=gt_bboxes,
+                out_anchor_list=out_anchor_list,
+                out_anchor_bbx_list=out_anchor_bbx_list,
+                out_valid_flag_list=out_valid_flag_list,
+                out_anchor_scale_list=out_anchor_scale_list,
+                gt_bboxes_ignore=gt_bboxes_ignore,
+                device=device,
+                assign_candidates=assign_candidates,
+                return_assign_candidates=return_assign_candidates)
+            if cls_reg_targets is not None and return_assign_candidates:
+                candidates = cls_reg_targets[-1]
+                cls_reg_targets = cls_reg_targets[:-1]
         if cls_reg_targets is None:
             return None
-        (labels_list, label_weights_list, reg_targets_list, reg_weights_list,
-         reg_bbx_targets_list, reg_bbx_weights_list,
-         num_total_pos, num_total_neg, num_pos_list, num_neg_list) = cls_reg_targets
-        new_anchor_list = []
-        new_anchor_scale_list = []
-        sum_length = 0
-        for i in range(len(reg_targets_list)):
-            length = reg_targets_list[i].shape[1]
-            new_anchor = torch.cat([anchor_list[j][sum_length:sum_length+length] for j in range(len(anchor_list))], dim=0)
-            new_anchor_scale = torch.cat([anchor_scale_list[j][sum_length:sum_length+length] for j in range(len(anchor_scale_list))], dim=0)
-            sum_length += length
-            new_anchor_list.append(new_anchor)
-            new_anchor_scale_list.append(new_anchor_scale)
+        (labels_list, label_weights_list, pos_inds_list, reg_targets_list,
+         reg_weights_list, reg_bbx_targets_list, reg_bbx_weights_list,
+         num_total_pos, num_total_neg) = cls_reg_targets
 
         num_total_samples = (
             num_total_pos + num_total_neg if self.sampling else num_total_pos)
-        losses_cls, losses_reg, losses_bbx = multi_apply(
+        loss_cls = self.loss_cls_levels(cls_scores, labels_list, label_weights_list,
+                                        num_total_samples)
+        losses_reg, losses_bbx = multi_apply(
             self.loss_single,
-            cls_scores,
             reg_preds,
             reg_bbx_preds,
-            labels_list,
-            label_weights_list,
+            pos_inds_list,
             reg_targets_list,
             reg_weights_list,
             reg_bbx_targets_list,
             reg_bbx_weights_list,
-            new_anchor_list,
-            new_anchor_scale_list,
             num_total_samples=num_total_samples,
             cfg=cfg)
 
         loss_dict_all = {
-            'loss_cls': losses_cls,
+            'loss_cls': loss_cls,
             'loss_reg': losses_reg,
             'loss_bbx': losses_bbx,
         }
+        if return_assign_candidates:
+            return loss_dict_all, candidates
         return loss_dict_all
 
     @force_fp32(apply_to=('cls_scores', 'reg_preds', 'heat_preds'))
@@ -788,16 +1152,22 @@ class PointSetAnchorPoseHead(nn.Module):
             reg_pred_list = [
                 reg_preds[i][img_id].detach() for i in range(num_levels)
             ]
+            # the bbox regression and the heatmaps are not computed when
+            # they are not used, see PointSetAnchorPoseDetector.used_outputs
             reg_bbx_pred_list = [
-                reg_bbx_preds[i][img_id].detach() for i in range(num_levels)
+                reg_bbx_preds[i][img_id].detach()
+                if reg_bbx_preds[i] is not None else None
+                for i in range(num_levels)
             ]
             # use lowest heatmap
             heat_pred_list = [
-                heat_preds[0][img_id].detach() for i in range(num_levels)
+                heat_preds[0][img_id].detach() if heat_preds is not None else None
+                for i in range(num_levels)
             ]
             # use lowest heatmap
             offset_pred_list = [
-                offset_preds[0][img_id].detach() for i in range(num_levels)
+                offset_preds[0][img_id].detach() if offset_preds is not None else None
+                for i in range(num_levels)
             ]
             
             img_shape = img_metas[img_id]['img_shape']
@@ -815,6 +1185,26 @@ class PointSetAnchorPoseHead(nn.Module):
             return anchor_list, anchor_bbx_list
         return result_list
 
+    def decode_poses(self, anchors, anchors_scales, reg_pred, heat_pred, offset_pred, img_shape,
+                     use_heatmap=False):
+        """Poses of the anchors from the regression (n, 2 * TEMPLATE_POINTS_NUM),
+        refined by the heatmaps with `use_heatmap` and clamped to the image."""
+        poses = delta2template(anchors, anchors_scales, reg_pred, self.target_means,
+                               self.target_stds, img_shape, self.use_out_scale)
+        if use_heatmap:
+            stride = int((img_shape[0] + 31)//32 * 32)/heat_pred.shape[1]
+            poses = absorb_heatmap(poses, heat_pred, offset_pred, stride)
+
+        xxx = []
+        yyy = []
+        for n in range(0, TEMPLATE_POINTS_NUM):
+            xxx.append(poses[:, n * 2].clamp(min=0, max=img_shape[1]))
+            yyy.append(poses[:, n * 2 + 1].clamp(min=0, max=img_shape[0]))
+        poses = torch.stack([xxx[0], yyy[0]], dim=-1)
+        for n in range(1, TEMPLATE_POINTS_NUM):
+            poses = torch.cat([poses, torch.stack([xxx[n], yyy[n]], dim=-1)], dim=-1)
+        return poses
+
     def get_bboxes_single(self,
                           cls_score_list,
                           reg_pred_list,
@@ -851,7 +1241,8 @@ class PointSetAnchorPoseHead(nn.Module):
             else:
                 scores = cls_score.softmax(-1)
             reg_pred = reg_pred.permute(1, 2, 0).reshape(-1, 2 * TEMPLATE_POINTS_NUM)
-            reg_bbx_pred = reg_bbx_pred.permute(1, 2, 0).reshape(-1, 4)
+            if use_predict_bbx:
+                reg_bbx_pred = reg_bbx_pred.permute(1, 2, 0).reshape(-1, 4)
             nms_pre = cfg.get('nms_pre', -1)
             if nms_pre > 0 and scores.shape[0] > nms_pre and not get_nextstage_anchor:
                 if self.use_sigmoid_cls:
@@ -863,28 +1254,17 @@ class PointSetAnchorPoseHead(nn.Module):
                 bbx_anchors = bbx_anchors[topk_inds, :]
                 anchors_scales = anchors_scales[topk_inds, :]
                 reg_pred = reg_pred[topk_inds, :]
-                reg_bbx_pred = reg_bbx_pred[topk_inds, :]
+                if use_predict_bbx:
+                    reg_bbx_pred = reg_bbx_pred[topk_inds, :]
                 scores = scores[topk_inds, :]
                 
-            poses = delta2template(anchors, anchors_scales, reg_pred, self.target_means,
-                                   self.target_stds, img_shape, self.use_out_scale)
             #(1000, 34)
             # bbx encoding
-            bboxes = delta2bbox(bbx_anchors, reg_bbx_pred, [0, 0, 0, 0], [1, 1, 1, 1], img_shape)
+            if use_predict_bbx:
+                bboxes = delta2bbox(bbx_anchors, reg_bbx_pred, [0, 0, 0, 0], [1, 1, 1, 1], img_shape)
             # clamp pose points, bbx has been clamped in delta2bbx function
-
-            if use_heatmap:
-                stride = int((img_shape[0] + 31)//32 * 32)/heat_pred.shape[1]
-                poses = absorb_heatmap(poses, heat_pred, offset_pred, stride)
-            
-            xxx = []
-            yyy = []
-            for n in range(0, TEMPLATE_POINTS_NUM):
-                xxx.append(poses[:, n * 2].clamp(min=0, max=img_shape[1]))
-                yyy.append(poses[:, n * 2 + 1].clamp(min=0, max=img_shape[0]))
-            poses = torch.stack([xxx[0], yyy[0]], dim=-1)
-            for n in range(1, TEMPLATE_POINTS_NUM):
-                poses = torch.cat([poses, torch.stack([xxx[n], yyy[n]], dim=-1)], dim=-1)
+            poses = self.decode_poses(anchors, anchors_scales, reg_pred, heat_pred, offset_pred,
+                                      img_shape, use_heatmap)
 
             if not use_predict_bbx:
                 bboxes = pose2bbox_minmax(poses)
@@ -6,7 +6,8 @@ import numpy as np
 import pycocotools.mask as maskUtils
 import torch.nn as nn
 
-from mmdet.core import auto_fp16, get_classes, tensor2imgs
+from mmdet.core import (auto_fp16, get_classes, normalize_img_batch,
+                        tensor2imgs)
 
 
 class BaseDetector(nn.Module):
@@ -103,7 +104,6 @@ class BaseDetector(nn.Module):
         else:
             return self.aug_test(imgs, img_metas, **kwargs)
 
-    @auto_fp16(apply_to=('img', ))
     def forward(self, img, img_meta, return_loss=True, **kwargs):
         """
         Calls either forward_train or forward_test depending on whether
@@ -112,7 +112,21 @@ class BaseDetector(nn.Module):
         Tensor and List[dict]), and when `resturn_loss=True`, img and img_meta
         should be double nested (i.e.  List[Tensor], List[List[dict]]), with
         the outer list indicating test time augmentations.
+
+        uint8 images produced by `Normalize(on_device=True)` are normalized
+        here, on the device of the model, before anything else runs.
         """
+        if isinstance(img, list):
+            img = [
+                normalize_img_batch(_img, _img_meta)
+                for _img, _img_meta in zip(img, img_meta)
+            ]
+        else:
+            img = normalize_img_batch(img, img_meta)
+        return self._forward(img, img_meta, return_loss=return_loss, **kwargs)
+
+    @auto_fp16(apply_to=('img', ))
+    def _forward(self, img, img_meta, return_loss=True, **kwargs):
         if return_loss:
             return self.forward_train(img, img_meta, **kwargs)
         else:
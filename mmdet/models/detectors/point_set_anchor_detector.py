@@ -1,4 +1,5 @@
-from mmdet.core import bbox_mapping_back
+from mmdet.core import (bbox_mapping_back, batch_aug_imgs, prune_aug_candidates,
+                        shift_points, tile_img_metas, tile_windows)
 from ..registry import DETECTORS
 from .single_stage import SingleStageDetector
 import numpy as np
@@ -30,44 +31,151 @@ class PointSetAnchorDetector(SingleStageDetector):
                       gt_bboxes,
                       gt_labels,
                       gt_masks,
-                      gt_bboxes_ignore=None):
+                      gt_bboxes_ignore=None,
+                      point_set_targets=None):
         x = self.extract_feat(img)
         outs = self.bbox_head(x)
         loss_inputs = outs + (gt_bboxes, gt_labels, gt_masks, img_metas, self.train_cfg)
         losses = self.bbox_head.loss(
-            *loss_inputs, gt_bboxes_ignore=gt_bboxes_ignore)
+            *loss_inputs, gt_bboxes_ignore=gt_bboxes_ignore,
+            precomputed_targets=point_set_targets)
         return losses
 
-    def simple_test(self, img, img_meta, rescale=False):
-        x = self.extract_feat(img)
-        outs = self.bbox_head(x)
-        bbox_inputs = outs + (img_meta, self.test_cfg, rescale)
-        inference_res_list = self.bbox_head.get_inference_res(*bbox_inputs)
-        results = [
-            self.bbox_mask2result(det_bboxes, det_masks, det_labels, self.bbox_head.num_classes, img_meta[0])
-            for det_bboxes, det_masks, det_labels in inference_res_list]
+    def sparse_topk(self):
+        """Number of anchors the head predicts the boxes and masks of at
+        test time, None for all (see `test_cfg.sparse_reg`)."""
+        if self.test_cfg.get('sparse_reg', False):
+            return self.test_cfg.get('nms_pre', -1)
+        return None
 
-        bbox_results = results[0][0]
-        mask_results = results[0][1]
+    def test_candidates(self, img, img_meta):
+        """Bboxes, masks and scores of each image before the nms.
 
-        return bbox_results, mask_results
+        With `test_cfg.tile`, the images are cut into overlapping tiles,
+        see `tiled_test_candidates`.
+        """
+        if self.test_cfg.get('tile', None) is None:
+            x = self.extract_feat(img)
+            outs = self.bbox_head(x, sparse_topk=self.sparse_topk())
+            bbox_inputs = outs + (img_meta, self.test_cfg, False, False)
+            return self.bbox_head.get_inference_res(*bbox_inputs)
+        return [
+            self.tiled_test_candidates(img[i:i + 1], meta)
+            for i, meta in enumerate(img_meta)
+        ]
+
+    def tiled_test_candidates(self, img, img_meta):
+        """Bboxes, masks and scores of an image cut into overlapping tiles,
+        before the nms.
+
+        `test_cfg.tile` gives the `size` (h, w) of the tiles (multiples of
+        32), their `overlap` in pixels and the number of tiles run as a batch
+        (`imgs_per_batch`), which bounds the memory whatever the size of the
+        image. The results are shifted to the coordinates of the image, the
+        duplicates of the overlaps are removed by the nms.
+        """
+        tile_cfg = self.test_cfg.tile
+        tile_size = tile_cfg['size']
+        assert tile_size[0] % 32 == 0 and tile_size[1] % 32 == 0
+        windows = tile_windows(img.shape[-2:], tile_size,
+                               tile_cfg.get('overlap', 128))
+        tile_metas = tile_img_metas(img_meta, windows)
+        imgs_per_batch = tile_cfg.get('imgs_per_batch', 4)
+        results = []
+        for i in range(0, len(windows), imgs_per_batch):
+            batch_windows = windows[i:i + imgs_per_batch]
+            tiles = torch.cat(
+                [img[..., y1:y2, x1:x2] for x1, y1, x2, y2 in batch_windows])
+            x = self.extract_feat(tiles)
+            outs = self.bbox_head(x, sparse_topk=self.sparse_topk())
+            bbox_inputs = outs + (tile_metas[i:i + imgs_per_batch],
+                                  self.test_cfg, False, False)
+            for (bboxes, masks, scores), (x1, y1, _, _) in zip(
+                    self.bbox_head.get_inference_res(*bbox_inputs),
+                    batch_windows):
+                results.append((shift_points(bboxes, x1, y1),
+                                shift_points(masks, x1, y1), scores))
+        return tuple(torch.cat(res) for res in zip(*results))
 
+    def simple_test(self, img, img_meta, rescale=False):
+        return self.postprocess(
+            self.test_candidates(img, img_meta)[0], img_meta[0], rescale)
+
+    def postprocess(self, candidates, img_meta, rescale=False):
+        """Nms of the candidates of an image (see `test_candidates`) and
+        conversion to the results format."""
+        bboxes, masks, scores = candidates
+        if rescale:
+            bboxes = bboxes / bboxes.new_tensor(img_meta['scale_factor'])
+            masks = masks / masks.new_tensor(img_meta['scale_factor'])
+        det_bboxes, det_masks, det_labels = \
+            self.bbox_head.multiclass_nms_bbx_mask(
+                bboxes, masks, scores, self.test_cfg.score_thr,
+                self.test_cfg.nms, self.test_cfg.max_per_img)
+        return self.bbox_mask2result(det_bboxes, det_masks, det_labels,
+                                     self.bbox_head.num_classes, img_meta)
 
     def aug_test(self, imgs, img_metas, rescale=False):
-        feats = self.extract_feats(imgs)
+        """Test with augmentations.
+
+        Options of `test_cfg`:
+            batch_aug (bool): Run the augmented images of the same shape (the
+                flipped and unflipped images of a scale) as one batch.
+            aug_nms_pre (int): Number of best scored candidates of each
+                augmented image merged before the nms, -1 for all.
+            adaptive_aug (dict, optional): Run the scales from the smallest
+                one, and skip the larger scales once `min_scales` scales are
+                done if no object smaller than `small_size` (square root of
+                the area in the original image) was found with a score above
+                `score_thr`.
+        """
+        adaptive_cfg = self.test_cfg.get('adaptive_aug', None)
+        if self.test_cfg.get('batch_aug', False):
+            batches = batch_aug_imgs(imgs, img_metas)
+        else:
+            batches = [(img, img_meta, [i])
+                       for i, (img, img_meta) in enumerate(zip(imgs, img_metas))]
+            if adaptive_cfg is not None:
+                batches.sort(
+                    key=lambda batch: batch[0].shape[-2] * batch[0].shape[-1])
+
         aug_bboxes = []
         aug_masks = []
         aug_scores = []
-        for x, img_meta in zip(feats, img_metas):
-            outs = self.bbox_head(x)
-            bbox_inputs = outs + (img_meta, self.test_cfg, False, False)
-            det_bboxes, det_masks, det_scores = self.bbox_head.get_inference_res(*bbox_inputs)[0]
-            aug_bboxes.append(det_bboxes)
-            aug_masks.append(det_masks)
-            aug_scores.append(det_scores)
+        aug_img_metas = []
+        done_shapes = set()
+        for n_batch, (img, img_meta, _) in enumerate(batches):
+            found_small = False
+            for (det_bboxes, det_masks, det_scores), meta in zip(
+                    self.test_candidates(img, img_meta), img_meta):
+                # candidates under score_thr are dropped by the nms anyway
+                inds = prune_aug_candidates(det_scores,
+                                            self.test_cfg.score_thr,
+                                            self.test_cfg.get('aug_nms_pre', -1))
+                det_bboxes = det_bboxes[inds]
+                det_scores = det_scores[inds]
+                aug_bboxes.append(det_bboxes)
+                aug_masks.append(det_masks[inds])
+                aug_scores.append(det_scores)
+                aug_img_metas.append([meta])
+                if adaptive_cfg is not None:
+                    sizes = ((det_bboxes[:, 2] - det_bboxes[:, 0]) *
+                             (det_bboxes[:, 3] - det_bboxes[:, 1])).clamp(
+                                 min=0).sqrt() / meta['scale_factor']
+                    found_small |= bool(
+                        ((det_scores[:, 1:].max(dim=1)[0] >
+                          adaptive_cfg['score_thr']) &
+                         (sizes < adaptive_cfg['small_size'])).any())
+
+            done_shapes.add(tuple(img.shape[-2:]))
+            if adaptive_cfg is not None and n_batch + 1 < len(batches) \
+                    and not found_small \
+                    and len(done_shapes) >= adaptive_cfg.get('min_scales', 1) \
+                    and tuple(batches[n_batch + 1][0].shape[-2:]) not in done_shapes:
+                break
 
         merged_bboxes, merged_masks, merged_scores = self.merge_aug_results(
-                aug_bboxes, aug_masks, aug_scores, img_metas)
+                aug_bboxes, aug_masks, aug_scores, aug_img_metas)
         det_bboxes, det_masks, det_labels = self.bbox_head.multiclass_nms_bbx_mask(
                 merged_bboxes, merged_masks, merged_scores,
                 self.test_cfg.score_thr, self.test_cfg.nms, self.test_cfg.max_per_img)
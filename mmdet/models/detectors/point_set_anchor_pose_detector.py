@@ -1,7 +1,9 @@
 from ..registry import DETECTORS
 from .retinanet import RetinaNet
-from mmdet.core import kpts2result, bbox_mapping_back, kpts_nms
-from mmcv_custom.keypoints import get_keypoints, flip_keypoints
+from mmdet.core import (kpts2result, bbox_mapping_back, kpts_nms, batch_aug_imgs,
+                        prune_aug_candidates, shift_points, tile_img_metas, tile_windows,
+                        pose2bbox_minmax)
+from mmcv_custom.keypoints import COCO_FLIP_INDEX, flip_keypoints_torch
 import copy
 from .. import builder
 import torch
@@ -34,6 +36,7 @@ class PointSetAnchorPoseDetector(RetinaNet):
                  stage3_oks_thre=0.95,
                  use_predict_bbx=False,
                  heat_reg_group=False,
+                 keypoint_flip_index=None,
                  train_cfg=None,
                  test_cfg=None,
                  pretrained=None):
@@ -46,20 +49,40 @@ class PointSetAnchorPoseDetector(RetinaNet):
         self.stage3_oks_thre = stage3_oks_thre
         self.use_predict_bbx = use_predict_bbx
         self.heat_reg_group = heat_reg_group
+        self.keypoint_flip_index = COCO_FLIP_INDEX if keypoint_flip_index is None else keypoint_flip_index
         self.extra_heads = nn.ModuleList()
+        # poses tracked by video_test
+        self.track_state = None
 
         for n_stage in range(self.extra_stage_num):
             self.extra_heads.append(builder.build_head(bbox_head))
             self.extra_heads[n_stage].init_weights()
 
+        # training configs of the refinement stages
+        self.stage_train_cfgs = []
+        if self.train_cfg is not None:
+            for oks_thre in [stage2_oks_thre, stage3_oks_thre][:self.extra_stage_num]:
+                train_cfg_copy = copy.deepcopy(self.train_cfg)
+                train_cfg_copy['assigner']['pos_iou_thr'] = oks_thre
+                train_cfg_copy['assigner']['neg_iou_thr'] = oks_thre - 0.1
+                self.stage_train_cfgs.append(train_cfg_copy)
+
     def forward_train(self,
                       img,
                       img_metas,
                       gt_bboxes,
                       gt_labels,
                       gt_bboxes_ignore=None,
-                      gt_keypoints=None
-                      ):        
+                      gt_keypoints=None,
+                      point_set_targets=None,
+                      heat_targets=None
+                      ):
+        # point_set_targets and heat_targets are computed in the data workers
+        # by the ComputePointSetTargets pipeline stage, for the first stage
+        # with train_cfg.incremental_assign, the refinement stages only
+        # compute the OKS of the gts which are candidates of the parent anchors
+        incremental = self.train_cfg.get('incremental_assign', False) and \
+            self.extra_stage_num > 0
         x = self.extract_feat(img)
         all_anchor_list = []
         all_anchor_bbx_list = []
@@ -75,14 +98,25 @@ class PointSetAnchorPoseDetector(RetinaNet):
             out_anchor_bbx_list=deep_copy_list_list_of_tensors(anchor_bbx_list),
             out_valid_flag_list=deep_copy_list_list_of_tensors(valid_flag_list),
             out_anchor_scale_list=deep_copy_list_list_of_tensors(anchor_scale_list),
-            gt_bboxes_ignore=gt_bboxes_ignore
+            gt_bboxes_ignore=gt_bboxes_ignore,
+            precomputed_targets=point_set_targets,
+            return_assign_candidates=incremental
         )
+        assign_candidates = None
+        if incremental:
+            losses, assign_candidates = losses
 
         if self.heat_head is not None:
             (_, heat_pred, offset) = self.heat_head(x)
 
-            target = [self.heat_head.get_target(heat_pred_i, gt_keypoints, index) for (index, heat_pred_i) in
-                      enumerate(heat_pred)]
+            target = []
+            for (index, heat_pred_i) in enumerate(heat_pred):
+                target_i = None
+                if heat_targets is not None:
+                    target_i = self.heat_head.get_target_from_compact(heat_pred_i, heat_targets, index)
+                if target_i is None:
+                    target_i = self.heat_head.get_target(heat_pred_i, gt_keypoints, index)
+                target.append(target_i)
             heat_loss = self.heat_head.loss([x[0] for x in target], [x[2] for x in target],
                                             [x[3] for x in target], heat_pred, offset)
             losses['heat_loss'] = [x * self.heat_branch_weight for x in heat_loss['heat_loss']]
@@ -97,43 +131,59 @@ class PointSetAnchorPoseDetector(RetinaNet):
             all_anchor_list.append(anchor_list)
             all_anchor_bbx_list.append(anchor_bbx_list)
             outs = self.extra_heads[n_stage](x, anchor_list, valid_flag_list, anchor_zero_list)
-            if n_stage == 0:
-                train_cfg_copy = copy.deepcopy(self.train_cfg)
-                train_cfg_copy['assigner']['pos_iou_thr'] = self.stage2_oks_thre
-                train_cfg_copy['assigner']['neg_iou_thr'] = self.stage2_oks_thre - 0.1
-            elif n_stage == 1:
-                train_cfg_copy = copy.deepcopy(self.train_cfg)
-                train_cfg_copy['assigner']['pos_iou_thr'] = self.stage3_oks_thre
-                train_cfg_copy['assigner']['neg_iou_thr'] = self.stage3_oks_thre - 0.1
-            else:
-                assert 0
-            loss_inputs = outs + (gt_labels, img_metas, train_cfg_copy)
+            assert n_stage < len(self.stage_train_cfgs)
+            loss_inputs = outs + (gt_labels, img_metas, self.stage_train_cfgs[n_stage])
+            # the candidates of the previous stage are those of the parent
+            # anchors, they are not known if its targets were precomputed
+            record_candidates = incremental and n_stage + 1 < self.extra_stage_num
             extra_losses = self.extra_heads[n_stage].loss(
                 *loss_inputs, gt_keypoints=gt_keypoints, gt_bboxes=gt_bboxes,
                 out_anchor_list=deep_copy_list_list_of_tensors(anchor_list),
                 out_anchor_bbx_list=deep_copy_list_list_of_tensors(anchor_bbx_list),
                 out_valid_flag_list=deep_copy_list_list_of_tensors(valid_flag_list),
                 out_anchor_scale_list=deep_copy_list_list_of_tensors(anchor_scale_list),
-                gt_bboxes_ignore=gt_bboxes_ignore
+                gt_bboxes_ignore=gt_bboxes_ignore,
+                assign_candidates=assign_candidates,
+                return_assign_candidates=record_candidates
             )
+            if record_candidates:
+                extra_losses, assign_candidates = extra_losses
             for k, v in extra_losses.items():
                 losses['{}_stage{}'.format(k, n_stage)] = v
 
         return losses
 
-    def simple_test(self, img, img_meta, rescale=False):
-        x = self.extract_feat(img)
+    def used_outputs(self):
+        """Outputs of the heads consumed at test time.
+
+        The final bboxes are the extents of the poses (`get_bboxes` does not
+        use the bbox regression), and the heatmaps are only used to refine the
+        poses with `heat_reg_group`. With `test_cfg.prune_unused`, the
+        branches of the unused outputs are not computed.
+        """
+        return dict(
+            reg_bbx=False,
+            heat=self.heat_head is not None and self.heat_reg_group)
+
+    def test_heads(self, x, img_meta):
+        """Run the heads of all stages and decode the poses of the last one,
+        without nms."""
+        if self.test_cfg.get('prune_unused', False):
+            used = self.used_outputs()
+        else:
+            used = dict(reg_bbx=True, heat=self.heat_head is not None)
 
         all_anchor_list = []
         all_anchor_bbx_list = []
         anchor_list, anchor_bbx_list, valid_flag_list, anchor_zero_list, anchor_scale_list = \
-            self.bbox_head.get_anchors([featmap.size()[-2:] for featmap in x], img_meta, device=x[0].device)
+            self.bbox_head.get_test_anchors([featmap.size()[-2:] for featmap in x], img_meta, device=x[0].device)
         all_anchor_list.append(anchor_list)
         all_anchor_bbx_list.append(anchor_bbx_list)
 
-        outs = self.bbox_head(x, anchor_list, valid_flag_list, anchor_zero_list)
+        outs = self.bbox_head(x, anchor_list, valid_flag_list, anchor_zero_list, with_reg_bbx=used['reg_bbx'])
 
-        if self.heat_head is not None:
+        heat_preds, offset = None, None
+        if used['heat']:
             (_, heat_preds, offset) = self.heat_head(x)
 
         for n_stage in range(self.extra_stage_num):
@@ -144,18 +194,149 @@ class PointSetAnchorPoseDetector(RetinaNet):
                 out_anchors_scales=anchor_scale_list, use_heatmap=False, get_nextstage_anchor=True)
             all_anchor_list.append(anchor_list)
             all_anchor_bbx_list.append(anchor_bbx_list)
-            outs = self.extra_heads[n_stage](x, anchor_list, valid_flag_list, anchor_zero_list)
+            outs = self.extra_heads[n_stage](x, anchor_list, valid_flag_list, anchor_zero_list,
+                                             with_reg_bbx=used['reg_bbx'])
 
-            
         bbox_inputs = outs + (heat_preds, offset, img_meta, self.test_cfg, False)
-        
-        bbox_list = self.bbox_head.get_bboxes(
+        return self.bbox_head.get_bboxes(
             *bbox_inputs, do_nms=False, use_heatmap=self.heat_reg_group, out_anchors=all_anchor_list[-1], out_bbx_anchors=all_anchor_bbx_list[-1], out_anchors_scales=anchor_scale_list)
-        bbox_results = [
-            kpts2result(det_bboxes, det_labels, self.bbox_head.num_classes)
-            for det_bboxes, det_labels in bbox_list
-        ]
-        return bbox_results[0]
+
+    def test_candidates(self, img, img_meta):
+        """Poses of each image before the nms, as `test_heads`.
+
+        With `test_cfg.tile`, the images are cut into overlapping tiles,
+        see `tiled_test_candidates`.
+        """
+        if self.test_cfg.get('tile', None) is None:
+            return self.test_heads(self.extract_feat(img), img_meta)
+        return [self.tiled_test_candidates(img[i:i + 1], meta) for i, meta in enumerate(img_meta)]
+
+    def tiled_test_candidates(self, img, img_meta):
+        """Poses of an image cut into overlapping tiles, before the nms.
+
+        `test_cfg.tile` gives the `size` (h, w) of the tiles (multiples of 32),
+        their `overlap` in pixels and the number of tiles run as a batch
+        (`imgs_per_batch`), which bounds the memory whatever the size of the
+        image. The poses are shifted to the coordinates of the image, the
+        duplicates of the overlaps are removed by the nms.
+        """
+        tile_cfg = self.test_cfg.tile
+        tile_size = tile_cfg['size']
+        assert tile_size[0] % 32 == 0 and tile_size[1] % 32 == 0
+        windows = tile_windows(img.shape[-2:], tile_size, tile_cfg.get('overlap', 128))
+        tile_metas = tile_img_metas(img_meta, windows)
+        imgs_per_batch = tile_cfg.get('imgs_per_batch', 4)
+        results = []
+        for i in range(0, len(windows), imgs_per_batch):
+            batch_windows = windows[i:i + imgs_per_batch]
+            tiles = torch.cat([img[..., y1:y2, x1:x2] for x1, y1, x2, y2 in batch_windows])
+            bbox_list = self.test_heads(self.extract_feat(tiles), tile_metas[i:i + imgs_per_batch])
+            for (bboxes, poses, scores, areas, vis), (x1, y1, _, _) in zip(bbox_list, batch_windows):
+                results.append((shift_points(bboxes, x1, y1), shift_points(poses, x1, y1), scores, areas, vis))
+        return tuple(torch.cat(res) for res in zip(*results))
+
+    def simple_test(self, img, img_meta, rescale=False):
+        return self.postprocess(self.test_candidates(img, img_meta)[0], img_meta[0], rescale)
+
+    def postprocess(self, candidates, img_meta, rescale=False):
+        """Nms of the candidates of an image (see `test_candidates`) and
+        conversion to the results format."""
+        bboxes, poses, scores, areas, vis = candidates
+        if rescale:
+            scale_factor = img_meta['scale_factor']
+            bboxes = bboxes / scale_factor
+            poses = poses / scale_factor
+            areas = areas / (scale_factor * scale_factor)
+        det_poses, det_labels, _ = kpts_nms(torch.cat([bboxes, poses], dim=-1), scores, areas, vis,
+                                            self.test_cfg.score_thr, self.test_cfg.nms,
+                                            self.test_cfg.max_per_img)
+        return kpts2result(det_poses, det_labels, self.bbox_head.num_classes)
+
+    def last_head(self):
+        """The head of the last stage."""
+        return self.extra_heads[-1] if self.extra_stage_num > 0 else self.bbox_head
+
+    def reset_tracks(self):
+        """Forget the poses tracked by `video_test`, to start a new video."""
+        self.track_state = None
+
+    def track_candidates(self, img, img_meta, poses, norm_stats):
+        """Poses of an image refined from the poses of the previous frame by
+        the last head, before the nms, see `video_test`."""
+        x = self.extract_feat(img)
+        head = self.last_head()
+        track_anchors = head.get_track_anchors(poses, [featmap.size()[-2:] for featmap in x])
+        cls_score, reg_pred = head.forward_track(x, track_anchors, norm_stats)
+        order = torch.cat([level['inds'] for level in track_anchors]).argsort()
+        anchors, anchors_scales = [
+            torch.cat([level[key] for level in track_anchors])[order]
+            for key in ['anchors', 'anchors_scales']]
+
+        heat_pred, offset_pred = None, None
+        use_heatmap = self.heat_head is not None and self.heat_reg_group
+        if use_heatmap:
+            (_, heat_preds, offset_preds) = self.heat_head(x)
+            heat_pred = heat_preds[0][0]
+            offset_pred = offset_preds[0][0] if offset_preds is not None else None
+        img_shape = img_meta[0]['img_shape']
+        poses = head.decode_poses(anchors, anchors_scales, reg_pred, heat_pred, offset_pred, img_shape,
+                                  use_heatmap)
+        bboxes = pose2bbox_minmax(poses)
+        areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+        vis = areas.new_ones((areas.shape[0], TEMPLATE_POINTS_NUM))
+        if head.use_sigmoid_cls:
+            scores = cls_score.sigmoid()
+            scores = torch.cat([scores.new_zeros(scores.shape[0], 1), scores], dim=1)
+        else:
+            scores = cls_score.softmax(-1)
+        return bboxes, poses, scores, areas, vis
+
+    def video_test(self, img, img_meta, rescale=False):
+        """Test a frame of a video stream, the frames of a video must be given
+        in order, one at a time.
+
+        The full detector only runs on keyframes. On the other frames, the
+        poses of the previous frame scored above `test_cfg.track.score_thr`
+        are the anchors of the last head, only evaluated at their locations
+        (see `PointSetAnchorPoseHead.forward_track`), with the GN statistics
+        of the last keyframe. People entering the frame are found at the next
+        keyframe, every `track.keyframe_interval` frames. A frame is a
+        keyframe too if there is no pose to track, or if the mean score of
+        the refined poses drops below `track.fallback_thr`.
+
+        Call `reset_tracks` before the first frame of each video.
+        """
+        assert img.size(0) == 1 and self.test_cfg.get('tile', None) is None
+        track_cfg = self.test_cfg.track
+        state = self.track_state
+        candidates = None
+        if state is not None and state['num_frames'] < track_cfg.get('keyframe_interval', 10) and \
+                state['poses'].size(0) > 0:
+            candidates = self.track_candidates(img, img_meta, state['poses'], state['norm_stats'])
+            if candidates[2][:, 1:].max(dim=1)[0].mean() < track_cfg.get('fallback_thr', 0.2):
+                candidates = None
+        if candidates is None:
+            head = self.last_head()
+            head.norm_stats = {}
+            try:
+                candidates = self.test_candidates(img, img_meta)[0]
+                state = dict(num_frames=0, norm_stats=head.norm_stats)
+            finally:
+                head.norm_stats = None
+
+        bboxes, poses, scores, areas, vis = candidates
+        det_poses, det_labels, _ = kpts_nms(torch.cat([bboxes, poses], dim=-1), scores, areas, vis,
+                                            self.test_cfg.score_thr, self.test_cfg.nms,
+                                            self.test_cfg.max_per_img)
+        # the dets are (bboxes, poses, score)
+        state['poses'] = det_poses[det_poses[:, -1] > track_cfg.get('score_thr', 0.3), 4:-1]
+        state['num_frames'] += 1
+        self.track_state = state
+
+        if rescale:
+            det_poses = det_poses.clone()
+            det_poses[:, :-1] /= img_meta[0]['scale_factor']
+        return kpts2result(det_poses, det_labels, self.bbox_head.num_classes)
 
     def merge_aug_results(self, aug_bboxes, aug_poses, aug_scores, aug_areas, aug_vis, img_metas):
         recovered_bboxes = []
@@ -169,9 +350,8 @@ class PointSetAnchorPoseDetector(RetinaNet):
             bboxes = bbox_mapping_back(bboxes, img_shape, scale_factor, flip)
 
             if flip:
-                kpt_name, kpt_flip_map = get_keypoints()
                 poses = poses.view(poses.shape[0], -1, 2)
-                poses = flip_keypoints(kpt_name, kpt_flip_map, poses, img_shape[1])
+                poses = flip_keypoints_torch(poses, img_shape[1], self.keypoint_flip_index)
                 poses = poses.view(poses.shape[0], -1)
             poses = poses / scale_factor
 
@@ -188,43 +368,59 @@ class PointSetAnchorPoseDetector(RetinaNet):
         return bboxes, poses, areas, scores, vis
 
     def aug_test(self, imgs, img_metas, rescale=False):
-        feats = self.extract_feats(imgs)
+        """Test with augmentations.
+
+        Options of `test_cfg`:
+            batch_aug (bool): Run the augmented images of the same shape (the
+                flipped and unflipped images of a scale) as one batch.
+            aug_nms_pre (int): Number of best scored candidates of each
+                augmented image merged before the nms, -1 for all.
+            adaptive_aug (dict, optional): Run the scales from the smallest
+                one, and skip the larger scales once `min_scales` scales are
+                done if no person smaller than `small_size` (square root of
+                the area in the original image) was found with a score above
+                `score_thr`.
+        """
+        adaptive_cfg = self.test_cfg.get('adaptive_aug', None)
+        if self.test_cfg.get('batch_aug', False):
+            batches = batch_aug_imgs(imgs, img_metas)
+        else:
+            batches = [(img, img_meta, [i]) for i, (img, img_meta) in enumerate(zip(imgs, img_metas))]
+            if adaptive_cfg is not None:
+                batches.sort(key=lambda batch: batch[0].shape[-2] * batch[0].shape[-1])
+
         aug_bbox_list, aug_pose_list, aug_score_list, aug_area_list, aug_vis_list = [],[],[],[],[]
-        for i, (x, img_meta) in enumerate(zip(feats, img_metas)):
-            
-            all_anchor_list = []
-            all_anchor_bbx_list = []
-            anchor_list, anchor_bbx_list, valid_flag_list, anchor_zero_list, anchor_scale_list = \
-                self.bbox_head.get_anchors([featmap.size()[-2:] for featmap in x], img_meta, device=x[0].device)
-            all_anchor_list.append(anchor_list)
-            all_anchor_bbx_list.append(anchor_bbx_list)
-            outs = self.bbox_head(x, anchor_list, valid_flag_list, anchor_zero_list)
-
-            if self.heat_head is not None:
-                (_, heat_preds, offset) = self.heat_head(x)
-
-            for n_stage in range(self.extra_stage_num):
-                bbox_inputs = outs + (heat_preds, offset, img_meta, self.test_cfg)
-                anchor_list, anchor_bbx_list = self.bbox_head.get_bboxes(
-                    *bbox_inputs, rescale=False, do_nms=False, out_anchors=all_anchor_list[-1], out_bbx_anchors=all_anchor_bbx_list[-1], 
-                    out_anchors_scales=anchor_scale_list, use_heatmap=False, get_nextstage_anchor=True)
-                all_anchor_list.append(anchor_list)
-                all_anchor_bbx_list.append(anchor_bbx_list)
-                outs = self.extra_heads[n_stage](x, anchor_list, valid_flag_list, anchor_zero_list)
-            
-            bbox_inputs = outs + (heat_preds, offset, img_meta, self.test_cfg, False)
-            bbox_list = self.bbox_head.get_bboxes(
-                *bbox_inputs, do_nms=False, use_heatmap=self.heat_reg_group, out_anchors=all_anchor_list[-1], out_bbx_anchors=all_anchor_bbx_list[-1], out_anchors_scales=anchor_scale_list)
-            assert len(bbox_list) == 1
-
-            aug_bbox_list.append(bbox_list[0][0]) #3000,4
-            aug_pose_list.append(bbox_list[0][1]) #3000,34
-            aug_score_list.append(bbox_list[0][2]) #3000,2
-            aug_area_list.append(bbox_list[0][3]) #3000
-            aug_vis_list.append(bbox_list[0][4]) #3000,17
+        aug_img_metas = []
+        done_shapes = set()
+        for n_batch, (img, img_meta, _) in enumerate(batches):
+            bbox_list = self.test_candidates(img, img_meta)
+            assert len(bbox_list) == len(img_meta)
+
+            found_small = False
+            for (bboxes, poses, scores, areas, vis), meta in zip(bbox_list, img_meta):
+                # candidates under score_thr are dropped by the nms anyway
+                inds = prune_aug_candidates(scores, self.test_cfg.score_thr,
+                                            self.test_cfg.get('aug_nms_pre', -1))
+                aug_bbox_list.append(bboxes[inds])
+                aug_pose_list.append(poses[inds])
+                aug_score_list.append(scores[inds])
+                aug_area_list.append(areas[inds])
+                aug_vis_list.append(vis[inds])
+                aug_img_metas.append([meta])
+                if adaptive_cfg is not None:
+                    sizes = areas[inds].clamp(min=0).sqrt() / meta['scale_factor']
+                    found_small |= bool(((scores[inds][:, 1:].max(dim=1)[0] > adaptive_cfg['score_thr']) &
+                                         (sizes < adaptive_cfg['small_size'])).any())
+
+            done_shapes.add(tuple(img.shape[-2:]))
+            if adaptive_cfg is not None and n_batch + 1 < len(batches) and not found_small and \
+                    len(done_shapes) >= adaptive_cfg.get('min_scales', 1) and \
+                    tuple(batches[n_batch + 1][0].shape[-2:]) not in done_shapes:
+                break
 
         merged_bboxes, merged_poses, merged_areas, merged_scores, merged_vis = \
-            self.merge_aug_results(aug_bbox_list, aug_pose_list, aug_score_list, aug_area_list, aug_vis_list, img_metas)
+            self.merge_aug_results(aug_bbox_list, aug_pose_list, aug_score_list, aug_area_list, aug_vis_list,
+                                   aug_img_metas)
 
         det_poses, det_labels, det_vises = kpts_nms(torch.cat([merged_bboxes, merged_poses], dim=-1), merged_scores,
                                                     merged_areas, merged_vis, self.test_cfg.score_thr,
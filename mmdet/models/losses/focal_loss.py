@@ -34,6 +34,8 @@ def sigmoid_focal_loss(pred,
                        avg_factor=None):
     # Function.apply does not accept keyword arguments, so the decorator
     # "weighted_loss" is not applicable
+    # the op (CUDA or CPU) only keeps the logits and targets for the
+    # backward, where the intermediates are recomputed
     loss = _sigmoid_focal_loss(pred, target, gamma, alpha)
     # TODO: find a proper way to handle the shape of weight
     if weight is not None:
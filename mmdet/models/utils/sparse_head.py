@@ -0,0 +1,144 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def topk_anchor_inds(cls_score, num_classes, k, use_sigmoid_cls=True):
+    """Indices of the k best scored anchors of each image.
+
+    This is the `nms_pre` selection of the heads' inference on a single level,
+    the indices are in the (h, w, anchor) order of the flattened predictions.
+
+    Args:
+        cls_score (Tensor): Scores of a level, shape (n, A * num_classes, h, w).
+        num_classes (int): Number of channels per anchor.
+        k (int): Number of anchors to keep.
+        use_sigmoid_cls (bool): Same as the head.
+
+    Returns:
+        list[Tensor] or None: The indices for each image, None if all the
+            anchors are kept.
+    """
+    if k <= 0 or cls_score[0].numel() // num_classes <= k:
+        return None
+    inds = []
+    for img_score in cls_score:
+        scores = img_score.detach().permute(1, 2, 0).reshape(-1, num_classes)
+        if use_sigmoid_cls:
+            max_scores, _ = scores.sigmoid().max(dim=1)
+        else:
+            max_scores, _ = scores.softmax(-1)[:, 1:].max(dim=1)
+        inds.append(max_scores.topk(k)[1])
+    return inds
+
+
+def split_anchor_inds(inds, width, num_anchors):
+    """Split indices in the (h, w, anchor) order into the location and the
+    anchor."""
+    a = inds % num_anchors
+    loc = inds // num_anchors
+    return loc // width, loc % width, a
+
+
+def conv2d_at(x, weight, bias, ys, xs, padding=0):
+    """A stride 1 conv of a single image evaluated at some locations only.
+
+    Args:
+        x (Tensor): Input of shape (C, H, W).
+        weight (Tensor): Weight of shape (O, C, kh, kw).
+        bias (Tensor, optional): Bias of shape (O, ).
+        ys, xs (Tensor): Output locations, shape (n, ).
+
+    Returns:
+        Tensor: The output at the locations, shape (n, O).
+    """
+    kh, kw = weight.shape[-2:]
+    if padding > 0:
+        x = F.pad(x, [padding] * 4)
+    patches = torch.stack(
+        [x[:, ys + i, xs + j] for i in range(kh) for j in range(kw)], dim=1)
+    out = weight.reshape(weight.size(0), -1).mm(
+        patches.reshape(-1, ys.numel())).t()
+    if bias is not None:
+        out = out + bias
+    return out
+
+
+def deform_conv2d_at(x, weight, offsets, ys, xs, padding=0):
+    """A stride 1 deformable conv of a single image evaluated at some
+    locations only, given the offsets of those locations.
+
+    The input is sampled bilinearly at the kernel points plus the offsets,
+    with zeros out of the image, as `DeformConv`. A `ModulatedDeformConv`
+    with a mask of ones gives the same result.
+
+    Args:
+        x (Tensor): Input of shape (C, H, W).
+        weight (Tensor): Weight of shape (O, C, kh, kw).
+        offsets (Tensor): (dy, dx) offsets of the kernel points in the order
+            of `DeformConv`, shape (n, kh * kw * 2).
+        ys, xs (Tensor): Output locations, shape (n, ).
+
+    Returns:
+        Tensor: The output at the locations, shape (n, O).
+    """
+    kh, kw = weight.shape[-2:]
+    height, width = x.shape[-2:]
+    n = ys.numel()
+    ky = torch.arange(kh, device=x.device).repeat_interleave(kw)
+    kx = torch.arange(kw, device=x.device).repeat(kh)
+    offsets = offsets.view(n, kh * kw, 2)
+    py = (ys - padding).view(-1, 1).type_as(x) + ky.type_as(x) + offsets[..., 0]
+    px = (xs - padding).view(-1, 1).type_as(x) + kx.type_as(x) + offsets[..., 1]
+    # grid_sample with align_corners maps -1 and 1 to the first and last
+    # pixel centers
+    grid = torch.stack([px / max(width - 1, 1) * 2 - 1,
+                        py / max(height - 1, 1) * 2 - 1], dim=-1)
+    sampled = F.grid_sample(
+        x[None], grid[None], mode='bilinear', padding_mode='zeros',
+        align_corners=True)[0]
+    # (C, n, K) -> (C, K, n)
+    patches = sampled.permute(0, 2, 1).reshape(-1, n)
+    return weight.reshape(weight.size(0), -1).mm(patches).t()
+
+
+def group_norm_stats(norm, feats):
+    """Mean and variance of the groups of a `GroupNorm` over the features
+    (m, C) of some locations of a single image."""
+    groups = feats.t().reshape(norm.num_groups, -1)
+    return groups.mean(dim=1), groups.var(dim=1, unbiased=False)
+
+
+def norm_at(norm, feats, stat_feats=None, stats=None):
+    """Apply a norm layer to features of some locations of a single image.
+
+    Args:
+        norm (nn.Module): The norm layer of the dense path.
+        feats (Tensor): Features of shape (n, C).
+        stat_feats (Tensor, optional): Features of the locations the
+            statistics of a `GroupNorm` are computed on, shape (m, C). The
+            statistics of the dense map are the ones of all the locations.
+            Defaults to `feats`.
+        stats (tuple[Tensor], optional): Precomputed statistics of a
+            `GroupNorm`, see :func:`group_norm_stats`, used instead of
+            `stat_feats`.
+
+    Returns:
+        Tensor: Normalized features, shape (n, C).
+    """
+    if not isinstance(norm, nn.GroupNorm):
+        # norms with running statistics (e.g. BN in eval mode) do not depend
+        # on the other locations
+        return norm(feats[:, :, None, None])[:, :, 0, 0]
+    num_groups = norm.num_groups
+    if stats is None:
+        stats = group_norm_stats(
+            norm, feats if stat_feats is None else stat_feats)
+    mean, var = stats
+    c = feats.size(1)
+    out = (feats.view(-1, num_groups, c // num_groups) - mean[:, None]) / \
+        (var[:, None] + norm.eps).sqrt()
+    out = out.view(-1, c)
+    if norm.affine:
+        out = out * norm.weight + norm.bias
+    return out
@@ -23,6 +23,26 @@ def oks_iou_tensor(g, d, a_g, a_d):
     return ious
 
 
+def oks_iou_tensor_batch(g, d, a_g, a_d):
+    """Batched `oks_iou_tensor`, of `g` (..., m, 3k) with `d` (..., n, 3k),
+    `a_g` (..., m) and `a_d` (..., n). Returns ious of shape (..., m, n)."""
+    sigmas = np.array([.26, .25, .25, .35, .35, .79, .79, .72, .72, .62, .62, 1.07, 1.07, .87, .87, .89, .89]) / 10.0
+    sigmas = d.new_tensor(sigmas)
+    vars = (sigmas * 2) ** 2
+    xg = g[..., 0::3].unsqueeze(-2)
+    yg = g[..., 1::3].unsqueeze(-2)
+    vg = (g[..., 2::3] > 0).type_as(g)
+    num_vis_point = torch.sum(vg, dim=-1, keepdim=True)
+    xd = d[..., 0::3].unsqueeze(-3)
+    yd = d[..., 1::3].unsqueeze(-3)
+    dx = xd - xg
+    dy = yd - yg
+    e = (dx ** 2 + dy ** 2) / vars / (
+        (a_g.unsqueeze(-1) + a_d.unsqueeze(-2)).unsqueeze(-1) / 2 + d.new_tensor(np.spacing(1))) / 2
+    ious = torch.sum(torch.exp(-e) * vg.unsqueeze(-2), dim=-1) / (num_vis_point + d.new_tensor(np.spacing(1)))
+    return ious
+
+
 def oks_iou(g, d, a_g, a_d, sigmas=None, in_vis_thre=None):
     if not isinstance(sigmas, np.ndarray):
         sigmas = np.array([.26, .25, .25, .35, .35, .79, .79, .72, .72, .62, .62, 1.07, 1.07, .87, .87, .89, .89]) / 10.0
@@ -13,6 +13,18 @@ at::Tensor SigmoidFocalLoss_backward_cuda(const at::Tensor &logits,
                                           const int num_classes,
                                           const float gamma, const float alpha);
 
+at::Tensor SigmoidFocalLoss_forward_cpu(const at::Tensor &logits,
+                                        const at::Tensor &targets,
+                                        const int num_classes,
+                                        const float gamma, const float alpha);
+
+at::Tensor SigmoidFocalLoss_backward_cpu(const at::Tensor &logits,
+                                         const at::Tensor &targets,
+                                         const at::Tensor &d_losses,
+                                         const int num_classes,
+                                         const float gamma,
+                                         const float alpha);
+
 // Interface for Python
 at::Tensor SigmoidFocalLoss_forward(const at::Tensor &logits,
                                     const at::Tensor &targets,
@@ -22,7 +34,8 @@ at::Tensor SigmoidFocalLoss_forward(const at::Tensor &logits,
     return SigmoidFocalLoss_forward_cuda(logits, targets, num_classes, gamma,
                                          alpha);
   }
-  AT_ERROR("SigmoidFocalLoss is not implemented on the CPU");
+  return SigmoidFocalLoss_forward_cpu(logits, targets, num_classes, gamma,
+                                      alpha);
 }
 
 at::Tensor SigmoidFocalLoss_backward(const at::Tensor &logits,
@@ -34,12 +47,13 @@ at::Tensor SigmoidFocalLoss_backward(const at::Tensor &logits,
     return SigmoidFocalLoss_backward_cuda(logits, targets, d_losses,
                                           num_classes, gamma, alpha);
   }
-  AT_ERROR("SigmoidFocalLoss is not implemented on the CPU");
+  return SigmoidFocalLoss_backward_cpu(logits, targets, d_losses, num_classes,
+                                       gamma, alpha);
 }
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("forward", &SigmoidFocalLoss_forward,
-        "SigmoidFocalLoss forward (CUDA)");
+        "SigmoidFocalLoss forward (CUDA/CPU)");
   m.def("backward", &SigmoidFocalLoss_backward,
-        "SigmoidFocalLoss backward (CUDA)");
+        "SigmoidFocalLoss backward (CUDA/CPU)");
 }
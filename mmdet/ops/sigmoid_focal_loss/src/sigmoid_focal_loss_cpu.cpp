@@ -0,0 +1,139 @@
+// CPU version of sigmoid_focal_loss_cuda.cu, same formulas
+#include <ATen/ATen.h>
+#include <ATen/Parallel.h>
+
+#include <algorithm>
+#include <cfloat>
+#include <cmath>
+
+template <typename scalar_t>
+void SigmoidFocalLossForwardCPU(const int64_t nthreads,
+                                const scalar_t *logits,
+                                const int64_t *targets,
+                                const int num_classes, const float gamma,
+                                const float alpha, scalar_t *losses) {
+  at::parallel_for(0, nthreads, 2048, [&](int64_t begin, int64_t end) {
+    for (int64_t i = begin; i < end; i++) {
+      int64_t n = i / num_classes;
+      int d = i % num_classes;  // current class[0~79];
+      int64_t t = targets[n];   // target class [1~80];
+
+      // Decide it is positive or negative case.
+      scalar_t c1 = (t == (d + 1));
+      scalar_t c2 = (t >= 0 & t != (d + 1));
+
+      scalar_t zn = (1.0 - alpha);
+      scalar_t zp = (alpha);
+      scalar_t x = logits[i];
+
+      // p = 1. / 1. + expf(-x); p = sigmoid(x)
+      scalar_t p = 1. / (1. + std::exp(-x));
+
+      // (1-p)**gamma * log(p) where
+      scalar_t term1 = std::pow(1. - p, gamma) *
+                       std::log(std::max(p, static_cast<scalar_t>(FLT_MIN)));
+
+      // p**gamma * log(1-p)
+      scalar_t term2 = std::pow(p, gamma) *
+                       (-1. * x * (x >= 0) -
+                        std::log(1. + std::exp(x - 2. * x * (x >= 0))));
+
+      losses[i] = -c1 * term1 * zp - c2 * term2 * zn;
+    }
+  });
+}
+
+template <typename scalar_t>
+void SigmoidFocalLossBackwardCPU(const int64_t nthreads,
+                                 const scalar_t *logits,
+                                 const int64_t *targets,
+                                 const scalar_t *d_losses,
+                                 const int num_classes, const float gamma,
+                                 const float alpha, scalar_t *d_logits) {
+  at::parallel_for(0, nthreads, 2048, [&](int64_t begin, int64_t end) {
+    for (int64_t i = begin; i < end; i++) {
+      int64_t n = i / num_classes;
+      int d = i % num_classes;  // current class[0~79];
+      int64_t t = targets[n];   // target class [1~80], 0 is background;
+
+      // Decide it is positive or negative case.
+      scalar_t c1 = (t == (d + 1));
+      scalar_t c2 = (t >= 0 & t != (d + 1));
+
+      scalar_t zn = (1.0 - alpha);
+      scalar_t zp = (alpha);
+      scalar_t x = logits[i];
+      // p = 1. / 1. + expf(-x); p = sigmoid(x)
+      scalar_t p = 1. / (1. + std::exp(-x));
+
+      // (1-p)**g * (1 - p - g*p*log(p)
+      scalar_t term1 =
+          std::pow(1. - p, gamma) *
+          (1. - p -
+           (p * gamma *
+            std::log(std::max(p, static_cast<scalar_t>(FLT_MIN)))));
+
+      // (p**g) * (g*(1-p)*log(1-p) - p)
+      scalar_t term2 = std::pow(p, gamma) *
+                       ((-1. * x * (x >= 0) -
+                         std::log(1. + std::exp(x - 2. * x * (x >= 0)))) *
+                            (1. - p) * gamma -
+                        p);
+      d_logits[i] = (-c1 * term1 * zp - c2 * term2 * zn) * d_losses[i];
+    }
+  });
+}
+
+at::Tensor SigmoidFocalLoss_forward_cpu(const at::Tensor &logits,
+                                        const at::Tensor &targets,
+                                        const int num_classes,
+                                        const float gamma, const float alpha) {
+  AT_ASSERTM(logits.dim() == 2, "logits should be NxClass");
+
+  const int64_t num_samples = logits.size(0);
+  auto losses = at::empty({num_samples, logits.size(1)}, logits.options());
+  if (losses.numel() == 0) {
+    return losses;
+  }
+  auto logits_ = logits.contiguous();
+  auto targets_ = targets.contiguous();
+
+  AT_DISPATCH_FLOATING_TYPES(
+      logits.scalar_type(), "SigmoidFocalLoss_forward_cpu", [&] {
+        SigmoidFocalLossForwardCPU<scalar_t>(
+            losses.numel(), logits_.data_ptr<scalar_t>(),
+            targets_.data_ptr<int64_t>(), num_classes, gamma, alpha,
+            losses.data_ptr<scalar_t>());
+      });
+  return losses;
+}
+
+at::Tensor SigmoidFocalLoss_backward_cpu(const at::Tensor &logits,
+                                         const at::Tensor &targets,
+                                         const at::Tensor &d_losses,
+                                         const int num_classes,
+                                         const float gamma,
+                                         const float alpha) {
+  AT_ASSERTM(logits.dim() == 2, "logits should be NxClass");
+
+  const int64_t num_samples = logits.size(0);
+  AT_ASSERTM(logits.size(1) == num_classes,
+             "logits.size(1) should be num_classes");
+
+  auto d_logits = at::zeros({num_samples, num_classes}, logits.options());
+  if (d_logits.numel() == 0) {
+    return d_logits;
+  }
+  auto logits_ = logits.contiguous();
+  auto targets_ = targets.contiguous();
+  auto d_losses_ = d_losses.contiguous();
+
+  AT_DISPATCH_FLOATING_TYPES(
+      logits.scalar_type(), "SigmoidFocalLoss_backward_cpu", [&] {
+        SigmoidFocalLossBackwardCPU<scalar_t>(
+            d_logits.numel(), logits_.data_ptr<scalar_t>(),
+            targets_.data_ptr<int64_t>(), d_losses_.data_ptr<scalar_t>(),
+            num_classes, gamma, alpha, d_logits.data_ptr<scalar_t>());
+      });
+  return d_logits;
+}
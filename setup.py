@@ -206,6 +206,7 @@ if __name__ == '__main__':
                 module='mmdet.ops.sigmoid_focal_loss',
                 sources=[
                     'src/sigmoid_focal_loss.cpp',
+                    'src/sigmoid_focal_loss_cpu.cpp',
                     'src/sigmoid_focal_loss_cuda.cu'
                 ]),
             make_cuda_ext(
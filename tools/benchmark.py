@@ -0,0 +1,347 @@
+import argparse
+import copy
+import json
+import os.path as osp
+import sys
+import tempfile
+import time
+from collections import OrderedDict, defaultdict
+
+import mmcv
+import numpy as np
+import torch
+from mmcv import Config
+from mmcv.parallel import DataContainer, collate
+from terminaltables import AsciiTable
+
+from mmcv_custom import load_checkpoint
+from mmdet.apis.train import parse_losses
+from mmdet.core import results2json
+from mmdet.datasets import build_dataset
+from mmdet.models import build_detector
+
+SYNTHETIC_DATASETS = {
+    'CocoDataset': 'SyntheticCocoDataset',
+    'CocoPoseDataset': 'SyntheticCocoPoseDataset'
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the latency of each stage of a detector')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument('--checkpoint', help='checkpoint file')
+    parser.add_argument(
+        '--mode',
+        choices=['test', 'train'],
+        default='test',
+        help='inference, or the forward, loss and backward of training')
+    parser.add_argument(
+        '--synthetic',
+        action='store_true',
+        help='generate the images and annotations instead of reading the '
+        'dataset of the config')
+    parser.add_argument(
+        '--scales',
+        type=str,
+        nargs='+',
+        default=['1333x800'],
+        help='input scales to sweep, as WxH')
+    parser.add_argument(
+        '--batch-sizes',
+        type=int,
+        nargs='+',
+        default=[1],
+        help='batch sizes to sweep')
+    parser.add_argument(
+        '--num-iters', type=int, default=20, help='number of timed batches')
+    parser.add_argument(
+        '--num-warmup', type=int, default=5, help='number of warmup batches')
+    parser.add_argument(
+        '--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--out', help='json file of the results')
+    args = parser.parse_args()
+    return args
+
+
+class StageTimer(object):
+    """Time the calls of some functions of a model, by stage.
+
+    The time of a stage excludes the stages called inside it (e.g. the loss
+    does not include the target assignment), so that the stages add up to the
+    total time. On GPU, the device is synchronized around each call.
+    """
+
+    def __init__(self, device):
+        self.cuda = torch.device(device).type == 'cuda'
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._stack = []
+        self._patched = []
+
+    def clock(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def wrap(self, stage, func):
+
+        def timed(*args, **kwargs):
+            start = self.clock()
+            self._stack.append(0.)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = self.clock() - start
+                inner = self._stack.pop()
+                self.times[stage] += elapsed - inner
+                self.calls[stage] += 1
+                if self._stack:
+                    self._stack[-1] += elapsed
+
+        return timed
+
+    def patch(self, obj, name, stage):
+        """Time `obj.name` as `stage`, if it exists."""
+        if obj is None or not hasattr(obj, name):
+            return
+        self._patched.append((obj, name, obj.__dict__.get(name)))
+        setattr(obj, name, self.wrap(stage, getattr(obj, name)))
+
+    def restore(self):
+        for obj, name, orig in reversed(self._patched):
+            if orig is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, orig)
+        self._patched = []
+
+    def reset(self):
+        self.times.clear()
+        self.calls.clear()
+
+
+def patch_model(timer, model):
+    """Register the stages of `PointSetAnchorPoseDetector` and
+    `PointSetAnchorDetector`."""
+    timer.patch(model.backbone, 'forward', 'backbone')
+    if getattr(model, 'neck', None) is not None:
+        timer.patch(model.neck, 'forward', 'neck')
+    heads = [model.bbox_head] + list(getattr(model, 'extra_heads', []))
+    for i, head in enumerate(heads):
+        timer.patch(head, 'forward',
+                    'head' if len(heads) == 1 else 'head.stage{}'.format(i))
+    for head in heads:
+        for name in ['get_anchors', 'get_test_anchors']:
+            timer.patch(head, name, 'anchors')
+        for name in ['get_targets', 'get_compact_targets']:
+            timer.patch(head, name, 'targets')
+        timer.patch(head, 'loss', 'loss')
+        for name in ['get_bboxes', 'get_inference_res']:
+            timer.patch(head, name, 'decode')
+        timer.patch(head, 'multiclass_nms_bbx_mask', 'nms')
+    timer.patch(getattr(model, 'heat_head', None), 'forward', 'heat_head')
+    # functions the pose detector calls by their module-level names
+    detector_module = sys.modules[type(model).__module__]
+    timer.patch(detector_module, 'kpts_nms', 'nms')
+    timer.patch(detector_module, 'kpts2result', 'result')
+    timer.patch(model, 'bbox_mask2result', 'result')
+
+
+def set_scale(pipeline, scale):
+    """Make the pipeline single scale, without flip, at `scale`."""
+    pipeline = copy.deepcopy(pipeline)
+    for transform in pipeline:
+        if transform['type'] == 'MultiScaleFlipAug':
+            transform['img_scale'] = scale
+            transform['flip'] = False
+        elif transform['type'] == 'Resize':
+            transform['img_scale'] = scale
+            transform.pop('multiscale_mode', None)
+        elif transform['type'] == 'CenterRandomCropXiao':
+            transform['patch_width'], transform['patch_height'] = scale
+    return pipeline
+
+
+def build_benchmark_dataset(cfg, mode, scale, synthetic, num_imgs):
+    data_cfg = copy.deepcopy(cfg.data.train if mode == 'train' else
+                             cfg.data.test)
+    data_cfg.pipeline = set_scale(data_cfg.pipeline, scale)
+    if synthetic:
+        assert data_cfg.type in SYNTHETIC_DATASETS, \
+            'No synthetic counterpart of {}'.format(data_cfg.type)
+        data_cfg = dict(
+            type=SYNTHETIC_DATASETS[data_cfg.type],
+            num_imgs=num_imgs,
+            img_scale=scale,
+            pipeline=[dict(type='LoadSyntheticImage')] +
+            data_cfg.pipeline[1:],
+            test_mode=data_cfg.get('test_mode', False) or mode == 'test')
+    elif mode == 'test':
+        data_cfg.test_mode = True
+    return build_dataset(data_cfg)
+
+
+def unwrap(data, device):
+    """The batch of a single device out of the collated data, on `device`,
+    contiguous like the scattered data."""
+    if isinstance(data, DataContainer):
+        data = data.data[0]
+    if isinstance(data, torch.Tensor):
+        return data.to(device).contiguous()
+    if isinstance(data, (list, tuple)):
+        return type(data)(unwrap(d, device) for d in data)
+    if isinstance(data, dict):
+        return {k: unwrap(v, device) for k, v in data.items()}
+    return data
+
+
+def pad_imgs(imgs):
+    """Stack images of different sizes, padded at the bottom right."""
+    h = max(img.shape[-2] for img in imgs)
+    w = max(img.shape[-1] for img in imgs)
+    batch = imgs[0].new_zeros((len(imgs), imgs[0].shape[0], h, w))
+    for i, img in enumerate(imgs):
+        batch[i, :, :img.shape[-2], :img.shape[-1]] = img
+    return batch
+
+
+def load_batch(dataset, inds, mode, device):
+    samples = [dataset[i] for i in inds]
+    if mode == 'train':
+        data = unwrap(collate(samples, samples_per_gpu=len(samples)), device)
+        data['img_metas'] = data.pop('img_meta')
+        return data
+    # single scale and no flip: the first (and only) augmentation
+    img = pad_imgs([sample['img'][0] for sample in samples]).to(device)
+    img_meta = [sample['img_meta'][0].data for sample in samples]
+    return dict(img=img, img_meta=img_meta)
+
+
+def run_batch(model, data, mode, timer, dataset, inds, tmp_dir):
+    if mode == 'train':
+        losses = model.forward_train(**data)
+        loss, _ = parse_losses(losses)
+        timer.wrap('backward', loss.backward)()
+        # the gradients are not used, only their computation is timed
+        model.zero_grad()
+        return
+    candidates = model.test_candidates(data['img'], data['img_meta'])
+    results = [
+        model.postprocess(cand, img_meta, rescale=True)
+        for cand, img_meta in zip(candidates, data['img_meta'])
+    ]
+    # the json of the images of the batch
+    view = copy.copy(dataset)
+    view.img_infos = [dataset.img_infos[i] for i in inds]
+    view.img_ids = [dataset.img_ids[i] for i in inds]
+    timer.wrap('json', results2json)(view, results, osp.join(tmp_dir, 'res'))
+
+
+def benchmark(model, args, cfg, scale, batch_size, tmp_dir):
+    num_batches = args.num_warmup + args.num_iters
+    dataset = build_benchmark_dataset(cfg, args.mode, scale, args.synthetic,
+                                      num_batches * batch_size)
+    timer = StageTimer(args.device)
+    patch_model(timer, model)
+    totals = []
+    try:
+        # the gradients are only needed for the backward of training
+        with torch.set_grad_enabled(args.mode == 'train'):
+            for it in range(num_batches):
+                if it == args.num_warmup:
+                    timer.reset()
+                inds = [(it * batch_size + i) % len(dataset)
+                        for i in range(batch_size)]
+                data = timer.wrap('data', load_batch)(dataset, inds,
+                                                      args.mode, args.device)
+                start = timer.clock()
+                run_batch(model, data, args.mode, timer, dataset, inds,
+                          tmp_dir)
+                if it >= args.num_warmup:
+                    totals.append(timer.clock() - start)
+    finally:
+        timer.restore()
+
+    stages = OrderedDict()
+    for stage, seconds in timer.times.items():
+        stages[stage] = dict(
+            ms_per_batch=seconds * 1000 / args.num_iters,
+            ms_per_img=seconds * 1000 / args.num_iters / batch_size,
+            calls_per_batch=timer.calls[stage] / args.num_iters)
+    # the model time, the data pipeline is usually run by loader workers
+    model_ms = np.array(totals) * 1000
+    other = model_ms.mean() - sum(v['ms_per_batch']
+                                  for k, v in stages.items() if k != 'data')
+    stages['other'] = dict(
+        ms_per_batch=other,
+        ms_per_img=other / batch_size,
+        calls_per_batch=1.)
+    return dict(
+        mode=args.mode,
+        device=args.device,
+        scale=list(scale),
+        batch_size=batch_size,
+        num_iters=args.num_iters,
+        stages=stages,
+        ms_per_batch=float(model_ms.mean()),
+        ms_per_batch_median=float(np.median(model_ms)),
+        imgs_per_s=float(batch_size * 1000 / model_ms.mean()))
+
+
+def print_results(runs):
+    for run in runs:
+        title = '{} {}x{} batch {} on {}'.format(run['mode'], run['scale'][0],
+                                                 run['scale'][1],
+                                                 run['batch_size'],
+                                                 run['device'])
+        table_data = [['stage', 'ms/batch', 'ms/img', 'calls/batch']]
+        for stage, v in run['stages'].items():
+            table_data.append([
+                stage, '{:.2f}'.format(v['ms_per_batch']),
+                '{:.2f}'.format(v['ms_per_img']),
+                '{:g}'.format(v['calls_per_batch'])
+            ])
+        table_data.append([
+            'model total', '{:.2f}'.format(run['ms_per_batch']),
+            '{:.2f}'.format(run['ms_per_batch'] / run['batch_size']),
+            '{:.1f} img/s'.format(run['imgs_per_s'])
+        ])
+        table = AsciiTable(table_data, title)
+        table.inner_footing_row_border = True
+        print(table.table)
+
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    cfg.model.pretrained = None
+    train_cfg = cfg.train_cfg if args.mode == 'train' else None
+    model = build_detector(
+        cfg.model, train_cfg=train_cfg, test_cfg=cfg.test_cfg)
+    if args.checkpoint is not None:
+        load_checkpoint(model, args.checkpoint, map_location='cpu')
+    model = model.to(args.device)
+    model.train(args.mode == 'train')
+    if not hasattr(model, 'postprocess'):
+        raise NotImplementedError(
+            'The benchmark is not supported with {}'.format(
+                model.__class__.__name__))
+
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in args.scales:
+            w, h = (int(s) for s in scale.split('x'))
+            for batch_size in args.batch_sizes:
+                runs.append(
+                    benchmark(model, args, cfg, (w, h), batch_size, tmp_dir))
+    print_results(runs)
+    if args.out is not None:
+        mmcv.mkdir_or_exist(osp.dirname(osp.abspath(args.out)))
+        with open(args.out, 'w') as f:
+            json.dump(runs, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
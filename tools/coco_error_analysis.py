@@ -49,59 +49,64 @@ def makeplot(rs, ps, outDir, class_name, iou_type):
         plt.close(fig)
 
 
-def analyze_individual_category(k, cocoDt, cocoGt, catId, iou_type):
-    nm = cocoGt.loadCats(catId)[0]
-    print('--------------analyzing {}-{}---------------'.format(
-        k + 1, nm['name']))
-    ps_ = {}
-    dt = copy.deepcopy(cocoDt)
+# read-only gt and dt shared with the forked workers, set before the pools
+# are created so that they are inherited copy-on-write instead of pickled
+# for every task
+_shared = {}
+
+
+def category_anns(coco, cat_ids):
+    """Annotations of some categories, as new dicts that the evaluation can
+    modify (it converts the segmentations to RLE in place)."""
+    ann_ids = coco.getAnnIds(catIds=cat_ids)
+    return [dict(ann) for ann in coco.loadAnns(ann_ids)]
+
+
+def coco_from_anns(coco, anns):
+    sub = COCO()
+    sub.dataset = dict(coco.dataset, annotations=anns)
+    sub.createIndex()
+    return sub
+
+
+def analyze_individual_category(k, catId, iou_type, variant):
+    """Precision of a category at IoU .1 when the confusions with its
+    super-category ('supercategory') or with any category ('allcategory')
+    are ignored.
+
+    The gts of the other categories concerned are turned into crowd
+    regions of the category. Only the category is evaluated, its precision
+    does not depend on the others.
+    """
+    cocoGt = _shared['gt']
+    cocoDt = _shared['dt']
     nm = cocoGt.loadCats(catId)[0]
-    imgIds = cocoGt.getImgIds()
-    dt_anns = dt.dataset['annotations']
-    select_dt_anns = []
-    for ann in dt_anns:
-        if ann['category_id'] == catId:
-            select_dt_anns.append(ann)
-    dt.dataset['annotations'] = select_dt_anns
-    dt.createIndex()
-    # compute precision but ignore superclass confusion
-    gt = copy.deepcopy(cocoGt)
-    child_catIds = gt.getCatIds(supNms=[nm['supercategory']])
-    for idx, ann in enumerate(gt.dataset['annotations']):
-        if (ann['category_id'] in child_catIds
-                and ann['category_id'] != catId):
-            gt.dataset['annotations'][idx]['ignore'] = 1
-            gt.dataset['annotations'][idx]['iscrowd'] = 1
-            gt.dataset['annotations'][idx]['category_id'] = catId
-    cocoEval = COCOeval(gt, copy.deepcopy(dt), iou_type)
-    cocoEval.params.imgIds = imgIds
-    cocoEval.params.maxDets = [100]
-    cocoEval.params.iouThrs = [.1]
-    cocoEval.params.useCats = 1
-    cocoEval.evaluate()
-    cocoEval.accumulate()
-    ps_supercategory = cocoEval.eval['precision'][0, :, k, :, :]
-    ps_['ps_supercategory'] = ps_supercategory
-    # compute precision but ignore any class confusion
-    gt = copy.deepcopy(cocoGt)
-    for idx, ann in enumerate(gt.dataset['annotations']):
+    print('--------------analyzing {}-{} ({})---------------'.format(
+        k + 1, nm['name'], variant))
+    dt = coco_from_anns(cocoDt, category_anns(cocoDt, [catId]))
+    if variant == 'supercategory':
+        other_catIds = cocoGt.getCatIds(supNms=[nm['supercategory']])
+    else:
+        other_catIds = cocoGt.getCatIds()
+    gt_anns = category_anns(cocoGt, other_catIds)
+    for ann in gt_anns:
         if ann['category_id'] != catId:
-            gt.dataset['annotations'][idx]['ignore'] = 1
-            gt.dataset['annotations'][idx]['iscrowd'] = 1
-            gt.dataset['annotations'][idx]['category_id'] = catId
-    cocoEval = COCOeval(gt, copy.deepcopy(dt), iou_type)
-    cocoEval.params.imgIds = imgIds
+            ann['ignore'] = 1
+            ann['iscrowd'] = 1
+            ann['category_id'] = catId
+    gt = coco_from_anns(cocoGt, gt_anns)
+    cocoEval = COCOeval(gt, dt, iou_type)
+    cocoEval.params.imgIds = cocoGt.getImgIds()
+    cocoEval.params.catIds = [catId]
     cocoEval.params.maxDets = [100]
     cocoEval.params.iouThrs = [.1]
     cocoEval.params.useCats = 1
     cocoEval.evaluate()
     cocoEval.accumulate()
-    ps_allcategory = cocoEval.eval['precision'][0, :, k, :, :]
-    ps_['ps_allcategory'] = ps_allcategory
-    return k, ps_
+    return cocoEval.eval['precision'][0, :, 0, :, :]
 
 
-def analyze_results(res_file, ann_file, res_types, out_dir):
+def analyze_results(res_file, ann_file, res_types, out_dir, nproc=48):
     for res_type in res_types:
         assert res_type in ['bbox', 'segm']
 
@@ -132,28 +137,32 @@ def analyze_results(res_file, ann_file, res_types, out_dir):
         ps = np.vstack([ps, np.zeros((4, *ps.shape[1:]))])
         catIds = cocoGt.getCatIds()
         recThrs = cocoEval.params.recThrs
-        with Pool(processes=48) as pool:
-            args = [(k, cocoDt, cocoGt, catId, iou_type)
-                    for k, catId in enumerate(catIds)]
-            analyze_results = pool.starmap(analyze_individual_category, args)
+        _shared.update(gt=cocoGt, dt=cocoDt)
+        variants = ['supercategory', 'allcategory']
+        with Pool(processes=nproc) as pool:
+            args = [(k, catId, iou_type, variant)
+                    for k, catId in enumerate(catIds)
+                    for variant in variants]
+            variant_ps = pool.starmap(analyze_individual_category, args)
+        _shared.clear()
+        # compute precision but ignore superclass confusion
+        ps[3] = np.stack(variant_ps[0::2], axis=1)
+        # compute precision but ignore any class confusion
+        ps[4] = np.stack(variant_ps[1::2], axis=1)
+        # fill in background and false negative errors
+        ps[ps == -1] = 0
+        ps[5] = (ps[4] > 0)
+        ps[6] = 1.0
+        plots = []
         for k, catId in enumerate(catIds):
             nm = cocoGt.loadCats(catId)[0]
-            print('--------------saving {}-{}---------------'.format(
-                k + 1, nm['name']))
-            analyze_result = analyze_results[k]
-            assert k == analyze_result[0]
-            ps_supercategory = analyze_result[1]['ps_supercategory']
-            ps_allcategory = analyze_result[1]['ps_allcategory']
-            # compute precision but ignore superclass confusion
-            ps[3, :, k, :, :] = ps_supercategory
-            # compute precision but ignore any class confusion
-            ps[4, :, k, :, :] = ps_allcategory
-            # fill in background and false negative errors and plot
-            ps[ps == -1] = 0
-            ps[5, :, k, :, :] = (ps[4, :, k, :, :] > 0)
-            ps[6, :, k, :, :] = 1.0
-            makeplot(recThrs, ps[:, :, k], res_out_dir, nm['name'], iou_type)
-        makeplot(recThrs, ps, res_out_dir, 'allclass', iou_type)
+            plots.append(
+                (recThrs, ps[:, :, k], res_out_dir, nm['name'], iou_type))
+        plots.append((recThrs, ps, res_out_dir, 'allclass', iou_type))
+        print('--------------saving {} plots---------------'.format(
+            len(plots)))
+        with Pool(processes=nproc) as pool:
+            pool.starmap(makeplot, plots)
 
 
 def main():
@@ -166,8 +175,18 @@ def main():
         help='annotation file path')
     parser.add_argument(
         '--types', type=str, nargs='+', default=['bbox'], help='result types')
+    parser.add_argument(
+        '--nproc',
+        type=int,
+        default=48,
+        help='number of processes of the evaluation and of the plotting')
     args = parser.parse_args()
-    analyze_results(args.result, args.ann, args.types, out_dir=args.out_dir)
+    analyze_results(
+        args.result,
+        args.ann,
+        args.types,
+        out_dir=args.out_dir,
+        nproc=args.nproc)
 
 
 if __name__ == '__main__':
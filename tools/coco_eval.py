@@ -11,7 +11,7 @@ def main():
         '--types',
         type=str,
         nargs='+',
-        choices=['proposal_fast', 'proposal', 'bbox', 'segm', 'keypoint'],
+        choices=['proposal_fast', 'proposal', 'bbox', 'segm', 'keypoints'],
         default=['bbox'],
         help='result types')
     parser.add_argument(
@@ -22,8 +22,19 @@ def main():
         help='proposal numbers, only used for recall evaluation')
     parser.add_argument(
         '--classwise', action='store_true', help='whether eval class wise ap')
+    parser.add_argument(
+        '--evaluator',
+        choices=['pycocotools', 'fast'],
+        default='pycocotools',
+        help='the fast evaluator gives the same results as pycocotools')
+    parser.add_argument(
+        '--nproc',
+        type=int,
+        default=1,
+        help='number of processes of the fast evaluator')
     args = parser.parse_args()
-    coco_eval(args.result, args.types, args.ann, args.max_dets, args.classwise)
+    coco_eval(args.result, args.types, args.ann, args.max_dets, args.classwise,
+              args.evaluator, args.nproc)
 
 
 if __name__ == '__main__':
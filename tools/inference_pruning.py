@@ -0,0 +1,100 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from mmcv import Config
+
+from mmcv_custom import load_checkpoint
+from mmdet.models import build_detector
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Measure the latency saved by skipping the unused head '
+        'branches at inference (test_cfg.prune_unused)')
+    parser.add_argument('config', help='test config file path')
+    parser.add_argument('--checkpoint', help='checkpoint file')
+    parser.add_argument(
+        '--shape',
+        type=int,
+        nargs='+',
+        default=[1280, 800],
+        help='input image size')
+    parser.add_argument(
+        '--num-iters', type=int, default=50, help='number of timed images')
+    parser.add_argument(
+        '--num-warmup', type=int, default=5, help='number of warmup images')
+    args = parser.parse_args()
+    return args
+
+
+def time_per_image(model, img, img_meta, num_iters, num_warmup):
+    times = []
+    with torch.no_grad():
+        for i in range(num_warmup + num_iters):
+            if img.is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            # the configs test with MultiScaleFlipAug, here with one scale
+            model.aug_test([img], [img_meta])
+            if img.is_cuda:
+                torch.cuda.synchronize()
+            if i >= num_warmup:
+                times.append(time.perf_counter() - start)
+    return np.median(times) * 1000
+
+
+def main():
+    args = parse_args()
+
+    if len(args.shape) == 1:
+        w = h = args.shape[0]
+    elif len(args.shape) == 2:
+        w, h = args.shape
+    else:
+        raise ValueError('invalid input shape')
+
+    cfg = Config.fromfile(args.config)
+    cfg.model.pretrained = None
+    model = build_detector(cfg.model, train_cfg=None, test_cfg=cfg.test_cfg)
+    if args.checkpoint is not None:
+        load_checkpoint(model, args.checkpoint, map_location='cpu')
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = model.to(device)
+    model.eval()
+    if not hasattr(model, 'used_outputs'):
+        raise NotImplementedError(
+            'Inference pruning is not supported with {}'.format(
+                model.__class__.__name__))
+
+    # the input size is padded to a multiple of 32 as in the test pipeline
+    h, w = int(np.ceil(h / 32)) * 32, int(np.ceil(w / 32)) * 32
+    img = torch.randn(1, 3, h, w, device=device)
+    img_meta = [
+        dict(
+            ori_shape=(h, w, 3),
+            img_shape=(h, w, 3),
+            pad_shape=(h, w, 3),
+            scale_factor=1.0,
+            flip=False)
+    ]
+
+    latencies = {}
+    for prune in [False, True]:
+        model.test_cfg.prune_unused = prune
+        latencies[prune] = time_per_image(model, img, img_meta,
+                                          args.num_iters, args.num_warmup)
+
+    skipped = [k for k, v in model.used_outputs().items() if not v]
+    split_line = '=' * 30
+    print('{0}\nInput shape: {1}\nSkipped outputs: {2}\n'
+          'Full: {3:.1f} ms/img\nPruned: {4:.1f} ms/img\n'
+          'Saved: {5:.1f} ms/img\n{0}'.format(
+              split_line, (3, w, h), ', '.join(skipped) or 'none',
+              latencies[False], latencies[True],
+              latencies[False] - latencies[True]))
+
+
+if __name__ == '__main__':
+    main()
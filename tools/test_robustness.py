@@ -9,17 +9,19 @@ import mmcv
 import numpy as np
 import torch
 import torch.distributed as dist
-from mmcv.parallel import MMDataParallel, MMDistributedDataParallel
-from mmcv.runner import get_dist_info, load_checkpoint
+from mmcv.parallel import MMDataParallel
+from mmcv.runner import get_dist_info
 from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 from robustness_eval import get_results
+from torch.utils.data import Subset
 
-from mmdet import datasets
+from mmcv_custom import load_checkpoint
 from mmdet.apis import init_dist, set_random_seed
 from mmdet.core import (eval_map, fast_eval_recall, results2json,
                         wrap_fp16_model)
 from mmdet.datasets import build_dataloader, build_dataset
+from mmdet.datasets.pipelines import Compose
 from mmdet.models import build_detector
 
 
@@ -131,7 +133,7 @@ def single_gpu_test(model, data_loader, show=False):
         results.append(result)
 
         if show:
-            model.module.show_result(data, result, dataset.img_norm_cfg)
+            model.module.show_result(data, result)
 
         batch_size = data['img'][0].size(0)
         for _ in range(batch_size):
@@ -139,69 +141,123 @@ def single_gpu_test(model, data_loader, show=False):
     return results
 
 
-def multi_gpu_test(model, data_loader, tmpdir=None):
-    model.eval()
-    results = []
-    dataset = data_loader.dataset
-    rank, world_size = get_dist_info()
-    if rank == 0:
-        prog_bar = mmcv.ProgressBar(len(dataset))
-    for i, data in enumerate(data_loader):
-        with torch.no_grad():
-            result = model(return_loss=False, rescale=True, **data)
-        results.append(result)
-
-        if rank == 0:
-            batch_size = data['img'][0].size(0)
-            for _ in range(batch_size * world_size):
-                prog_bar.update()
-
-    # collect results from all ranks
-    results = collect_results(results, len(dataset), tmpdir)
-
-    return results
+def dump_atomic(obj, filename):
+    """Dump to a temporary file first so that an interrupted run never
+    leaves a partial checkpoint."""
+    tmp_file = '{}.{}.tmp'.format(filename, os.getpid())
+    mmcv.dump(obj, tmp_file, file_format='pkl')
+    os.replace(tmp_file, filename)
 
 
-def collect_results(result_part, size, tmpdir=None):
-    rank, world_size = get_dist_info()
-    # create a tmp dir if it is not specified
-    if tmpdir is None:
-        MAX_LEN = 512
-        # 32 is whitespace
-        dir_tensor = torch.full((MAX_LEN, ),
-                                32,
-                                dtype=torch.uint8,
-                                device='cuda')
-        if rank == 0:
-            tmpdir = tempfile.mkdtemp()
-            tmpdir = torch.tensor(
-                bytearray(tmpdir.encode()), dtype=torch.uint8, device='cuda')
-            dir_tensor[:len(tmpdir)] = tmpdir
-        dist.broadcast(dir_tensor, 0)
-        tmpdir = dir_tensor.cpu().numpy().tobytes().decode().rstrip()
-    else:
-        mmcv.mkdir_or_exist(tmpdir)
-    # dump the part result to the dir
-    mmcv.dump(result_part, osp.join(tmpdir, 'part_{}.pkl'.format(rank)))
-    dist.barrier()
-    # collect all parts
-    if rank != 0:
-        return None
+def get_conditions(corruptions, severities):
+    """The (corruption, severity) pairs to test, severity 0 (= no
+    corruption) is tested only once, with the first corruption."""
+    conditions = []
+    for corr_i, corruption in enumerate(corruptions):
+        for severity in severities:
+            if corr_i > 0 and severity == 0:
+                continue
+            conditions.append((corruption, severity))
+    return conditions
+
+
+def condition_dir(work_dir, corruption, severity):
+    return osp.join(work_dir, corruption, str(severity))
+
+
+def chunk_file(work_dir, corruption, severity, chunk):
+    return osp.join(
+        condition_dir(work_dir, corruption, severity),
+        'chunk_{:05d}.pkl'.format(chunk))
+
+
+def corrupted_dataset(dataset, test_pipeline, corruption, severity,
+                      cache_dir):
+    """The test dataset with the corruption inserted in its pipeline, the
+    annotations are shared with `dataset`."""
+    pipeline = copy.deepcopy(test_pipeline)
+    if severity > 0:
+        # TODO: hard coded "1", we assume that the first step is
+        # loading images, which needs to be fixed in the future
+        pipeline.insert(
+            1,
+            dict(
+                type='Corrupt',
+                corruption=corruption,
+                severity=severity,
+                cache_dir=cache_dir))
+    dataset = copy.copy(dataset)
+    dataset.pipeline = Compose(pipeline)
+    return dataset
+
+
+def condition_done(work_dir, corruption, severity, num_chunks):
+    return all(
+        osp.isfile(chunk_file(work_dir, corruption, severity, chunk))
+        for chunk in range(num_chunks))
+
+
+def merge_condition(args, corruption, severity, num_chunks):
+    """Merge the chunks of a condition into the results of the whole dataset,
+    saved in its dir and, as the other test tools, to --out (which holds the
+    results of the last condition merged)."""
+    outputs = []
+    for chunk in range(num_chunks):
+        outputs.extend(
+            mmcv.load(chunk_file(args.work_dir, corruption, severity, chunk)))
+    out_file = osp.join(
+        condition_dir(args.work_dir, corruption, severity), 'results.pkl')
+    mmcv.dump(outputs, out_file)
+    dump_atomic(outputs, args.out)
+    return outputs, out_file
+
+
+def evaluate_condition(args, cfg, dataset, corruption, severity, num_chunks):
+    """Evaluate the merged chunks of a condition, as the whole dataset."""
+    outputs, out_file = merge_condition(args, corruption, severity,
+                                        num_chunks)
+    eval_types = args.eval
+    print('\nEvaluating {} at severity {}'.format(corruption, severity))
+    if cfg.dataset_type == 'VOCDataset':
+        if eval_types != ['bbox']:
+            print('\nOnly "bbox" evaluation is supported for pascal voc')
+            return None
+        mean_ap, eval_results = voc_eval_with_return(
+            out_file, dataset, args.iou_thr, args.summaries)
+        return eval_results
+    if eval_types == ['proposal_fast']:
+        result_files = out_file
+    elif not isinstance(outputs[0], dict):
+        result_files = results2json(dataset, outputs, out_file)
     else:
-        # load results of all parts from tmp dir
-        part_list = []
-        for i in range(world_size):
-            part_file = osp.join(tmpdir, 'part_{}.pkl'.format(i))
-            part_list.append(mmcv.load(part_file))
-        # sort the results
-        ordered_results = []
-        for res in zip(*part_list):
-            ordered_results.extend(list(res))
-        # the dataloader may pad some samples
-        ordered_results = ordered_results[:size]
-        # remove tmp dir
-        shutil.rmtree(tmpdir)
-        return ordered_results
+        for name in outputs[0]:
+            outputs_ = [out[name] for out in outputs]
+            result_files = results2json(dataset, outputs_,
+                                        out_file + '.{}'.format(name))
+    return coco_eval_with_return(result_files, eval_types, dataset.coco)
+
+
+def evaluate_ready(args, cfg, dataset, conditions, num_chunks,
+                   aggregated_results, eval_results_filename):
+    """Evaluate the conditions whose chunks are all done and that are not in
+    the aggregated results yet, the results are saved after each one."""
+    for corruption, severity in conditions:
+        if severity in aggregated_results.get(corruption, {}):
+            continue
+        if not condition_done(args.work_dir, corruption, severity,
+                              num_chunks):
+            continue
+        eval_results = evaluate_condition(args, cfg, dataset, corruption,
+                                          severity, num_chunks)
+        if eval_results is None:
+            continue
+        aggregated_results.setdefault(corruption, {})[severity] = eval_results
+        # severity 0 is shared by all the corruptions
+        clean = aggregated_results.get(conditions[0][0], {}).get(0)
+        if clean is not None:
+            for corr in aggregated_results:
+                aggregated_results[corr][0] = clean
+        dump_atomic(aggregated_results, eval_results_filename)
 
 
 def parse_args():
@@ -248,7 +304,30 @@ def parse_args():
     parser.add_argument(
         '--workers', type=int, default=32, help='workers per gpu')
     parser.add_argument('--show', action='store_true', help='show results')
-    parser.add_argument('--tmpdir', help='tmp dir for writing some results')
+    parser.add_argument(
+        '--work-dir',
+        help='dir of the checkpointed results of the image chunks, a run '
+        'resumes from the chunks found there (defaults to the --out path '
+        'without extension)')
+    parser.add_argument(
+        '--corrupt-cache',
+        help='dir where the corrupted images are cached, shared by runs')
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=500,
+        help='number of images of a work item')
+    parser.add_argument(
+        '--shard-id',
+        type=int,
+        default=None,
+        help='index of the shard of work items run by this process '
+        '(defaults to the rank)')
+    parser.add_argument(
+        '--num-shards',
+        type=int,
+        default=None,
+        help='number of shards (defaults to the world size)')
     parser.add_argument('--seed', type=int, default=None, help='random seed')
     parser.add_argument(
         '--launcher',
@@ -275,36 +354,7 @@ def parse_args():
     return args
 
 
-def main():
-    args = parse_args()
-
-    assert args.out or args.show, \
-        ('Please specify at least one operation (save or show the results) '
-         'with the argument "--out" or "--show"')
-
-    if args.out is not None and not args.out.endswith(('.pkl', '.pickle')):
-        raise ValueError('The output file must be a pkl file.')
-
-    cfg = mmcv.Config.fromfile(args.config)
-    # set cudnn_benchmark
-    if cfg.get('cudnn_benchmark', False):
-        torch.backends.cudnn.benchmark = True
-    cfg.model.pretrained = None
-    cfg.data.test.test_mode = True
-    if args.workers == 0:
-        args.workers = cfg.data.workers_per_gpu
-
-    # init distributed env first, since logger depends on the dist info.
-    if args.launcher == 'none':
-        distributed = False
-    else:
-        distributed = True
-        init_dist(args.launcher, **cfg.dist_params)
-
-    # set random seeds
-    if args.seed is not None:
-        set_random_seed(args.seed)
-
+def get_corruptions(args):
     if 'all' in args.corruptions:
         corruptions = [
             'gaussian_noise', 'shot_noise', 'impulse_noise', 'defocus_blur',
@@ -339,115 +389,145 @@ def main():
         args.severities = [0]
     else:
         corruptions = args.corruptions
+    return corruptions
 
-    aggregated_results = {}
-    for corr_i, corruption in enumerate(corruptions):
-        aggregated_results[corruption] = {}
-        for sev_i, corruption_severity in enumerate(args.severities):
-            # evaluate severity 0 (= no corruption) only once
-            if corr_i > 0 and corruption_severity == 0:
-                aggregated_results[corruption][0] = \
-                    aggregated_results[corruptions[0]][0]
-                continue
 
-            test_data_cfg = copy.deepcopy(cfg.data.test)
-            # assign corruption and severity
-            if corruption_severity > 0:
-                corruption_trans = dict(
-                    type='Corrupt',
-                    corruption=corruption,
-                    severity=corruption_severity)
-                # TODO: hard coded "1", we assume that the first step is
-                # loading images, which needs to be fixed in the future
-                test_data_cfg['pipeline'].insert(1, corruption_trans)
-
-            # print info
-            print('\nTesting {} at severity {}'.format(corruption,
-                                                       corruption_severity))
-
-            # build the dataloader
-            # TODO: support multiple images per gpu
-            #       (only minor changes are needed)
-            dataset = build_dataset(test_data_cfg)
-            data_loader = build_dataloader(
-                dataset,
-                imgs_per_gpu=1,
-                workers_per_gpu=args.workers,
-                dist=distributed,
-                shuffle=False)
-
-            # build the model and load checkpoint
-            model = build_detector(
-                cfg.model, train_cfg=None, test_cfg=cfg.test_cfg)
-            fp16_cfg = cfg.get('fp16', None)
-            if fp16_cfg is not None:
-                wrap_fp16_model(model)
-            checkpoint = load_checkpoint(
-                model, args.checkpoint, map_location='cpu')
-            # old versions did not save class info in checkpoints,
-            # this walkaround is for backward compatibility
-            if 'CLASSES' in checkpoint['meta']:
-                model.CLASSES = checkpoint['meta']['CLASSES']
-            else:
-                model.CLASSES = dataset.CLASSES
-
-            if not distributed:
-                model = MMDataParallel(model, device_ids=[0])
-                outputs = single_gpu_test(model, data_loader, args.show)
-            else:
-                model = MMDistributedDataParallel(model.cuda())
-                outputs = multi_gpu_test(model, data_loader, args.tmpdir)
-
-            rank, _ = get_dist_info()
-            if args.out and rank == 0:
-                eval_results_filename = (
-                    osp.splitext(args.out)[0] + '_results' +
-                    osp.splitext(args.out)[1])
-                mmcv.dump(outputs, args.out)
-                eval_types = args.eval
-                if cfg.dataset_type == 'VOCDataset':
-                    if eval_types:
-                        for eval_type in eval_types:
-                            if eval_type == 'bbox':
-                                test_dataset = mmcv.runner.obj_from_dict(
-                                    cfg.data.test, datasets)
-                                mean_ap, eval_results = \
-                                    voc_eval_with_return(
-                                        args.out, test_dataset,
-                                        args.iou_thr, args.summaries)
-                                aggregated_results[corruption][
-                                    corruption_severity] = eval_results
-                            else:
-                                print('\nOnly "bbox" evaluation \
-                                is supported for pascal voc')
-                else:
-                    if eval_types:
-                        print('Starting evaluate {}'.format(
-                            ' and '.join(eval_types)))
-                        if eval_types == ['proposal_fast']:
-                            result_file = args.out
-                        else:
-                            if not isinstance(outputs[0], dict):
-                                result_files = results2json(
-                                    dataset, outputs, args.out)
-                            else:
-                                for name in outputs[0]:
-                                    print('\nEvaluating {}'.format(name))
-                                    outputs_ = [out[name] for out in outputs]
-                                    result_file = args.out
-                                    + '.{}'.format(name)
-                                    result_files = results2json(
-                                        dataset, outputs_, result_file)
-                        eval_results = coco_eval_with_return(
-                            result_files, eval_types, dataset.coco)
-                        aggregated_results[corruption][
-                            corruption_severity] = eval_results
-                    else:
-                        print('\nNo task was selected for evaluation;'
-                              '\nUse --eval to select a task')
-
-            # save results after each evaluation
-            mmcv.dump(aggregated_results, eval_results_filename)
+def main():
+    args = parse_args()
+
+    assert args.out or args.show, \
+        ('Please specify at least one operation (save or show the results) '
+         'with the argument "--out" or "--show"')
+
+    if args.out is not None and not args.out.endswith(('.pkl', '.pickle')):
+        raise ValueError('The output file must be a pkl file.')
+    tmp_work_dir = None
+    if args.work_dir is None and args.out is None:
+        # only shown, nothing to resume
+        tmp_work_dir = tempfile.mkdtemp()
+        args.work_dir = tmp_work_dir
+    elif args.work_dir is None:
+        args.work_dir = osp.splitext(args.out)[0]
+    if args.out is not None:
+        mmcv.mkdir_or_exist(osp.dirname(osp.abspath(args.out)))
+    eval_results_filename = None
+    if args.out is not None:
+        eval_results_filename = (
+            osp.splitext(args.out)[0] + '_results' +
+            osp.splitext(args.out)[1])
+
+    cfg = mmcv.Config.fromfile(args.config)
+    # set cudnn_benchmark
+    if cfg.get('cudnn_benchmark', False):
+        torch.backends.cudnn.benchmark = True
+    cfg.model.pretrained = None
+    cfg.data.test.test_mode = True
+    if args.workers == 0:
+        args.workers = cfg.data.workers_per_gpu
+
+    # init distributed env first, since logger depends on the dist info.
+    if args.launcher == 'none':
+        distributed = False
+    else:
+        distributed = True
+        init_dist(args.launcher, **cfg.dist_params)
+    rank, world_size = get_dist_info()
+    shard_id = rank if args.shard_id is None else args.shard_id
+    num_shards = world_size if args.num_shards is None else args.num_shards
+
+    # set random seeds
+    if args.seed is not None:
+        set_random_seed(args.seed)
+
+    corruptions = get_corruptions(args)
+    conditions = get_conditions(corruptions, args.severities)
+
+    # the annotations are loaded once, each condition only changes the
+    # pipeline
+    test_pipeline = cfg.data.test.pipeline
+    dataset = build_dataset(cfg.data.test)
+    num_chunks = int(np.ceil(len(dataset) / args.chunk_size))
+    # work items are (condition, chunk of images), a shard takes every
+    # num_shards-th one and skips the ones already done
+    work_items = [(corruption, severity, chunk)
+                  for corruption, severity in conditions
+                  for chunk in range(num_chunks)][shard_id::num_shards]
+    work_items = [
+        item for item in work_items
+        if not osp.isfile(chunk_file(args.work_dir, *item))
+    ]
+
+    # only the first shard saves and evaluates the results, as soon as the
+    # conditions are done
+    evaluate = shard_id == 0 and rank == 0 and args.out is not None
+    aggregated_results = {}
+    if evaluate and osp.isfile(eval_results_filename):
+        aggregated_results = mmcv.load(eval_results_filename)
+
+    model = None
+    if work_items:
+        model = build_detector(
+            cfg.model, train_cfg=None, test_cfg=cfg.test_cfg)
+        fp16_cfg = cfg.get('fp16', None)
+        if fp16_cfg is not None:
+            wrap_fp16_model(model)
+        checkpoint = load_checkpoint(
+            model, args.checkpoint, map_location='cpu')
+        # old versions did not save class info in checkpoints,
+        # this walkaround is for backward compatibility
+        if 'CLASSES' in checkpoint['meta']:
+            model.CLASSES = checkpoint['meta']['CLASSES']
+        else:
+            model.CLASSES = dataset.CLASSES
+        device_id = torch.cuda.current_device() if distributed else 0
+        model = MMDataParallel(model, device_ids=[device_id])
+
+    for corruption, severity, chunk in work_items:
+        inds = list(
+            range(chunk * args.chunk_size,
+                  min((chunk + 1) * args.chunk_size, len(dataset))))
+        print('\nTesting {} at severity {}, images {}-{}'.format(
+            corruption, severity, inds[0], inds[-1]))
+        cond_dataset = corrupted_dataset(dataset, test_pipeline, corruption,
+                                         severity, args.corrupt_cache)
+        # TODO: support multiple images per gpu
+        #       (only minor changes are needed)
+        data_loader = build_dataloader(
+            Subset(cond_dataset, inds),
+            imgs_per_gpu=1,
+            workers_per_gpu=args.workers,
+            dist=False,
+            shuffle=False)
+        outputs = single_gpu_test(model, data_loader, args.show)
+        filename = chunk_file(args.work_dir, corruption, severity, chunk)
+        mmcv.mkdir_or_exist(osp.dirname(filename))
+        dump_atomic(outputs, filename)
+        if evaluate and args.eval:
+            evaluate_ready(args, cfg, dataset, conditions, num_chunks,
+                           aggregated_results, eval_results_filename)
+
+    if distributed:
+        dist.barrier()
+    if tmp_work_dir is not None:
+        shutil.rmtree(tmp_work_dir)
+    if not evaluate:
+        return
+    if not args.eval:
+        for corruption, severity in conditions:
+            if condition_done(args.work_dir, corruption, severity,
+                              num_chunks):
+                merge_condition(args, corruption, severity, num_chunks)
+        print('\nNo task was selected for evaluation;'
+              '\nUse --eval to select a task')
+        return
+    evaluate_ready(args, cfg, dataset, conditions, num_chunks,
+                   aggregated_results, eval_results_filename)
+    missing = [(corruption, severity) for corruption, severity in conditions
+               if severity not in aggregated_results.get(corruption, {})]
+    if missing:
+        print('\n{} conditions are not done yet, run again when the other '
+              'shards are finished to evaluate them'.format(len(missing)))
+        return
 
     # print filan results
     print('\nAggregated results:')